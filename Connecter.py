@@ -35,6 +35,8 @@ class Connection:
         self.connecter = connecter
         # True if this client ever got a message from this peer.
         self.got_anything = False
+        # True once the connection is lost, so blocks read from disk afterward are not sent.
+        self.closed = False
 
     def get_ip(self):
         return self.connection.get_ip()
@@ -177,6 +179,7 @@ class Connecter:
 
     def connection_lost(self, connection):
         c = self.connections[connection]
+        c.closed = True
         d = c.download
         # Remove mapping to the Connection instance.
         del self.connections[connection]
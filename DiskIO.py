@@ -0,0 +1,142 @@
+# see LICENSE.txt for license information
+
+from threading import Thread, Condition
+from Queue import Queue
+from traceback import print_exc
+
+class DiskIO:
+    """Runs disk jobs on a pool of worker threads, so a slow disk doesn't stall the reactor loop.
+
+    Each job's callback is called in the reactor loop with the job's result, or the IOError it raised.
+    With no worker threads, jobs run immediately in the caller's thread."""
+
+    def __init__(self, numthreads, external_add_task, max_queued = 64):
+        # Function to schedule a task in the reactor loop from another thread.
+        self.external_add_task = external_add_task
+        # Callers should stop submitting jobs once this many are queued.
+        self.max_queued = max_queued
+        # The number of jobs whose callbacks have not been called, counted in the reactor loop.
+        self.queued = 0
+        # Functions to call in the reactor loop once fewer than max_queued jobs are queued.
+        self.waiting = []
+        # The (func, args, callback) jobs waiting for a worker thread.
+        self.jobs = Queue()
+        # The number of jobs submitted that have not finished running, guarded by cond.
+        self.running = 0
+        self.cond = Condition()
+        self.threads = []
+        for i in xrange(numthreads):
+            t = Thread(target = self._work)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, func, args, callback):
+        # Run func(*args), then call callback(result, error) in the reactor loop.
+        self.queued += 1
+        if not self.threads:
+            result, error = self._run(func, args)
+            self._done(callback, result, error)
+            return
+        self.cond.acquire()
+        self.running += 1
+        self.cond.release()
+        self.jobs.put((func, args, callback))
+
+    def _run(self, func, args):
+        try:
+            return func(*args), None
+        except IOError, e:
+            return None, e
+        except:
+            # A bug, but the callback must still be called so the job isn't lost.
+            print_exc()
+            return None, IOError('disk job failed')
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            func, args, callback = job
+            result, error = self._run(func, args)
+            def foo(self = self, callback = callback, result = result, error = error):
+                self._done(callback, result, error)
+            self.external_add_task(foo, 0)
+            self.cond.acquire()
+            self.running -= 1
+            self.cond.notifyAll()
+            self.cond.release()
+
+    def _done(self, callback, result, error):
+        self.queued -= 1
+        callback(result, error)
+        while self.waiting and self.queued < self.max_queued:
+            # There is room for more jobs again.
+            self.waiting.pop(0)()
+
+    def is_full(self):
+        # Returns whether callers should wait before submitting more jobs.
+        return self.queued >= self.max_queued
+
+    def when_free(self, func):
+        # Call func in the reactor loop once there is room for more jobs.
+        if func not in self.waiting:
+            self.waiting.append(func)
+
+    def drain(self):
+        # Block until every job submitted has run, such as before accessing the disk directly.
+        # Their callbacks are still called later in the reactor loop.
+        self.cond.acquire()
+        while self.running:
+            self.cond.wait()
+        self.cond.release()
+
+    def stop(self):
+        # Stop the worker threads once they have run every job submitted.
+        for t in self.threads:
+            self.jobs.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+
+# everything below is for testing
+
+from threading import Event
+
+def test_inline():
+    results = []
+    d = DiskIO(0, None, 2)
+    d.submit(lambda x: x * 2, (3,), lambda r, e, results = results: results.append((r, e)))
+    assert results == [(6, None)]
+    assert d.queued == 0
+
+def test_threads():
+    tasks = []
+    d = DiskIO(2, lambda func, delay, tasks = tasks: tasks.append(func), 2)
+    go = Event()
+    def job(x, go = go):
+        go.wait()
+        if x is None:
+            raise IOError('bad')
+        return x
+    results = []
+    freed = []
+    d.submit(job, (1,), lambda r, e, results = results: results.append((r, e)))
+    d.submit(job, (None,), lambda r, e, results = results: results.append((r, e)))
+    # The queue is full until a callback runs in the reactor loop.
+    assert d.is_full()
+    d.when_free(lambda freed = freed: freed.append(1))
+    go.set()
+    d.drain()
+    assert d.running == 0
+    assert results == []
+    for func in tasks:
+        func()
+    results.sort()
+    assert results[0][0] is None and isinstance(results[0][1], IOError)
+    assert results[1] == (1, None)
+    assert freed == [1]
+    assert not d.is_full()
+    d.stop()
@@ -5,6 +5,7 @@ from CurrentRateMeasure import Measure
 from random import shuffle
 from time import time
 from bitfield import Bitfield
+from sha import sha
 
 class SingleDownload:
     def __init__(self, downloader, connection):
@@ -23,16 +24,21 @@ class SingleDownload:
         # The last time this client has gotten data from the peer.
         self.last = 0
         self.example_interest = None
+        # The pieces this peer is fast enough to download by itself, as dictionary keys.
+        self.owned = {}
 
     def disconnected(self):
         self.downloader.downloads.remove(self)
         # Decrement the availability of each piece this peer had.
-        for i in xrange(len(self.have)):
-            if self.have[i]:
-                self.downloader.picker.lost_have(i)
+        for i in self.have.indexes():
+            self.downloader.picker.lost_have(i)
+            self.downloader.lost_holder(i, self)
         self._letgo()
 
     def _letgo(self):
+        # Other peers may now download the pieces this peer was downloading by itself.
+        for index in self.owned.keys():
+            self.downloader.release(index)
         if not self.active_requests:
             return
         if self.downloader.storage.is_endgame():
@@ -42,18 +48,23 @@ class SingleDownload:
         # The piece indexes that this client was requesting from the peer.
         lost = []
         for index, begin, length in self.active_requests:
+            if self.downloader.drop_duplicate((index, begin, length)):
+                # Another peer is still sending us this block.
+                continue
             # No longer downloading this block.
             self.downloader.storage.request_lost(index, begin, length)
             if index not in lost:
                 lost.append(index)
         self.active_requests = []
+        # Only peers that have one of the lost pieces can take over its requests.
+        candidates = self.downloader.holders_of(lost)
         # Get all other SingleDownload instances that are not choking us.
-        ds = [d for d in self.downloader.downloads if not d.choked]
+        ds = [d for d in candidates if not d.choked]
         shuffle(ds)
 
         for d in ds:
             d._request_more(lost)
-        for d in self.downloader.downloads:
+        for d in candidates:
             # Get all other SingleDownload instances that are choking us. None of these were in ds.
             # Also, filter by the ones that we are not interested in.
             if d.choked and not d.interested:
@@ -94,14 +105,21 @@ class SingleDownload:
         if self.downloader.storage.is_endgame():
             # Remove this from the consolidated list of blocks sent to all peers.
             self.downloader.all_requests.remove((index, begin, len(piece)))
+        else:
+            # Cancel this block at any other peers we requested it from because it was urgent.
+            self.downloader.cancel_duplicates(self, (index, begin, len(piece)))
         # Update our upload and download rates.
         self.last = time()
         self.measure.update_rate(len(piece))
         self.downloader.measurefunc(len(piece))
         self.downloader.downmeasure.update_rate(len(piece))
+        self.downloader._update_download_rate(len(piece))
+        # Remember which peer sent this block, in case the piece fails validation.
+        self.downloader.sources.setdefault(index, {})[begin] = (self.connection.get_ip(), len(piece))
         # TODO
         if not self.downloader.storage.piece_came_in(index, begin, piece):
             # This block completed a piece but it failed validation.
+            self.downloader.piece_failed(index)
             if self.downloader.storage.is_endgame():
                 while self.downloader.storage.do_I_have_requests(index):
                     nb, nl = self.downloader.storage.new_request(index)
@@ -111,8 +129,19 @@ class SingleDownload:
                 return False
             # Decrease the priority of this piece...
             self.downloader.picker.bump(index)
+            self.downloader.release(index)
             # ... but try downloading this piece again immediately?
-            ds = [d for d in self.downloader.downloads if not d.choked]
+            ds = self.downloader.holders_of([index])
+            if self.downloader.suspects.has_key(index):
+                # Prefer peers that did not send blocks of the piece that failed.
+                others = [d for d in ds if not self.downloader.is_suspect(index, d.connection.get_ip())]
+                if others:
+                    ds = others
+                for d in ds:
+                    if d.choked and not d.interested:
+                        d.interested = True
+                        d.connection.send_interested()
+            ds = [d for d in ds if not d.choked]
             shuffle(ds)
             for d in ds:
                 d._request_more([index])
@@ -120,6 +149,8 @@ class SingleDownload:
         if self.downloader.storage.do_I_have(index):
             # Notify the picker that this piece is complete.
             self.downloader.picker.complete(index)
+            self.downloader.release(index)
+            self.downloader.piece_validated(index)
         if self.downloader.storage.is_endgame():
             for d in self.downloader.downloads:
                 if d is not self and d.interested:
@@ -136,7 +167,9 @@ class SingleDownload:
                         d.connection.send_cancel(index, begin, len(piece))
                         # Keep requesting pieces that we're requesting from other peers.
                         d.fix_download_endgame()
-        self._request_more()
+        if self in self.downloader.downloads:
+            # Validating the piece may have banned this peer, which disconnects it.
+            self._request_more()
         if self.downloader.picker.am_I_complete():
             for d in [i for i in self.downloader.downloads if i.have.numfalse == 0]:
                 d.connection.close()
@@ -144,12 +177,46 @@ class SingleDownload:
 
     def _want(self, index):
         # Want a piece if this user has it and TODO.
+        if not (self.have[index] and self.downloader.storage.do_I_have_requests(index)):
+            return False
+        if self.downloader.suspects.has_key(index) and self.downloader.is_suspect(index, self.connection.get_ip()):
+            # This peer may have sent bad data for the piece before, so prefer other peers.
+            return False
+        # Leave pieces that a fast peer is downloading by itself to that peer.
+        owner = self.downloader.owners.get(index)
+        return owner is None or owner is self or owner.is_snubbed()
+
+    def _want_any(self, index):
+        # Like _want, but also wants the leftover blocks of pieces other peers are downloading by themselves,
+        # and pieces that this peer may have sent bad data for.
         return self.have[index] and self.downloader.storage.do_I_have_requests(index)
 
+    def is_fast(self):
+        # Whether this peer can download a whole piece within piece_affinity_time seconds.
+        return (self.downloader.piece_affinity_time > 0 and self.measure.get_rate() *
+            self.downloader.piece_affinity_time >= self.downloader.piece_size)
+
+    def _next_owned(self):
+        # Returns a piece this peer is downloading by itself with blocks left to request, or None.
+        for index in self.owned.keys():
+            if self.downloader.storage.do_I_have_requests(index):
+                return index
+        return None
+
+    def _disk_freed(self):
+        # Request more blocks now that the disk has caught up, if still unchoked and connected.
+        if not self.choked and self in self.downloader.downloads:
+            self._request_more()
+
     def _request_more(self, indices = None):
         assert not self.choked
         # Return if we already have the maximum outstanding requests to this peer.
-        if len(self.active_requests) == self.downloader.backlog:
+        backlog = self.downloader.get_backlog()
+        if len(self.active_requests) >= backlog:
+            return
+        if self.downloader.storage.is_disk_busy():
+            # Writing to disk has fallen behind, so wait before requesting more blocks.
+            self.downloader.storage.when_disk_free(self._disk_freed)
             return
         if self.downloader.storage.is_endgame():
             # Keep requesting pieces that we're requesting from other peers.
@@ -157,11 +224,19 @@ class SingleDownload:
             return
 
         lost_interests = []
-        while len(self.active_requests) < self.downloader.backlog:
+        while len(self.active_requests) < backlog:
             # Have less than the maximum outstanding requests to this peer...
             if indices is None:
-                # Not passed any specific indexes to get. Pick a piece to download.
-                interest = self.downloader.picker.next(self._want, self.have.numfalse == 0)
+                # Not passed any specific indexes to get.
+                # Finish the pieces this peer is downloading by itself first, so they complete in one pipeline.
+                interest = self._next_owned()
+                if interest is None:
+                    # Pick a piece to download.
+                    interest = self.downloader.picker.next(self._want, self.have.numfalse == 0, self.have)
+                if interest is None and (self.downloader.owners or self.downloader.suspects):
+                    # Nothing else is left, so help with pieces that fast peers are downloading,
+                    # or download again a piece that this peer may have sent bad data for.
+                    interest = self.downloader.picker.next(self._want_any, self.have.numfalse == 0, self.have)
             else:
                 # Pick a piece from one of the given indexes to download.
                 interest = None
@@ -177,6 +252,10 @@ class SingleDownload:
                 self.interested = True
                 self.connection.send_interested()
             self.example_interest = interest
+            if self.is_fast() and not self.downloader.owners.has_key(interest):
+                # This peer is fast enough to download the whole piece by itself.
+                self.downloader.owners[interest] = self
+                self.owned[interest] = 1
             # Get a block of the piece to request.
             begin, length = self.downloader.storage.new_request(interest)
             # Notify the PiecePicker that we're requesting this piece.
@@ -188,25 +267,23 @@ class SingleDownload:
                 # TODO
                 lost_interests.append(interest)
 
+        if self.downloader.urgent and len(self.active_requests) < backlog:
+            self._request_duplicates(backlog)
+
         if not self.active_requests and self.interested:
             # Peer has no pieces this client wants, so no longer interested.
             self.interested = False
             self.connection.send_not_interested()
 
         if lost_interests:
-            for d in self.downloader.downloads:
+            for d in self.downloader.holders_of(lost_interests):
                 if d.active_requests or not d.interested:
                     # Looking for a client that has no active requests, but we're interested in.
                     continue
                 if d.example_interest is not None and self.downloader.storage.do_I_have_requests(d.example_interest):
                     continue
-                for lost in lost_interests:
-                    if d.have[lost]:
-                        break
-                else:
-                    continue
                 # 
-                interest = self.downloader.picker.next(d._want, d.have.numfalse == 0)
+                interest = self.downloader.picker.next(d._want_any, d.have.numfalse == 0, d.have)
                 if interest is None:
                     d.interested = False
                     d.connection.send_not_interested()
@@ -216,6 +293,8 @@ class SingleDownload:
         if self.downloader.storage.is_endgame():
             # Now entering endgame mode.
             self.downloader.all_requests = []
+            # Endgame requests every block from every peer, so stop tracking urgent duplicates.
+            self.downloader.duplicates = {}
             # Consolidate the block requests this client has sent to all peers.
             for d in self.downloader.downloads:
                 self.downloader.all_requests.extend(d.active_requests)
@@ -223,6 +302,27 @@ class SingleDownload:
             for d in self.downloader.downloads:
                 d.fix_download_endgame()
 
+    def _request_duplicates(self, backlog):
+        # Request blocks of urgent pieces that other peers are already sending us,
+        # so that whichever peer is faster delivers them in time for the stream reader.
+        for index in self.downloader.urgent:
+            if not self.have[index] or self.downloader.storage.do_I_have(index):
+                continue
+            for d in self.downloader.holders_of([index]):
+                if d is self:
+                    continue
+                for r in d.active_requests:
+                    if r[0] != index or r in self.active_requests:
+                        continue
+                    if not self.interested:
+                        self.interested = True
+                        self.connection.send_interested()
+                    self.downloader.duplicates[r] = self.downloader.duplicates.get(r, 0) + 1
+                    self.active_requests.append(r)
+                    self.connection.send_request(r[0], r[1], r[2])
+                    if len(self.active_requests) >= backlog:
+                        return
+
     def fix_download_endgame(self):
         # Find pieces this peer has which we're requesting from other peers.
         want = [a for a in self.downloader.all_requests if self.have[a[0]] and a not in self.active_requests]
@@ -240,7 +340,7 @@ class SingleDownload:
             return
         # Don't send exceed the maximum number of requests to the client.
         shuffle(want)
-        del want[self.downloader.backlog - len(self.active_requests):]
+        del want[max(0, self.downloader.get_backlog() - len(self.active_requests)):]
         # Request the blocks that we're requesting from other peers.
         self.active_requests.extend(want)
         for piece, begin, length in want:
@@ -253,6 +353,7 @@ class SingleDownload:
         self.have[index] = True
         # Increase the availability of this piece.
         self.downloader.picker.got_have(index)
+        self.downloader.got_holder(index, self)
         if self.downloader.picker.am_I_complete() and self.have.numfalse == 0:
             # Both this client and the peer have every piece, so close.
             self.connection.close()
@@ -272,10 +373,11 @@ class SingleDownload:
     def got_have_bitfield(self, have):
         # Assign the full bitfield of pieces this client has.
         self.have = have
-        for i in xrange(len(self.have)):
+        pieces = have.indexes()
+        for i in pieces:
             # Increase the availability of each piece.
-            if self.have[i]:
-                self.downloader.picker.got_have(i)
+            self.downloader.picker.got_have(i)
+            self.downloader.got_holder(i, self)
         if self.downloader.picker.am_I_complete() and self.have.numfalse == 0:
             # Both this client and the peer have every piece, so close.
             self.connection.close()
@@ -287,9 +389,9 @@ class SingleDownload:
                     self.interested = True
                     self.connection.send_interested()
                     return
-        for i in xrange(len(self.have)):
+        for i in pieces:
             # This peer has a piece that we want, so express interest.
-            if self.have[i] and self.downloader.storage.do_I_have_requests(i):
+            if self.downloader.storage.do_I_have_requests(i):
                 self.interested = True
                 self.connection.send_interested()
                 return
@@ -304,7 +406,10 @@ class SingleDownload:
 
 class Downloader:
     def __init__(self, storage, picker, backlog, max_rate_period, numpieces, 
-            downmeasure, snub_time, measurefunc = lambda x: None):
+            downmeasure, snub_time, measurefunc = lambda x: None,
+            max_download_rate = 0, sched = None, pause_reading = None,
+            resume_reading = None, request_size = 2 ** 14, piece_size = 0,
+            piece_affinity_time = 0, ban = lambda ip: None):
         # The StorageWrapper instance.
         self.storage = storage
         # The PiecePicker instance.
@@ -320,18 +425,259 @@ class Downloader:
         self.measurefunc = measurefunc
         # The SingleDownload instances.
         self.downloads = []
+        # The download rate to cap at in bytes per second, or 0 for no cap.
+        self.max_download_rate = max_download_rate
+        # Function to schedule events in the reactor loop of RawServer.
+        self.sched = sched
+        # Functions that stop and resume RawServer reading from peer sockets.
+        self.pause_reading = pause_reading
+        self.resume_reading = resume_reading
+        # The size of each block requested, used to size request pipelines under a rate cap.
+        self.request_size = request_size
+        # A token bucket holding the bytes we may download before exceeding the rate cap.
+        # It refills at max_download_rate up to one second's worth of data.
+        self.download_tokens = float(max_download_rate)
+        # The last time download_tokens was refilled.
+        self.tokens_updated = time()
+        # Whether this client has paused reading from peers to stay under the rate cap.
+        self.reading_paused = False
+        # Pieces a stream reader needs right away, earliest deadline first.
+        # Blocks of these pieces may be requested from more than one peer.
+        self.urgent = []
+        # Maps each (index, begin, length) block requested from more than one peer
+        # to the number of extra peers it was requested from.
+        self.duplicates = {}
+        # In endgame mode, the blocks still requested from any peer.
+        self.all_requests = []
+        # The number of bytes in each piece.
+        self.piece_size = piece_size
+        # Peers fast enough to download a whole piece within this many seconds download pieces by
+        # themselves, so that they complete quickly and each piece comes from one peer.
+        # 0 means pieces are shared among peers as blocks are requested.
+        self.piece_affinity_time = piece_affinity_time
+        # Maps each piece a fast peer is downloading by itself to its SingleDownload instance.
+        self.owners = {}
+        # Function to stop connecting to the peer at an IP address that sent bad data.
+        self.ban = ban
+        # Maps each piece being downloaded to a dictionary from the first byte of each block
+        # to the IP address of the peer that sent it and the block length.
+        self.sources = {}
+        # Maps each piece that failed validation with blocks from several peers to a dictionary
+        # from the first byte of each block to a list of the (ip, length, digest) of the bad blocks.
+        # Once the piece is downloaded and validated, the peers that sent different data are banned.
+        self.suspects = {}
+        # Maps each piece index to a dictionary whose keys are the SingleDownload instances
+        # of the peers that have that piece. Pieces that no connected peer has are absent.
+        self.holders = {}
+
+    def release(self, index):
+        # Stop downloading this piece from only one peer.
+        owner = self.owners.get(index)
+        if owner is not None:
+            del self.owners[index]
+            del owner.owned[index]
+
+    def piece_failed(self, index):
+        # The piece failed validation, so find which peer sent the bad data.
+        sources = self.sources.get(index, {})
+        if self.sources.has_key(index):
+            del self.sources[index]
+        ips = {}
+        # Blocks restored from fast-resume state have no source, so count the bytes peers sent.
+        amount = 0
+        for ip, length in sources.values():
+            ips[ip] = 1
+            amount += length
+        if len(ips) == 1 and amount == self.storage.get_piece_length(index):
+            # One peer sent every block of this piece.
+            self.ban(ips.keys()[0])
+            return
+        # Compare what each peer sent with the blocks that pass validation later.
+        suspects = self.suspects.setdefault(index, {})
+        for begin, (ip, length) in sources.items():
+            data = self.storage.get_failed_piece(index, begin, length)
+            if data is not None:
+                suspects.setdefault(begin, []).append((ip, length, sha(data).digest()))
+
+    def piece_validated(self, index):
+        # The piece was downloaded and validated.
+        if self.sources.has_key(index):
+            del self.sources[index]
+        if not self.suspects.has_key(index):
+            return
+        suspects = self.suspects[index]
+        del self.suspects[index]
+        for begin, l in suspects.items():
+            for ip, length, digest in l:
+                data = self.storage.get_piece(index, begin, length)
+                if data is not None and sha(data).digest() != digest:
+                    # This peer sent a block that differs from the valid one.
+                    self.ban(ip)
+
+    def is_suspect(self, index, ip):
+        # Whether the peer at this IP address sent a block of this piece when it failed validation.
+        for l in self.suspects[index].values():
+            for x in l:
+                if x[0] == ip:
+                    return True
+        return False
 
     def make_download(self, connection):
         self.downloads.append(SingleDownload(self, connection))
         return self.downloads[-1]
 
+    def get_backlog(self):
+        # The maximum number of requests to issue to any peer.
+        if self.max_download_rate <= 0:
+            return self.backlog
+        # Under a rate cap, pipeline only about a second's worth of data,
+        # split among the peers we're downloading from, so they don't queue up data we won't read.
+        n = 0
+        for d in self.downloads:
+            if d.interested and not d.choked:
+                n += 1
+        per_peer = self.max_download_rate / (self.request_size * max(n, 1))
+        return max(1, min(self.backlog, int(per_peer) + 1))
+
+    def _refill_tokens(self):
+        t = time()
+        self.download_tokens = min(float(self.max_download_rate), 
+            self.download_tokens + (t - self.tokens_updated) * self.max_download_rate)
+        self.tokens_updated = t
+
+    def _update_download_rate(self, amount):
+        if self.max_download_rate <= 0:
+            return
+        # Take the downloaded bytes out of the token bucket.
+        self._refill_tokens()
+        self.download_tokens -= amount
+        if self.download_tokens < 0 and not self.reading_paused:
+            # We have exceeded the maximum download rate, so stop reading from peers for now.
+            self.reading_paused = True
+            self.pause_reading()
+            # Schedule resuming once the bucket has refilled.
+            self.sched(self._unpause, -self.download_tokens / self.max_download_rate)
+
+    def _unpause(self):
+        if not self.reading_paused:
+            return
+        if self.max_download_rate > 0:
+            self._refill_tokens()
+            if self.download_tokens < 0:
+                # The cap was lowered since pausing, so keep waiting.
+                self.sched(self._unpause, -self.download_tokens / self.max_download_rate)
+                return
+        self.reading_paused = False
+        self.resume_reading()
+
+    def change_max_download_rate(self, newval):
+        def foo(self=self, newval=newval):
+            self._change_max_download_rate(newval)
+        self.sched(foo, 0)
+
+    def _change_max_download_rate(self, newval):
+        self.max_download_rate = newval
+        self._refill_tokens()
+        self._unpause()
+
+    def set_urgent(self, pieces):
+        # Assign the pieces a stream reader needs right away, and fill pipelines with them.
+        self.urgent = pieces
+        if self.storage.is_endgame():
+            return
+        for d in self.holders_of(pieces):
+            if not d.choked:
+                d._request_more()
+
+    def priorities_changed(self, pieces):
+        # The given pieces became wanted or unwanted, such as when files are skipped.
+        if self.all_requests and not self.storage.is_endgame():
+            # Pieces became wanted again during endgame mode, so it ended.
+            # Track the blocks that endgame requested from several peers as duplicates.
+            counts = {}
+            for d in self.downloads:
+                for r in d.active_requests:
+                    counts[r] = counts.get(r, 0) + 1
+            for r, n in counts.items():
+                if n > 1:
+                    self.duplicates[r] = n - 1
+            self.all_requests = []
+        for d in self.holders_of(pieces):
+            if not d.choked:
+                d._request_more()
+            elif not d.interested:
+                for i in pieces:
+                    if d.have[i] and self.storage.do_I_have_requests(i):
+                        # The peer has a piece that is now wanted, so express interest.
+                        d.interested = True
+                        d.connection.send_interested()
+                        break
+
+    def piece_lost(self, index, priority = 0):
+        # A piece we had failed validation, so download it again from the peers that have it.
+        self.picker.lost(index, len(self.holders.get(index, {})))
+        if priority != 0:
+            self.picker.set_priority(index, priority)
+        if priority != -1:
+            self.priorities_changed([index])
+
+    def drop_duplicate(self, request):
+        # A peer will no longer send this block. Returns whether another peer still will.
+        n = self.duplicates.get(request)
+        if not n:
+            return False
+        if n == 1:
+            del self.duplicates[request]
+        else:
+            self.duplicates[request] = n - 1
+        return True
+
+    def cancel_duplicates(self, download, request):
+        # The given peer sent this block, so cancel it at any other peers we requested it from.
+        if not self.duplicates.has_key(request):
+            return
+        del self.duplicates[request]
+        for d in self.holders_of([request[0]]):
+            if d is download:
+                continue
+            try:
+                d.active_requests.remove(request)
+            except ValueError:
+                continue
+            d.connection.send_cancel(request[0], request[1], request[2])
+
+    def got_holder(self, index, download):
+        # The peer of the given SingleDownload now has this piece.
+        self.holders.setdefault(index, {})[download] = 1
+
+    def lost_holder(self, index, download):
+        # The peer of the given SingleDownload disconnected while having this piece.
+        h = self.holders.get(index)
+        if h is None:
+            return
+        try:
+            del h[download]
+        except KeyError:
+            pass
+        if not h:
+            del self.holders[index]
+
+    def holders_of(self, indices):
+        # Returns the SingleDownload instances of peers that have any of the given pieces.
+        if len(indices) == 1:
+            return self.holders.get(indices[0], {}).keys()
+        r = {}
+        for i in indices:
+            r.update(self.holders.get(i, {}))
+        return r.keys()
+
 
 class DummyPicker:
     def __init__(self, num, r):
         self.stuff = range(num)
         self.r = r
 
-    def next(self, wantfunc, seed):
+    def next(self, wantfunc, seed, bitfield = None):
         for i in self.stuff:
             if wantfunc(i):
                 return i
@@ -362,6 +708,14 @@ class DummyStorage:
         self.active = [[] for i in xrange(numpieces)]
         self.endgame = False
         self.have_endgame = have_endgame
+        self.busy = False
+        self.waiting = []
+
+    def is_disk_busy(self):
+        return self.busy
+
+    def when_disk_free(self, func):
+        self.waiting.append(func)
 
     def do_I_have_requests(self, index):
         return self.remaining[index] != []
@@ -395,8 +749,12 @@ class DummyStorage:
         return self.have_endgame and self.endgame
 
 class DummyConnection:
-    def __init__(self, events):
+    def __init__(self, events, ip = 'fake.ip'):
         self.events = events
+        self.ip = ip
+
+    def get_ip(self):
+        return self.ip
 
     def send_interested(self):
         self.events.append('interested')
@@ -434,6 +792,21 @@ def test_stops_at_backlog():
     assert ds.remaining == [[(0, 2)]]
     assert ds.active == [[(2, 2), (6, 2)]]
 
+def test_waits_for_disk():
+    ds = DummyStorage([[(0, 2), (2, 2)]])
+    ds.busy = True
+    events = []
+    d = Downloader(ds, DummyPicker(len(ds.remaining), events), 2, 15, 1, Measure(15), 10)
+    sd = d.make_download(DummyConnection(events))
+    sd.got_have_bitfield(Bitfield(1, chr(0x80)))
+    sd.got_unchoke()
+    # Nothing is requested until the disk catches up.
+    assert events == ['got have', 'interested']
+    assert ds.waiting == [sd._disk_freed]
+    ds.busy = False
+    ds.waiting.pop()()
+    assert events[2:] == ['requested', ('request', 0, 2, 2), 'requested', ('request', 0, 0, 2)]
+
 def test_got_have_single():
     ds = DummyStorage([[(0, 2)]])
     events = []
@@ -538,7 +911,7 @@ def test_endgame():
     assert ev2 == []
 
     sd4 = d.make_download(DummyConnection(ev4))
-    sd4.got_have_bitfield([True, True, True])
+    sd4.got_have_bitfield(Bitfield(3, chr(0xE0)))
     assert ev4 == ['interested']
     del ev4[:]
     sd4.got_unchoke()
@@ -581,3 +954,283 @@ def test_stops_at_backlog_endgame():
     sd1.got_piece(0, n, 'ab')
     assert ev1 == []
     assert ev2 == [('cancel', 0, n, 2), ('request', 0, 2-n, 2)]
+
+def test_holders_track_haves():
+    ds = DummyStorage([[(0, 2)], [(0, 2)]], numpieces = 2)
+    events = []
+    d = Downloader(ds, DummyPicker(len(ds.remaining), events), 2, 15, 2, Measure(15), 10)
+    sd1 = d.make_download(DummyConnection(events))
+    sd2 = d.make_download(DummyConnection(events))
+    sd3 = d.make_download(DummyConnection(events))
+    sd1.got_have_bitfield(Bitfield(2, chr(0xC0)))
+    sd2.got_have(1)
+    assert d.holders_of([0]) == [sd1]
+    x = d.holders_of([0, 1])
+    x.sort()
+    y = [sd1, sd2]
+    y.sort()
+    assert x == y
+    sd1.got_unchoke()
+    del events[:]
+    sd1.disconnected()
+    assert d.holders_of([0]) == []
+    assert d.holders_of([1]) == [sd2]
+    # sd3 has neither piece, so it was never asked to take over the lost requests.
+    assert events == ['lost have', 'lost have', 'interested']
+
+def test_piece_lost():
+    from PiecePicker import PiecePicker
+    ds = DummyStorage([[], [(0, 2)]], numpieces = 2)
+    events = []
+    picker = PiecePicker(2)
+    picker.complete(0)
+    d = Downloader(ds, picker, 2, 15, 2, Measure(15), 10)
+    sd = d.make_download(DummyConnection(events))
+    sd.got_have_bitfield(Bitfield(2, chr(0x80)))
+    assert events == []
+    # Piece 0 failed validation, so the peer that has it is asked for it again.
+    ds.remaining[0] = [(0, 2)]
+    d.piece_lost(0)
+    assert picker.numinterests[0] == 1
+    assert events == ['interested']
+    sd.got_unchoke()
+    assert events[-1] == ('request', 0, 0, 2)
+
+def test_download_rate_cap():
+    ds = DummyStorage([[(0, 2), (2, 2), (4, 2), (6, 2)]])
+    events = []
+    tasks = []
+    d = Downloader(ds, DummyPicker(len(ds.remaining), events), 5, 15, 1, Measure(15), 10,
+        max_download_rate = 2, sched = lambda f, delay: tasks.append(f),
+        pause_reading = lambda: events.append('pause'),
+        resume_reading = lambda: events.append('resume'), request_size = 2)
+    sd = d.make_download(DummyConnection(events))
+    sd.got_have_bitfield(Bitfield(1, chr(0x80)))
+    del events[:]
+    # Only two requests are pipelined at a rate of one block per second.
+    sd.got_unchoke()
+    assert events == ['requested', ('request', 0, 6, 2), 'requested', ('request', 0, 4, 2)]
+    del events[:]
+    sd.got_piece(0, 6, 'ab')
+    assert 'pause' not in events
+    del events[:]
+    sd.got_piece(0, 4, 'ab')
+    assert events[0] == 'pause'
+    assert len(tasks) == 1
+    del events[:]
+    # The bucket has not refilled yet.
+    tasks.pop()()
+    assert events == []
+    assert len(tasks) == 1
+    d.tokens_updated -= 2
+    tasks.pop()()
+    assert events == ['resume']
+    del events[:]
+    # Removing the cap restores the full backlog.
+    d._change_max_download_rate(0)
+    assert d.get_backlog() == 5
+
+def test_urgent_duplicates():
+    ds = DummyStorage([[(0, 2), (2, 2), (4, 2)]])
+    events = []
+    d = Downloader(ds, DummyPicker(len(ds.remaining), events), 2, 15, 1, Measure(15), 10)
+    ev1 = []
+    ev2 = []
+    sd1 = d.make_download(DummyConnection(ev1))
+    sd2 = d.make_download(DummyConnection(ev2))
+    sd1.got_unchoke()
+    sd1.got_have(0)
+    sd2.got_unchoke()
+    sd2.got_have(0)
+    assert ev1 == ['interested', ('request', 0, 4, 2), ('request', 0, 2, 2)]
+    assert ev2 == ['interested', ('request', 0, 0, 2)]
+    del ev1[:]
+    del ev2[:]
+    # A stream reader needs piece 0, so the peer with a free slot is also asked for a block in flight.
+    d.set_urgent([0])
+    assert ev1 == []
+    assert ev2 == [('request', 0, 4, 2)]
+    del ev2[:]
+    sd1.got_piece(0, 4, 'ab')
+    assert ev2 == [('cancel', 0, 4, 2)]
+    assert ev1 == [('request', 0, 0, 2)]
+    del ev2[:]
+    # Losing a peer doesn't release a block still requested from another.
+    sd2.got_choke()
+    assert ds.remaining == [[]]
+    sd1.got_piece(0, 2, 'ab')
+    sd1.got_piece(0, 0, 'ab')
+    assert ds.do_I_have(0)
+    assert d.duplicates == {}
+
+def test_priorities_changed_leaves_endgame():
+    ds = DummyStorage([[(0, 2)], []], have_endgame = True, numpieces = 2)
+    events = []
+    d = Downloader(ds, DummyPicker(len(ds.remaining), events), 2, 15, 2, Measure(15), 10)
+    ev1 = []
+    ev2 = []
+    sd1 = d.make_download(DummyConnection(ev1))
+    sd2 = d.make_download(DummyConnection(ev2))
+    sd1.got_have_bitfield(Bitfield(2, chr(0xC0)))
+    sd2.got_have_bitfield(Bitfield(2, chr(0xC0)))
+    sd1.got_unchoke()
+    sd2.got_unchoke()
+    # Endgame mode requests the only wanted block from both peers.
+    assert ev1 == ['interested', ('request', 0, 0, 2)]
+    assert ev2[-1] == ('request', 0, 0, 2)
+    del ev1[:]
+    del ev2[:]
+    # Piece 1 becomes wanted, such as when its file is no longer skipped.
+    ds.remaining[1] = [(0, 2), (2, 2), (4, 2)]
+    ds.endgame = False
+    d.priorities_changed([1])
+    assert d.all_requests == []
+    assert d.duplicates == {(0, 0, 2): 1}
+    # Each peer is asked for a block of piece 1, in no particular order.
+    assert len(ev1) == 1 and len(ev2) == 1
+    x = ev1 + ev2
+    x.sort()
+    assert x == [('request', 1, 2, 2), ('request', 1, 4, 2)]
+
+def test_piece_affinity():
+    ds = DummyStorage([[(0, 2), (2, 2), (4, 2), (6, 2)], [(0, 2), (2, 2), (4, 2), (6, 2)]], numpieces = 2)
+    events = []
+    d = Downloader(ds, DummyPicker(len(ds.remaining), events), 2, 15, 2, Measure(15), 10,
+        piece_size = 8, piece_affinity_time = 10)
+    ev1 = []
+    ev2 = []
+    sd1 = d.make_download(DummyConnection(ev1))
+    sd2 = d.make_download(DummyConnection(ev2))
+    sd1.is_fast = lambda: True
+    sd2.is_fast = lambda: False
+    sd1.last = time()
+    sd1.got_have_bitfield(Bitfield(2, chr(0xC0)))
+    sd2.got_have_bitfield(Bitfield(2, chr(0xC0)))
+    sd1.got_unchoke()
+    assert ev1 == ['interested', ('request', 0, 6, 2), ('request', 0, 4, 2)]
+    assert d.owners == {0: sd1}
+    # The slow peer leaves piece 0 to the fast peer.
+    sd2.got_unchoke()
+    assert ev2 == ['interested', ('request', 1, 6, 2), ('request', 1, 4, 2)]
+    del ev1[:]
+    del ev2[:]
+    sd1.got_piece(0, 6, 'ab')
+    assert ev1 == [('request', 0, 2, 2)]
+    sd2.got_piece(1, 6, 'ab')
+    sd2.got_piece(1, 4, 'ab')
+    sd2.got_piece(1, 2, 'ab')
+    # Only piece 0 has blocks left, so the slow peer shares them.
+    assert ev2[-1] == ('request', 0, 0, 2)
+    assert d.owners == {0: sd1}
+    # Once the fast peer chokes us, its piece is released.
+    sd1.got_choke()
+    assert d.owners == {}
+    assert sd1.owned == {}
+
+def test_ban_bad_data():
+    from StorageWrapper import StorageWrapper, DummyStorage as DummyDiskStorage
+    banned = []
+    def make(banned = banned):
+        # No peer has the second piece, so the download never enters endgame mode.
+        ds = DummyDiskStorage(8)
+        sw = StorageWrapper(ds, 2, [sha('abcd').digest(), sha('efgh').digest()], 4, lambda: None, None)
+        return Downloader(sw, DummyPicker(2, []), 1, 15, 2, Measure(15), 10,
+            ban = banned.append)
+    # One peer sent the whole piece, so it sent the bad data.
+    d = make()
+    sd1 = d.make_download(DummyConnection([], 'a'))
+    sd1.got_unchoke()
+    sd1.got_have(0)
+    sd1.got_piece(0, 0, 'ab')
+    sd1.got_piece(0, 2, 'xx')
+    assert banned == ['a']
+    assert d.suspects == {}
+    del banned[:]
+    # Two peers sent blocks, so download the piece again from another and compare.
+    d = make()
+    sd1 = d.make_download(DummyConnection([], 'a'))
+    sd2 = d.make_download(DummyConnection([], 'b'))
+    sd1.got_unchoke()
+    sd1.got_have(0)
+    sd2.got_unchoke()
+    sd2.got_have(0)
+    assert sd1.active_requests == [(0, 0, 2)]
+    assert sd2.active_requests == [(0, 2, 2)]
+    events = []
+    sd3 = d.make_download(DummyConnection(events, 'c'))
+    sd3.got_have(0)
+    sd1.got_piece(0, 0, 'ab')
+    sd2.got_piece(0, 2, 'xx')
+    assert banned == []
+    assert d.is_suspect(0, 'a') and d.is_suspect(0, 'b')
+    # The piece is downloaded again from the peer that sent none of it.
+    assert sd1.active_requests == [] and sd2.active_requests == []
+    assert not sd1._want(0)
+    assert events == ['interested']
+    sd3.got_unchoke()
+    assert sd3.active_requests == [(0, 0, 2)]
+    sd3.got_piece(0, 0, 'ab')
+    sd3.got_piece(0, 2, 'cd')
+    assert d.storage.do_I_have(0)
+    assert banned == ['b']
+    assert d.suspects == {}
+    assert d.sources == {}
+    del banned[:]
+    # A block written in an earlier session was bad, so the one peer that sent the rest is only a suspect.
+    d = make()
+    d.storage.new_request(0)
+    d.storage.piece_came_in(0, 0, 'zz')
+    sd1 = d.make_download(DummyConnection([], 'a'))
+    sd1.got_unchoke()
+    sd1.got_have(0)
+    sd1.got_piece(0, 2, 'cd')
+    assert banned == []
+    assert d.is_suspect(0, 'a')
+    sd1.got_piece(0, 0, 'ab')
+    sd1.got_piece(0, 2, 'cd')
+    assert d.storage.do_I_have(0)
+    assert banned == []
+
+def test_ban_sender_of_last_block():
+    from StorageWrapper import StorageWrapper, DummyStorage as DummyDiskStorage
+    banned = []
+    downloaders = []
+    def ban(ip, banned = banned, downloaders = downloaders):
+        # Banning a peer closes its connection right away.
+        banned.append(ip)
+        for sd in downloaders[0].downloads[:]:
+            if sd.connection.get_ip() == ip:
+                sd.disconnected()
+    ds = DummyDiskStorage(12)
+    sw = StorageWrapper(ds, 2, [sha('abcd').digest(), sha('efgh').digest(), sha('ijkl').digest()],
+        4, lambda: None, None)
+    d = Downloader(sw, DummyPicker(3, []), 1, 15, 3, Measure(15), 10, ban = ban)
+    downloaders.append(d)
+    events = []
+    sd1 = d.make_download(DummyConnection(events, 'a'))
+    sd2 = d.make_download(DummyConnection([], 'b'))
+    sd1.got_unchoke()
+    sd2.got_unchoke()
+    sd1.got_have(0)
+    sd1.got_have(1)
+    sd2.got_have(0)
+    sd1.got_piece(0, 0, 'xx')
+    sd2.got_piece(0, 2, 'cd')
+    assert d.is_suspect(0, 'a') and d.is_suspect(0, 'b')
+    sd2.got_piece(0, 0, 'ab')
+    assert sd2.active_requests == [(0, 2, 2)]
+    sd2.got_choke()
+    sd1.got_piece(1, 0, 'ef')
+    sd1.got_piece(1, 2, 'gh')
+    # Only the peer that sent bad data is left to download the last block of the piece.
+    assert sd1.active_requests == [(0, 2, 2)]
+    sd1.got_have(2)
+    del events[:]
+    sd1.got_piece(0, 2, 'cd')
+    assert d.storage.do_I_have(0)
+    assert banned == ['a']
+    # The banned peer is disconnected, so it requests nothing more and leaves the last piece to others.
+    assert sd1 not in d.downloads
+    assert sd1.active_requests == []
+    assert events == []
+    assert d.storage.do_I_have_requests(2)
@@ -201,6 +201,8 @@ class Encoder:
         self.connections = {}
         # Peers this client can connect to if the number of connections drops below max_initiate.
         self.spares = []
+        # The IP addresses of peers that sent data failing hash checks, as dictionary keys.
+        self.banned = {}
         schedulefunc(self.send_keepalives, keepalive_delay)
 
     def send_keepalives(self):
@@ -212,6 +214,9 @@ class Encoder:
                 c.send_message('')
 
     def start_connection(self, dns, id):
+        if self.banned.has_key(dns[0]):
+            # Don't connect to a peer that sent bad data.
+            return
         if id:
             if id == self.my_id:
                 # Don't connect to ourself.
@@ -252,9 +257,20 @@ class Encoder:
         return self.everinc
 
     def external_connection_made(self, connection):
+        if self.banned.has_key(connection.get_ip()):
+            # Refuse connections from a peer that sent bad data.
+            connection.close()
+            return
         self.connections[connection] = Connection(self, 
             connection, None, False)
 
+    def ban(self, ip):
+        # Close any connections to the peer at this IP address, and never connect to it again.
+        self.banned[ip] = 1
+        for c in self.connections.values():
+            if c.get_ip() == ip:
+                c.close()
+
     def connection_flushed(self, connection):
         c = self.connections[connection]
         if c.complete:
@@ -303,13 +319,14 @@ class DummyRawServer:
         return c
 
 class DummyRawConnection:
-    def __init__(self):
+    def __init__(self, ip = 'fake.ip'):
         self.closed = False
         self.data = []
         self.flushed = True
+        self.ip = ip
 
     def get_ip(self):
-        return 'fake.ip'
+        return self.ip
 
     def is_flushed(self):
         return self.flushed
@@ -700,3 +717,21 @@ def test_ignore_connect_to_self():
 def test_conversion():
     assert toint(tobinary(50000)) == 50000
 
+def test_ban():
+    c = DummyConnecter()
+    rs = DummyRawServer()
+    e = Encoder(c, rs, 'a' * 20, 500, dummyschedule, 30, 'd' * 20)
+    c1 = DummyRawConnection('bad.ip')
+    c2 = DummyRawConnection()
+    e.external_connection_made(c1)
+    e.external_connection_made(c2)
+    e.ban('bad.ip')
+    assert c1.closed
+    assert not c2.closed
+    assert len(e.connections) == 1
+    c3 = DummyRawConnection('bad.ip')
+    e.external_connection_made(c3)
+    assert c3.closed
+    assert len(e.connections) == 1
+    e.start_connection(('bad.ip', 6881), 'b' * 20)
+    assert rs.connects == []
@@ -0,0 +1,116 @@
+# see LICENSE.txt for license information
+
+from bisect import bisect_right
+
+class FilePriority:
+    def __init__(self, files, piece_size, storagewrapper, picker, downloader, sched):
+        # The (filename, length) pairs of the torrent.
+        self.files = files
+        self.piece_size = piece_size
+        # The StorageWrapper instance.
+        self.storagewrapper = storagewrapper
+        # The PiecePicker instance.
+        self.picker = picker
+        # The Downloader instance.
+        self.downloader = downloader
+        # Function to schedule events in the reactor loop of RawServer from other threads,
+        # such as RawServer.external_add_task, which wakes the loop.
+        self.sched = sched
+        # The priority of each file: -1 to skip it, 0 for normal, or higher to download it first.
+        self.priorities = [0] * len(files)
+        # The first byte offset of each file.
+        self.begins = []
+        total = 0
+        for file, length in files:
+            self.begins.append(total)
+            total += length
+
+    def set_priority(self, index, priority):
+        # Change the priority of the file at the given index, from any thread.
+        def foo(self = self, index = index, priority = priority):
+            self.set_priorities({index: priority})
+        self.sched(foo, 0)
+
+    def set_priorities(self, priorities):
+        # Takes a dictionary or list from file index to priority.
+        if type(priorities) is list:
+            priorities = dict(zip(range(len(priorities)), priorities))
+        pieces = {}
+        for index, priority in priorities.items():
+            if priority < -1:
+                raise ValueError('bad priority ' + str(priority))
+            if self.priorities[index] == priority:
+                continue
+            self.priorities[index] = priority
+            file, length = self.files[index]
+            if length == 0:
+                continue
+            # Every piece overlapping this file may change priority.
+            begin = self.begins[index]
+            for i in xrange(begin // self.piece_size, (begin + length - 1) // self.piece_size + 1):
+                pieces[i] = 1
+        pieces = pieces.keys()
+        pieces.sort()
+        for i in pieces:
+            p = self._piece_priority(i)
+            self.storagewrapper.set_skipped(i, p == -1)
+            self.picker.set_priority(i, p)
+        if pieces:
+            self.downloader.priorities_changed(pieces)
+
+    def piece_lost(self, index):
+        # A piece we had failed validation, so download it again at the priority of its files.
+        self.downloader.piece_lost(index, self._piece_priority(index))
+
+    def _piece_priority(self, piece):
+        # A piece has the highest priority of the files it overlaps.
+        # So a piece on the boundary of a skipped file is still downloaded if the other file is wanted.
+        begin = piece * self.piece_size
+        end = begin + self.piece_size
+        p = None
+        i = bisect_right(self.begins, begin) - 1
+        while i < len(self.files) and self.begins[i] < end:
+            if self.files[i][1] != 0 and self.begins[i] + self.files[i][1] > begin:
+                if p is None or self.priorities[i] > p:
+                    p = self.priorities[i]
+            i += 1
+        return p
+
+
+# everything below is for testing
+
+from sha import sha
+from fakeopen import FakeOpen
+from Storage import Storage
+from StorageWrapper import StorageWrapper
+from PiecePicker import PiecePicker
+
+class DummyDownloader:
+    def __init__(self):
+        self.changed = []
+
+    def priorities_changed(self, pieces):
+        self.changed.append(pieces)
+
+def test_skip_files():
+    files = [('a', 3), ('b', 0), ('c', 4), ('d', 1)]
+    f = FakeOpen()
+    storage = Storage(files, f.open, f.exists, f.getsize, {'c': 1})
+    sw = StorageWrapper(storage, 2, [sha('aa').digest(), sha('ac').digest(), 
+        sha('cc').digest(), sha('cd').digest()], 2, lambda: None, None)
+    picker = PiecePicker(4)
+    d = DummyDownloader()
+    fp = FilePriority(files, 2, sw, picker, d, lambda f, delay: f())
+    fp.set_priorities([0, 0, -1, 1])
+    assert d.changed == [[1, 2, 3]]
+    # Piece 1 overlaps a wanted file, and piece 3 overlaps a high priority one.
+    assert sw.do_I_have_requests(1)
+    assert not sw.do_I_have_requests(2)
+    assert picker.priorities == {2: -1, 3: 1}
+    x = f.files.keys()
+    x.sort()
+    assert x == ['a', 'b', 'd']
+    fp.set_priority(2, 0)
+    assert d.changed[-1] == [1, 2, 3]
+    assert sw.do_I_have_requests(2)
+    assert picker.priorities == {3: 1}
@@ -2,10 +2,15 @@
 # see LICENSE.txt for license information
 
 from random import randrange, shuffle, choice
+from bitfield import WORD_BITS, numwords, word_bit, bit_index
 
 class PiecePicker:
-    def __init__(self, numpieces, rarest_first_cutoff = 1):
+    def __init__(self, numpieces, rarest_first_cutoff = 1, strategy = None):
         self.rarest_first_cutoff = rarest_first_cutoff
+        # Decides what piece to download after pieces with deadlines or raised priorities.
+        if strategy is None:
+            strategy = RarestFirst()
+        self.strategy = strategy
         # The number of pieces.
         self.numpieces = numpieces
         # The availability of each piece.
@@ -15,15 +20,36 @@ class PiecePicker:
         self.pos_in_interests = range(numpieces)
         # The availability of each piece.
         self.numinterests = [0] * numpieces
-        # Any pieces that we have requested from anyone.
-        self.started = []
-        # Any pieces that we have requested from a seed.
-        self.seedstarted = []
+        # Any pieces that we have requested from anyone, as dictionary keys.
+        self.started = {}
+        # Any pieces that we have requested from a seed, as dictionary keys.
+        self.seedstarted = {}
         # The number of completed pieces.
         self.numgot = 0
         # All pieces randomly ordered.
         self.scrambled = range(numpieces)
         shuffle(self.scrambled)
+        # Maps each piece that a stream reader needs soon to the time by which it is needed.
+        self.deadlines = {}
+        # Maps each piece with a priority other than normal to that priority.
+        # Priorities above 0 are downloaded first, highest first, and -1 means skip.
+        self.priorities = {}
+        # Maps each piece with a priority above 0 to that priority, so picking them skips skipped pieces.
+        self.raised = {}
+        # The number of words in each bitset below.
+        self.numwords = numwords(numpieces)
+        # Bitsets of the pieces in each array of interests, in the format of Bitfield.words.
+        # Intersecting these with the bitfield of a peer finds the rarest pieces it has quickly.
+        all = [0L] * self.numwords
+        for i in xrange(numpieces):
+            all[i // WORD_BITS] |= word_bit(i)
+        self.interestwords = [all]
+        # Bitset of all pieces neither complete nor skipped.
+        self.wanted = all[:]
+        # Maps each piece demoted by bump to the number of bumps so far when it was bumped.
+        # Among pieces of equal availability, these are picked last, those bumped first before the others.
+        self.bumped = {}
+        self.numbumps = 0
 
     def got_have(self, piece):
         if self.numinterests[piece] is None:
@@ -33,9 +59,13 @@ class PiecePicker:
         numint = self.numinterests[piece]
         if numint == len(self.interests) - 1:
             self.interests.append([])
+            self.interestwords.append([0L] * self.numwords)
         self.numinterests[piece] += 1
+        if self.priorities.get(piece) == -1:
+            # Skipped pieces are not in interests.
+            return
         # Update interests and pos_in_interests for this piece.
-        self._shift_over(piece, self.interests[numint], self.interests[numint + 1])
+        self._shift_level(piece, numint, numint + 1)
 
     def lost_have(self, piece):
         if self.numinterests[piece] is None:
@@ -44,8 +74,20 @@ class PiecePicker:
         # Increment the availability of this piece.
         numint = self.numinterests[piece]
         self.numinterests[piece] -= 1
+        if self.priorities.get(piece) == -1:
+            # Skipped pieces are not in interests.
+            return
         # Update interests and pos_in_interests for this piece.
-        self._shift_over(piece, self.interests[numint], self.interests[numint - 1])
+        self._shift_level(piece, numint, numint - 1)
+
+    def _shift_level(self, piece, old, new):
+        # Move the piece from the old availability to the new one, at a random position.
+        self._shift_over(piece, self.interests[old], self.interests[new])
+        w = piece // WORD_BITS
+        self.interestwords[old][w] &= ~word_bit(piece)
+        self.interestwords[new][w] |= word_bit(piece)
+        if self.bumped.has_key(piece):
+            del self.bumped[piece]
 
     def _shift_over(self, piece, l1, l2):
         # Move the piece from l1 to l2, which are arrays in interests.
@@ -70,82 +112,303 @@ class PiecePicker:
             self.pos_in_interests[piece] = newp
 
     def requested(self, piece, seed = False):
-        if piece not in self.started:
-            # We have requested this piece from another client.
-            self.started.append(piece)
-        if seed and piece not in self.seedstarted:
+        # We have requested this piece from another client.
+        self.started[piece] = 1
+        if seed:
             # We have requestd this piece from a seed.
-            self.seedstarted.append(piece)
+            self.seedstarted[piece] = 1
 
     def complete(self, piece):
         assert self.numinterests[piece] is not None
         # Have one more piece.
         self.numgot += 1
-        # Remove this piece from whatever array in numinterests.
+        if self.priorities.get(piece) != -1:
+            # Remove this piece from whatever array in numinterests.
+            self._remove_interest(piece)
+        # Set numinterests element to None to signify that it's done.
+        self.numinterests[piece] = None
+        self.clear_deadline(piece)
+        self.strategy.complete(self, piece)
+        try:
+            del self.priorities[piece]
+        except KeyError:
+            pass
+        if self.raised.has_key(piece):
+            del self.raised[piece]
+        # Not requesting this piece from anyone anymore.
+        if self.started.has_key(piece):
+            del self.started[piece]
+        if self.seedstarted.has_key(piece):
+            del self.seedstarted[piece]
+
+    def lost(self, piece, availability):
+        # A piece passed to complete failed validation, so it must be downloaded again.
+        # Availability is the number of peers that have it, since complete stopped counting them.
+        if self.numinterests[piece] is not None:
+            return
+        self.numgot -= 1
+        while len(self.interests) <= availability:
+            self.interests.append([])
+            self.interestwords.append([0L] * self.numwords)
+        self.numinterests[piece] = availability
+        self._add_interest(piece)
+
+    def _remove_interest(self, piece):
+        # Remove this piece from its array in interests.
         l = self.interests[self.numinterests[piece]]
         p = self.pos_in_interests[piece]
         l[p] = l[-1]
         self.pos_in_interests[l[-1]] = p
         del l[-1]
-        # Set numinterests element to None to signify that it's done.
-        self.numinterests[piece] = None
+        w = piece // WORD_BITS
+        self.interestwords[self.numinterests[piece]][w] &= ~word_bit(piece)
+        self.wanted[w] &= ~word_bit(piece)
+        if self.bumped.has_key(piece):
+            del self.bumped[piece]
+
+    def _add_interest(self, piece):
+        # Insert this piece at a random position in its array in interests.
+        l = self.interests[self.numinterests[piece]]
+        newp = randrange(len(l) + 1)
+        if newp == len(l):
+            self.pos_in_interests[piece] = len(l)
+            l.append(piece)
+        else:
+            old = l[newp]
+            self.pos_in_interests[old] = len(l)
+            l.append(old)
+            l[newp] = piece
+            self.pos_in_interests[piece] = newp
+        w = piece // WORD_BITS
+        self.interestwords[self.numinterests[piece]][w] |= word_bit(piece)
+        self.wanted[w] |= word_bit(piece)
+
+    def set_priority(self, piece, priority):
+        # Set the priority of a piece: -1 to skip it, 0 for normal, or higher to download it first.
+        if self.numinterests[piece] is None:
+            # This piece is complete.
+            return
+        old = self.priorities.get(piece, 0)
+        if priority == old:
+            return
+        if priority == -1:
+            # Never pick this piece, so take it out of interests.
+            self._remove_interest(piece)
+        elif old == -1:
+            self._add_interest(piece)
+        if priority == 0:
+            del self.priorities[piece]
+        else:
+            self.priorities[piece] = priority
+        if priority > 0:
+            self.raised[piece] = priority
+        elif old > 0:
+            del self.raised[piece]
+
+    def set_deadline(self, piece, deadline):
+        # Download this piece ahead of all others, by the given time if possible.
+        if self.numinterests[piece] is not None:
+            self.deadlines[piece] = deadline
+
+    def clear_deadline(self, piece):
         try:
-            # Not requesting this piece from anyone anymore.
-            self.started.remove(piece)
-            self.seedstarted.remove(piece)
-        except ValueError:
+            del self.deadlines[piece]
+        except KeyError:
             pass
 
-    def next(self, havefunc, seed = False):
+    def get_urgent(self, t):
+        # Returns the pieces due by the given time, earliest deadline first.
+        r = [(d, p) for p, d in self.deadlines.items() if d <= t]
+        r.sort()
+        return [p for d, p in r]
+
+    def next(self, havefunc, seed = False, bitfield = None):
+        # If given, bitfield is the Bitfield of pieces the peer has.
+        # It is intersected with bitsets of pieces instead of calling havefunc on each piece.
+        if self.deadlines:
+            # Pieces a stream reader is waiting on come first, earliest deadline first.
+            best = None
+            bestdeadline = None
+            for i, d in self.deadlines.items():
+                if (best is None or d < bestdeadline) and havefunc(i):
+                    best = i
+                    bestdeadline = d
+            if best is not None:
+                return best
+        if self.raised:
+            # Pieces with a raised priority come next, highest priority and then rarest first.
+            best = None
+            for i, p in self.raised.items():
+                if best is None or (p, -self.numinterests[i]) > bestkey:
+                    if havefunc(i):
+                        best = i
+                        bestkey = (p, -self.numinterests[i])
+            if best is not None:
+                return best
+        return self.strategy.next(self, havefunc, seed, bitfield)
+
+    def next_in_words(self, havefunc, words, peerwords):
+        # Returns a random piece in both bitsets accepted by havefunc, or None.
+        # Bumped pieces are only returned if no other piece is accepted, the first bumped first.
+        bumped = None
+        start = randrange(max(self.numwords, 1))
+        for k in xrange(self.numwords):
+            w = (start + k) % self.numwords
+            x = words[w] & peerwords[w]
+            if not x:
+                continue
+            # Start at a random bit so that pieces are not picked in order.
+            r = randrange(WORD_BITS)
+            while x:
+                y = (x >> r) << r
+                if not y:
+                    y = x
+                bit = y & -y
+                x ^= bit
+                piece = bit_index(w, bit)
+                if self.bumped.has_key(piece):
+                    if (bumped is None or self.bumped[piece] < self.bumped[bumped]) and havefunc(piece):
+                        bumped = piece
+                elif havefunc(piece):
+                    return piece
+        return bumped
+
+    def wants(self, piece):
+        # Returns whether the piece is neither complete nor skipped.
+        return self.numinterests[piece] is not None and self.priorities.get(piece) != -1
+
+    def am_I_complete(self):
+        # Return true if we've called completed with each piece.
+        return self.numgot == self.numpieces
+
+    def bump(self, piece):
+        # Demote this piece below the others of equal availability, and below pieces bumped before it.
+        # Only recorded in bumped, so its position in its interests array doesn't move.
+        if self.numinterests[piece] is None or self.priorities.get(piece) == -1:
+            # Complete and skipped pieces are not in interests.
+            return
+        self.numbumps += 1
+        self.bumped[piece] = self.numbumps
+
+
+class RarestFirst:
+    # Picks pieces already requested from others first, then random pieces until
+    # rarest_first_cutoff pieces are complete, and then the rarest pieces.
+
+    def complete(self, picker, piece):
+        pass
+
+    def next(self, picker, havefunc, seed, bitfield):
         # The rarest pieces this peer has.
         bests = None
         # The availability of the rarest pieces this peer has.
         bestnum = 2 ** 30
         if seed:
             # Peer is a seed, so choose a pieces that we've already requested from other seeds.
-            s = self.seedstarted
+            s = picker.seedstarted
         else:
             # Choose from among pieces we've already requested from other peers.
-            s = self.started
+            s = picker.started
         for i in s:
             # Find some piece this peer has that we've already requested.
-            if havefunc(i):
-                if self.numinterests[i] < bestnum:
+            if havefunc(i) and picker.priorities.get(i) != -1:
+                if picker.numinterests[i] < bestnum:
                     # This piece is rarer than the rarest pieces found so far.
                     bests = [i]
-                    bestnum = self.numinterests[i]
-                elif self.numinterests[i] == bestnum:
+                    bestnum = picker.numinterests[i]
+                elif picker.numinterests[i] == bestnum:
                     # This piece has the same availability as the rarest pieces found so far.
                     bests.append(i)
         if bests:
             # This peer has some piece that we've already requested.
             return choice(bests)
-        if self.numgot < self.rarest_first_cutoff:
+        if picker.numgot < picker.rarest_first_cutoff:
             # Randomize requests for the first few pieces.
-            for i in self.scrambled:
-                if havefunc(i):
+            if bitfield is not None:
+                return picker.next_in_words(havefunc, picker.wanted, bitfield.words)
+            for i in picker.scrambled:
+                if havefunc(i) and picker.priorities.get(i) != -1:
                     return i
             return None
-        for i in xrange(1, min(bestnum, len(self.interests))):
+        for i in xrange(1, min(bestnum, len(picker.interests))):
             # Request one of the rarest pieces that this client has not yet requested.
-            for j in self.interests[i]:
-                if havefunc(j):
+            l = picker.interests[i]
+            if bitfield is not None and len(l) > picker.numwords:
+                # Intersecting bitsets checks fewer pieces than walking the array.
+                j = picker.next_in_words(havefunc, picker.interestwords[i], bitfield.words)
+                if j is not None:
+                    return j
+                continue
+            # Bumped pieces are picked after the others of this availability.
+            bumped = None
+            for j in l:
+                if picker.bumped.has_key(j):
+                    if (bumped is None or picker.bumped[j] < picker.bumped[bumped]) and havefunc(j):
+                        bumped = j
+                elif havefunc(j):
                     return j
+            if bumped is not None:
+                return bumped
         return None
 
-    def am_I_complete(self):
-        # Return true if we've called completed with each piece.
-        return self.numgot == self.numpieces
 
-    def bump(self, piece):
-        # Move this piece to the end of its interests array.
-        # This demotes its priority, given the append operation, and how next iterates in order.
-        l = self.interests[self.numinterests[piece]]
-        pos = self.pos_in_interests[piece]
-        del l[pos]
-        l.append(piece)
-        for i in range(pos,len(l)):
-            self.pos_in_interests[l[i]] = i
+class Sequential:
+    # Picks the first piece the peer has, such as when mirroring an archive.
+
+    def __init__(self):
+        # No pieces before this one are wanted.
+        self.first = 0
+
+    def complete(self, picker, piece):
+        pass
+
+    def next(self, picker, havefunc, seed, bitfield):
+        if bitfield is not None:
+            for w in xrange(picker.numwords):
+                x = picker.wanted[w] & bitfield.words[w]
+                while x:
+                    # The highest bit is the first piece in the word.
+                    bit = 1L << (x.bit_length() - 1)
+                    x ^= bit
+                    piece = bit_index(w, bit)
+                    if havefunc(piece):
+                        return piece
+            return None
+        while self.first < picker.numpieces and picker.numinterests[self.first] is None:
+            self.first += 1
+        for i in xrange(self.first, picker.numpieces):
+            if picker.wants(i) and havefunc(i):
+                return i
+        return None
+
+
+class CachedFirst(RarestFirst):
+    # Picks pieces next to the most recently completed pieces first.
+    # How recently a piece was written only approximates whether it is still in the page cache,
+    # which this doesn't check, so under memory pressure its neighbours may already be evicted.
+    # Otherwise picks pieces like RarestFirst.
+
+    def __init__(self, recent = 16):
+        # The number of completed pieces to remember.
+        self.recent_max = recent
+        # The most recently completed pieces, most recent last.
+        self.recent = []
+
+    def complete(self, picker, piece):
+        self.recent.append(piece)
+        if len(self.recent) > self.recent_max:
+            del self.recent[0]
+
+    def next(self, picker, havefunc, seed, bitfield):
+        for k in xrange(len(self.recent) - 1, -1, -1):
+            p = self.recent[k]
+            for i in (p + 1, p - 1):
+                if 0 <= i < picker.numpieces and picker.wants(i) and havefunc(i):
+                    return i
+        return RarestFirst.next(self, picker, havefunc, seed, bitfield)
+
+# Maps the names of the piece picking strategies to their classes.
+strategies = {'rarest': RarestFirst, 'sequential': Sequential, 'cached': CachedFirst}
 
 
 def test_requested():
@@ -207,9 +470,154 @@ def test_rarer_in_started_takes_priority():
     p.got_have(0)
     assert _pull(p) == [1, 0]
 
+def test_deadlines_first():
+    p = PiecePicker(4)
+    p.got_have(0)
+    p.got_have(1)
+    p.got_have(1)
+    p.got_have(2)
+    p.got_have(3)
+    p.requested(0)
+    p.set_deadline(3, 20)
+    p.set_deadline(2, 10)
+    assert p.get_urgent(15) == [2]
+    assert p.get_urgent(30) == [2, 3]
+    assert _pull(p)[:3] == [2, 3, 0]
+    p.complete(2)
+    assert p.get_urgent(30) == [3]
+    p.clear_deadline(3)
+    assert p.get_urgent(30) == []
+
+def test_priorities():
+    p = PiecePicker(5)
+    for i in xrange(5):
+        p.got_have(i)
+    p.got_have(0)
+    p.set_priority(1, -1)
+    p.set_priority(3, -1)
+    p.set_priority(2, 1)
+    p.set_priority(4, 2)
+    p.got_have(3)
+    p.lost_have(3)
+    v = _pull(p)
+    assert v == [4, 2, 0]
+    p.set_priority(3, 0)
+    p.set_priority(4, 0)
+    assert p.priorities == {1: -1, 2: 1}
+    # Only raised priorities are looked at before the strategy picks.
+    assert p.raised == {2: 1}
+    p.complete(1)
+    assert p.priorities == {2: 1}
+    v = _pull(p)
+    assert v == [2, 3, 4, 0] or v == [2, 4, 3, 0]
+
+def test_lost():
+    p = PiecePicker(3)
+    for i in xrange(3):
+        p.got_have(i)
+    p.complete(1)
+    p.complete(2)
+    p.lost(1, 2)
+    assert not p.am_I_complete() and p.numgot == 1
+    assert p.interests[2] == [1]
+    assert p.next(lambda i: i == 1) == 1
+    # Completing it again works as before.
+    p.complete(1)
+    assert p.numgot == 2
+
+def test_bump():
+    p = PiecePicker(4)
+    for i in xrange(4):
+        p.got_have(i)
+    p.numgot = 1
+    p.bump(1)
+    p.bump(0)
+    # Pieces bumped are picked last, the first bumped first.
+    for b in [None, Bitfield(4, chr(0xF0))]:
+        l = [0, 1, 2, 3]
+        order = []
+        while l:
+            i = p.next(lambda i, l = l: i in l, False, b)
+            l.remove(i)
+            order.append(i)
+        assert order[2:] == [1, 0]
+    # Changing its availability forgets a piece was bumped.
+    p.got_have(1)
+    assert p.bumped == {0: 2}
+    p.requested(2, True)
+    p.requested(2)
+    p.complete(2)
+    assert p.started == {}
+    assert p.seedstarted == {}
+
+def test_next_in_bitfield():
+    p = PiecePicker(3000)
+    for i in xrange(3000):
+        p.got_have(i)
+        p.got_have(i)
+    for i in [5, 2000, 2100, 2200, 2300]:
+        p.lost_have(i)
+    p.complete(2500)
+    b = Bitfield(3000)
+    for i in [5, 6, 2000, 2100, 2500, 2999]:
+        b[i] = 1
+    r = []
+    def want(i, r = r, b = b):
+        r.append(i)
+        return b[i] and i != 2000
+    # Pieces 5 and 2100 are the rarest pieces wanted, and piece 2000 is rejected.
+    assert p.next(want, False, b) in [5, 2100]
+    assert 6 not in r and 2500 not in r
+    # Bumped pieces are picked last among the rarest.
+    p.bump(5)
+    p.bump(2100)
+    assert p.next(lambda i, b = b: b[i], False, b) == 2000
+    assert p.next(lambda i, b = b: b[i] and i != 2000, False, b) in [5, 2100]
+    for i in [5, 2000, 2100]:
+        p.got_have(i)
+    assert p.next(lambda i, b = b: b[i], False, b) in [5, 6, 2000, 2100, 2999]
+    for i in [6, 2000, 2100, 2999]:
+        p.set_priority(i, -1)
+    assert p.next(lambda i, b = b: b[i], False, b) == 5
+    p = PiecePicker(3000, 2)
+    for i in xrange(3000):
+        p.got_have(i)
+    b = Bitfield(3000)
+    b[1234] = 1
+    assert p.next(lambda i, b = b: b[i], False, b) == 1234
+
+def test_sequential():
+    p = PiecePicker(2100, 1, Sequential())
+    for i in xrange(2100):
+        p.got_have(i)
+    p.complete(0)
+    p.complete(3)
+    p.set_priority(1, -1)
+    assert _pull(p)[:3] == [2, 4, 5]
+    b = Bitfield(2100)
+    for i in [1, 2, 1500, 2050]:
+        b[i] = 1
+    assert p.next(lambda i, b = b: b[i], False, b) == 2
+    assert p.next(lambda i: i != 2, False, b) == 1500
+
+def test_cached_first():
+    p = PiecePicker(10, 1, CachedFirst(2))
+    for i in xrange(10):
+        p.got_have(i)
+    p.got_have(3)
+    p.complete(7)
+    p.complete(8)
+    p.complete(1)
+    # Next to piece 1, and then next to piece 8; piece 7 is forgotten.
+    # The rest are picked rarest first.
+    assert _pull(p)[:3] == [2, 0, 9]
+    assert _pull(p)[-1] == 3
+
 def test_zero():
     assert _pull(PiecePicker(0)) == []
 
+from bitfield import Bitfield
+
 def _pull(pp):
     r = []
     def want(p, r = r):
@@ -5,7 +5,7 @@ from bisect import insort
 import socket
 from cStringIO import StringIO
 from traceback import print_exc
-from errno import EWOULDBLOCK, ENOBUFS
+from errno import EWOULDBLOCK, ENOBUFS, EAGAIN
 try:
     from select import poll, error, POLLIN, POLLOUT, POLLERR, POLLHUP
     timemult = 1000
@@ -15,10 +15,9 @@ except ImportError:
 from threading import Thread, Event
 from time import time, sleep
 import sys
+from os import pipe, read, write, close
 from random import randrange
 
-all = POLLIN | POLLOUT
-
 class SingleSocket:
     def __init__(self, raw_server, sock, handler):
         # The RawServer instance.
@@ -90,12 +89,8 @@ class SingleSocket:
                     # Error is not because the socket buffer is full.
                     self.raw_server.dead_from_write.append(self)
                     return
-        if self.buffer == []:
-            # No more data to write, so only register FD for reading.
-            self.raw_server.poll.register(self.socket, POLLIN)
-        else:
-            # Still data to write, so register FD for reading and writing.
-            self.raw_server.poll.register(self.socket, all)
+        # Register FD for reading, and for writing if there is still data to write.
+        self.raw_server._register(self)
 
 
 def default_error_handler(x):
@@ -124,15 +119,40 @@ class RawServer:
         self.errorfunc = errorfunc
         # The maximum connections to maintain; any new connections are closed after this.
         self.maxconnects = maxconnects
+        # Whether reading from peer sockets is paused, such as to cap the download rate.
+        self.reading_paused = False
         # Scheduled tasks consisting of (time, func) pairs.
         self.funcs = []
         # Unscheduled tasks consisting of (func, delay) pairs.
         self.unscheduled_tasks = []
+        # A pipe other threads write to so that polling returns and runs the tasks they added.
+        # Windows can only poll sockets, so there such tasks wait for the next scheduled task.
+        self.wakeup = None
+        if sys.platform != 'win32':
+            from fcntl import fcntl, F_GETFL, F_SETFL
+            from os import O_NONBLOCK
+            self.wakeup = pipe()
+            # Writing to a full pipe or reading an empty one returns at once instead of blocking.
+            for fd in self.wakeup:
+                fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | O_NONBLOCK)
+            self.poll.register(self.wakeup[0], POLLIN)
         self.add_task(self.scan_for_timeouts, timeout_check_interval)
 
     def add_task(self, func, delay):
         self.unscheduled_tasks.append((func, delay))
 
+    def external_add_task(self, func, delay):
+        # Like add_task, but may be called from other threads, and runs func without waiting on polling.
+        # Always write a byte, since the reactor loop may be draining the pipe right now.
+        self.add_task(func, delay)
+        w = self.wakeup
+        if w is not None:
+            try:
+                write(w[1], 'x')
+            except OSError:
+                # The pipe is full, so polling returns anyway, or the reactor loop already exited.
+                pass
+
     def scan_for_timeouts(self):
         # Run this function again after timeout_check_interval seconds.
         self.add_task(self.scan_for_timeouts, self.timeout_check_interval)
@@ -182,7 +202,7 @@ class RawServer:
         except Exception, e:
             raise socket.error(str(e))
         # Reading data will finish establishing the connection.
-        self.poll.register(sock, POLLIN)
+        self.poll.register(sock, self._read_mask())
         # Map from the socket FD to a SingleSocket instance containing it.
         s = SingleSocket(self, sock, handler)
         self.single_sockets[sock.fileno()] = s
@@ -191,7 +211,10 @@ class RawServer:
         
     def handle_events(self, events):
         for sock, event in events:
-            if sock == self.server.fileno():
+            if self.wakeup is not None and sock == self.wakeup[0]:
+                # Another thread added tasks, which run on the next iteration of the loop.
+                self._drain_wakeup()
+            elif sock == self.server.fileno():
                 # This is the socket we're listening for new connections on.
                 if event & (POLLHUP | POLLERR) != 0:
                     # There was an error listening.
@@ -213,7 +236,7 @@ class RawServer:
                         nss = SingleSocket(self, newsock, self.handler)
                         self.single_sockets[newsock.fileno()] = nss
                         # Register the new connection with the polling implementation.
-                        self.poll.register(newsock, POLLIN)
+                        self.poll.register(newsock, self._read_mask())
                         # Notify the Connection object from Encrypter.
                         self.handler.external_connection_made(nss)
                     except socket.error:
@@ -254,6 +277,37 @@ class RawServer:
                         # Flushed the connection, notify the Connection object from Encrypter.
                         s.handler.connection_flushed(s)
 
+    def _read_mask(self):
+        # The events to poll peer sockets for so that we read from them.
+        if self.reading_paused:
+            return 0
+        return POLLIN
+
+    def _register(self, s):
+        if s.is_flushed():
+            # No more data to write, so only register FD for reading.
+            self.poll.register(s.socket, self._read_mask())
+        else:
+            # Still data to write, so register FD for reading and writing.
+            self.poll.register(s.socket, self._read_mask() | POLLOUT)
+
+    def pause_reading(self):
+        # Stop polling peer sockets for incoming data. The kernel buffers what peers send,
+        # and TCP flow control then slows the peers down, so no data is dropped.
+        if not self.reading_paused:
+            self.reading_paused = True
+            for s in self.single_sockets.values():
+                if s.socket is not None:
+                    self._register(s)
+
+    def resume_reading(self):
+        # Resume polling peer sockets for incoming data.
+        if self.reading_paused:
+            self.reading_paused = False
+            for s in self.single_sockets.values():
+                if s.socket is not None:
+                    self._register(s)
+
     def pop_unscheduled(self):
         try:
             # Schedule each unscheduled task.
@@ -331,6 +385,24 @@ class RawServer:
                 ss.close()
             # Close the socket that listens for incoming connections.
             self.server.close()
+            if self.wakeup is not None:
+                # Stop other threads writing to the pipe before closing it.
+                w = self.wakeup
+                self.wakeup = None
+                self.poll.unregister(w[0])
+                close(w[0])
+                close(w[1])
+
+    def _drain_wakeup(self):
+        # Read every byte written to the pipe, so polling waits again until the next is written.
+        while True:
+            try:
+                if len(read(self.wakeup[0], 4096)) < 4096:
+                    return
+            except OSError, e:
+                if e.errno == EAGAIN:
+                    return
+                raise
 
     def _close_dead(self):
         # Close each dead socket.
@@ -704,3 +776,83 @@ def test_does_not_close_if_hit():
     finally:
         fa.set()
         fb.set()
+
+def test_pause_reading():
+    try:
+        fa = Event()
+        fb = Event()
+        da = DummyHandler()
+        sa = RawServer(fa, 100, 100)
+        loop(sa)
+        sl(sa, da, beginport + 16)
+        db = DummyHandler()
+        sb = RawServer(fb, 100, 100)
+        loop(sb)
+        sl(sb, db, beginport + 17)
+
+        sleep(.5)
+        ca = sa.start_connection(('127.0.0.1', beginport + 17))
+        sleep(1)
+
+        assert len(db.external_made) == 1
+        cb = db.external_made[0]
+        del db.external_made[:]
+
+        sb.pause_reading()
+        sleep(.5)
+        ca.write('aaa')
+        sleep(1)
+        assert db.data_in == []
+        # Writing still works while reading is paused.
+        cb.write('bbb')
+        sleep(1)
+        assert da.data_in == [(ca, 'bbb')]
+
+        sb.resume_reading()
+        sleep(1)
+        assert db.data_in == [(cb, 'aaa')]
+        assert db.lost == []
+    finally:
+        fa.set()
+        fb.set()
+
+def test_external_add_task():
+    l = []
+    f = Event()
+    s = RawServer(f, 100, 100)
+    sl(s, DummyHandler(), beginport + 20)
+    sleep(.5)
+    # Without waking up, polling would sleep until the timeout check in 100 seconds.
+    Thread(target = lambda s = s, l = l: s.external_add_task(lambda l = l: l.append('a'), 0)).start()
+    sleep(1)
+    assert l == ['a']
+    f.set()
+    s.external_add_task(lambda: None, 0)
+
+def test_wakeup_while_draining():
+    import RawServer as module
+    from select import select
+    s = RawServer(Event(), 100, 100)
+    l = []
+    old = module.read
+    def read(fd, n, s = s, l = l, old = old):
+        # Another thread adds a task while the reactor loop is draining the pipe.
+        if not l:
+            s.external_add_task(lambda l = l: l.append('b'), 0)
+            l.append('a')
+        return old(fd, n)
+    module.read = read
+    try:
+        s.external_add_task(lambda: None, 0)
+        s.handle_events([(s.wakeup[0], POLLIN)])
+    finally:
+        module.read = old
+    assert l == ['a']
+    # The task added while draining is still scheduled.
+    assert len(s.unscheduled_tasks) == 3
+    # The pipe is empty, and a later task still wakes up polling.
+    assert select([s.wakeup[0]], [], [], 0)[0] == []
+    s.external_add_task(lambda: None, 0)
+    assert select([s.wakeup[0]], [], [], 0)[0] == [s.wakeup[0]]
+    close(s.wakeup[0])
+    close(s.wakeup[1])
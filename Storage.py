@@ -3,10 +3,201 @@
 
 from sha import sha
 from bisect import bisect_right
+from array import array
+from threading import RLock
+from mmap import mmap, ACCESS_READ, ACCESS_WRITE, error as mmap_error
+from os import strerror
+from sys import platform
+import __builtin__
+try:
+    from os import pread, pwrite
+except ImportError:
+    pread = None
+    pwrite = None
+    # Python 2 lacks them, so call the C library's directly where it has them.
+    try:
+        from ctypes import CDLL, c_int, c_longlong, c_size_t, c_ssize_t, c_char_p, c_void_p, \
+            create_string_buffer, get_errno
+        from ctypes.util import find_library
+        libc = CDLL(find_library('c'), use_errno = True)
+        # Prefer the versions taking 64-bit offsets on 32-bit systems.
+        _pread = getattr(libc, 'pread64', None) or getattr(libc, 'pread', None)
+        _pwrite = getattr(libc, 'pwrite64', None) or getattr(libc, 'pwrite', None)
+    except (ImportError, OSError, TypeError):
+        _pread = _pwrite = None
+    if _pread is not None and _pwrite is not None:
+        _pread.argtypes = [c_int, c_void_p, c_size_t, c_longlong]
+        _pread.restype = c_ssize_t
+        _pwrite.argtypes = [c_int, c_char_p, c_size_t, c_longlong]
+        _pwrite.restype = c_ssize_t
 
-class Storage:
-    def __init__(self, files, open, exists, getsize):
+        def pread(fd, amount, pos):
+            # Like os.pread. Calls into the C library release the interpreter lock.
+            buf = create_string_buffer(amount)
+            n = _pread(fd, buf, amount, pos)
+            if n < 0:
+                e = get_errno()
+                raise OSError(e, strerror(e))
+            return buf.raw[:n]
+
+        def pwrite(fd, s, pos):
+            # Like os.pwrite.
+            n = _pwrite(fd, s, len(s), pos)
+            if n < 0:
+                e = get_errno()
+                raise OSError(e, strerror(e))
+            return n
+    # Otherwise reads and writes seek on the shared handles instead, one thread at a time.
+try:
+    from os import posix_fadvise, POSIX_FADV_NORMAL, POSIX_FADV_SEQUENTIAL, \
+        POSIX_FADV_WILLNEED, POSIX_FADV_DONTNEED, POSIX_FADV_NOREUSE
+    # Maps the hints advise takes to their posix_fadvise values.
+    advice = {'normal': POSIX_FADV_NORMAL, 'sequential': POSIX_FADV_SEQUENTIAL,
+        'willneed': POSIX_FADV_WILLNEED, 'dontneed': POSIX_FADV_DONTNEED,
+        'noreuse': POSIX_FADV_NOREUSE}
+except ImportError:
+    # Hints are ignored.
+    posix_fadvise = None
+    advice = {}
+    # Python 2 lacks it, so call the C library's directly on Linux, whose hint values these are.
+    if platform.startswith('linux'):
+        try:
+            from ctypes import CDLL, c_int, c_longlong
+            from ctypes.util import find_library
+            libc = CDLL(find_library('c'))
+            # Prefer the version taking 64-bit offsets on 32-bit systems.
+            _fadvise = getattr(libc, 'posix_fadvise64', None) or getattr(libc, 'posix_fadvise', None)
+        except (ImportError, OSError, TypeError):
+            _fadvise = None
+        if _fadvise is not None:
+            _fadvise.argtypes = [c_int, c_longlong, c_longlong, c_int]
+            _fadvise.restype = c_int
+
+            def posix_fadvise(fd, pos, amount, hint):
+                # Like os.posix_fadvise. The C function returns the error instead of setting errno.
+                e = _fadvise(fd, pos, amount, hint)
+                if e:
+                    raise OSError(e, strerror(e))
+
+            advice = {'normal': 0, 'sequential': 2, 'willneed': 3, 'dontneed': 4, 'noreuse': 5}
+
+class HandlePool:
+    """Limits the files open at once across all Storage instances, closing the least recently used."""
+
+    def __init__(self, max_open = 50):
+        # The most files to keep open at once.
+        self.max_open = max_open
+        # Maps each (storage, filename) pair with an open handle to when it was last used.
+        self.used = {}
+        # Incremented on each use, so that the least recently used handle has the smallest value.
+        self.clock = 0
+        # The number of times a handle was already open, and had to be opened.
+        self.hits = 0
+        self.misses = 0
+        # Held while using or closing handles, so that disk worker threads can share them.
+        self.lock = RLock()
+
+    def touch(self, storage, file):
+        # Record that the handle of the given file was used.
+        self.clock += 1
+        self.used[(storage, file)] = self.clock
+        self.hits += 1
+
+    def opened(self, storage, file):
+        # Record that the given file was opened, closing the least recently used handles if over the limit.
+        self.clock += 1
+        self.used[(storage, file)] = self.clock
+        self.misses += 1
+        while len(self.used) > max(self.max_open, 1):
+            oldest = None
+            for key, t in self.used.items():
+                if oldest is None or t < self.used[oldest]:
+                    oldest = key
+            del self.used[oldest]
+            oldest[0]._close_handle(oldest[1])
+
+    def closed(self, storage, file):
+        # Record that the given file was closed by its Storage.
+        if self.used.has_key((storage, file)):
+            del self.used[(storage, file)]
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'open': len(self.used)}
+
+# The pool shared by all Storage instances in this process.
+handle_pool = HandlePool()
+
+
+class StorageBackend:
+    """The interface StorageWrapper reads and writes the bytes of a torrent through, as one range of
+    total_length bytes. Storage keeps them in the torrent's files, MmapStorage maps those files into
+    memory, MemoryStorage keeps them in memory only, and BlobStorage keeps them in a single file.
+
+    Subclasses set total_length and define read(pos, amount), which returns amount bytes starting at
+    pos, or fewer if the end was never written, and write(pos, s). Both might raise an IOError.
+    The methods below default to a backend that had no data at startup and keeps nothing that must be
+    flushed or closed."""
+
+    # The total bytes to download and save.
+    total_length = 0
+    # The piece size given to set_piece_size, or None until then.
+    piece_size = None
+
+    def get_total_length(self):
+        return self.total_length
+
+    def was_preallocated(self, pos, length):
+        # Whether all of the given bytes existed at startup, so must be hashed to tell what they hold.
+        return False
+
+    def set_piece_size(self, piece_size):
+        # Called by StorageWrapper before was_piece_preallocated.
+        self.piece_size = piece_size
+
+    def was_piece_preallocated(self, index):
+        begin = index * self.piece_size
+        return self.was_preallocated(begin, min(self.piece_size, self.total_length - begin))
+
+    def advise(self, pos, amount, hint):
+        # Hints how the given bytes will be read, as described in Storage.advise.
+        pass
+
+    def set_readonly(self):
+        # Called once every piece is downloaded and validated.
+        pass
+
+    def flush(self):
+        # Write anything buffered to disk.
+        pass
+
+    def close(self):
+        pass
+
+    def get_fingerprints(self):
+        # Returns a list describing the state of the data, saved with fast-resume state.
+        return []
+
+    def get_changed_ranges(self, fingerprints):
+        # Returns the (first byte offset, end byte offset) ranges that may have changed since
+        # get_fingerprints returned the given list.
+        return [(0, self.total_length)]
+
+
+class Storage(StorageBackend):
+    # Whether to read and write at an offset without seeking, so threads can use a handle at once.
+    positional = pread is not None
+
+    def __init__(self, files, open, exists, getsize, skip = {}, getmtime = None, pool = None,
+            fadvise = True):
         # can raise IOError and ValueError
+        # skip maps the name of each file not to create or open until it is written to.
+        self.open = open
+        self.exists = exists
+        self.getsize = getsize
+        # Returns the modification time of a file, if given.
+        self.getmtime = getmtime
+        # The (file, length) pairs.
+        self.files = files
         # Contains an array of (first byte offset, end byte offset, filename) tuples.
         self.ranges = []
         total = 0l
@@ -20,36 +211,60 @@ class Storage:
                     if l > length:
                         l = length
                     so_far += l
-            elif not exists(file):
+            elif not exists(file) and not skip.has_key(file):
                 open(file, 'wb').close()
         # The first byte offset for each filename.
         self.begins = [i[0] for i in self.ranges]
         # The total bytes to download and save.
         self.total_length = total
-        # Maps each filename to its file handle.
+        # For each piece, the index in ranges of the first file it overlaps, and a last entry
+        # of the index of the last file, so _intervals only searches the files of one piece.
+        self.piece_ranges = array('i')
+        # Whether each piece was preallocated, as was_preallocated would return for it.
+        self.preallocated = array('b')
+        # Reading and writing at an offset needs the descriptors of files from the built-in open,
+        # which the fake files of tests don't have.
+        self.positional = self.positional and open is __builtin__.open
+        # Whether advise tells the kernel how files will be read, so it can manage the page cache.
+        self.fadvise = fadvise and posix_fadvise is not None and open is __builtin__.open
+        # Limits how many files are open at once.
+        if pool is None:
+            pool = handle_pool
+        self.pool = pool
+        # Maps each open filename to its file handle. Files are opened on first use.
         self.handles = {}
-        # Maps a filename to 1 if it is opened for writing.
+        # Maps each handle that threads are reading or writing without the lock to how many are.
+        self.busy = {}
+        # Handles closed while busy, which are closed once no thread is using them.
+        self.closing = {}
+        # Maps a filename to 1 if it must be opened for writing.
         self.whandles = {}
         # Maps a filename to its existing size upon startup.
         self.tops = {}
+        # Maps each filename to its length in the torrent.
+        self.lengths = {}
         for file, length in files:
-            if exists(file):
+            self.lengths[file] = length
+            if skip.has_key(file):
+                # Skipped files are only created or truncated once written to.
+                if exists(file):
+                    self.tops[file] = getsize(file)
+                self.whandles[file] = 1
+            elif exists(file):
                 # Will append to the existing file.
                 l = getsize(file)
                 if l != length:
-                    # Not the correct size; open in append and binary mode for writing.
-                    self.handles[file] = open(file, 'rb+')
+                    # Not the correct size, so it will be opened for writing.
                     self.whandles[file] = 1
                     if l > length:
-                        self.handles[file].truncate(length)
-                else:
-                    # Already the correct size; open in read and binary mode.
-                    self.handles[file] = open(file, 'rb')
+                        h = open(file, 'rb+')
+                        h.truncate(length)
+                        h.close()
                 # Although it may have been truncated, the file existed with this size.
                 self.tops[file] = l
             else:
-                # File does not exist; open in append and binary mode while clobbering.
-                self.handles[file] = open(file, 'wb+')
+                # File does not exist; create it, and open it for writing later.
+                open(file, 'wb+').close()
                 self.whandles[file] = 1
 
     def was_preallocated(self, pos, length):
@@ -59,14 +274,60 @@ class Storage:
                 return False
         return True
 
+    def set_piece_size(self, piece_size):
+        # Index the files each piece overlaps and whether it was preallocated, in one pass over both.
+        numpieces = (self.total_length + piece_size - 1) // piece_size
+        self.piece_ranges = array('i', [0]) * (numpieces + 1)
+        self.preallocated = array('b', [1]) * numpieces
+        if numpieces == 0:
+            self.piece_size = piece_size
+            return
+        p = 0
+        for i in xrange(numpieces):
+            while self.ranges[p][1] <= i * piece_size:
+                p += 1
+            self.piece_ranges[i] = p
+        self.piece_ranges[numpieces] = len(self.ranges) - 1
+        for begin, end, file in self.ranges:
+            top = begin + self.tops.get(file, 0)
+            if top < end:
+                # Each piece ending after the existing bytes of this file was not preallocated.
+                for i in xrange(top // piece_size, (end - 1) // piece_size + 1):
+                    self.preallocated[i] = 0
+        self.piece_size = piece_size
+
+    def was_piece_preallocated(self, index):
+        # Like was_preallocated for the given piece, once set_piece_size is called.
+        return self.preallocated[index]
+
+    def advise(self, pos, amount, hint):
+        # Tell the kernel how the given byte range will be read, one of the hints in advice.
+        # Only a hint, so errors are ignored.
+        if not self.fadvise:
+            return
+        self.pool.lock.acquire()
+        try:
+            for file, begin, end in self._intervals(pos, amount):
+                try:
+                    h = self._get_handle(file, False)
+                    posix_fadvise(h.fileno(), begin, end - begin, advice[hint])
+                except (IOError, OSError):
+                    pass
+        finally:
+            self.pool.lock.release()
+
     def set_readonly(self):
         # may raise IOError or OSError
-        for file in self.whandles.keys():
-            old = self.handles[file]
-            old.flush()
-            old.close()
-            # Open in read and binary mode.
-            self.handles[file] = open(file, 'rb')
+        self.pool.lock.acquire()
+        try:
+            for file in self.whandles.keys():
+                # Close the file, so it is opened in read and binary mode on next use.
+                if self.handles.has_key(file):
+                    self._close_handle(file)
+                    self.pool.closed(self, file)
+            self.whandles = {}
+        finally:
+            self.pool.lock.release()
 
     def get_total_length(self):
         return self.total_length
@@ -77,7 +338,12 @@ class Storage:
         r = []
         # The end byte offset.
         stop = pos + amount
-        p = bisect_right(self.begins, pos) - 1
+        if self.piece_size is None or pos >= self.total_length:
+            p = bisect_right(self.begins, pos) - 1
+        else:
+            # Only search the files overlapping the piece containing pos.
+            i = pos // self.piece_size
+            p = bisect_right(self.begins, pos, self.piece_ranges[i], self.piece_ranges[i + 1] + 1) - 1
         # self.ranges[p] < stop is also begins[p] < stop
         while p < len(self.ranges) and self.ranges[p][0] < stop:
             begin, end, file = self.ranges[p]
@@ -85,32 +351,309 @@ class Storage:
             p += 1
         return r
 
+    def _get_handle(self, file, write):
+        # Returns the handle for the given file, opening it if it was never opened or was closed by the pool.
+        if write and not self.whandles.has_key(file):
+            self.whandles[file] = 1
+            if self.handles.has_key(file):
+                # This file was only open for reading; reopen it in append and binary mode.
+                self._close_handle(file)
+                self.pool.closed(self, file)
+        if self.handles.has_key(file):
+            self.pool.touch(self, file)
+            return self.handles[file]
+        if not self.exists(file):
+            # A skipped file written to for the first time.
+            h = self.open(file, 'wb+')
+        elif self.whandles.has_key(file):
+            h = self.open(file, 'rb+')
+            if self.getsize(file) > self.lengths[file]:
+                # A skipped file that is longer than in the torrent.
+                h.truncate(self.lengths[file])
+        else:
+            h = self.open(file, 'rb')
+        self.handles[file] = h
+        self.pool.opened(self, file)
+        return h
+
+    def _close_handle(self, file):
+        # Close the handle for the given file, flushing any data written.
+        h = self.handles[file]
+        del self.handles[file]
+        if self.busy.has_key(h):
+            # Another thread is reading or writing it, so close it once that finishes.
+            self.closing[h] = 1
+        else:
+            h.close()
+
+    def _pin(self, intervals, write):
+        # Returns the handle for each of the given file ranges, which stays open until _unpin.
+        hs = []
+        self.pool.lock.acquire()
+        try:
+            try:
+                for file, begin, end in intervals:
+                    h = self._get_handle(file, write)
+                    self.busy[h] = self.busy.get(h, 0) + 1
+                    hs.append(h)
+            except:
+                self._unpin(hs)
+                raise
+        finally:
+            self.pool.lock.release()
+        return hs
+
+    def _unpin(self, hs):
+        self.pool.lock.acquire()
+        try:
+            for h in hs:
+                self.busy[h] -= 1
+                if self.busy[h] == 0:
+                    del self.busy[h]
+                    if self.closing.has_key(h):
+                        del self.closing[h]
+                        h.close()
+        finally:
+            self.pool.lock.release()
+
     def read(self, pos, amount):
+        if self.positional:
+            return self._pread(pos, amount)
+        self.pool.lock.acquire()
+        try:
+            return self._read(pos, amount)
+        finally:
+            self.pool.lock.release()
+
+    def _pread(self, pos, amount):
+        # Only opening the handles is locked; reading at an offset leaves their positions alone.
+        intervals = self._intervals(pos, amount)
+        hs = self._pin(intervals, False)
+        try:
+            r = []
+            for i in xrange(len(intervals)):
+                file, begin, end = intervals[i]
+                r.append(pread(hs[i].fileno(), end - begin, begin))
+        finally:
+            self._unpin(hs)
+        if len(r) == 1:
+            # The block is within one file, so don't copy it again.
+            return r[0]
+        return ''.join(r)
+
+    def _read(self, pos, amount):
         # Concatenate the contents of the returned file ranges.
         r = []
         for file, pos, end in self._intervals(pos, amount):
-            h = self.handles[file]
+            h = self._get_handle(file, False)
             h.seek(pos)
             r.append(h.read(end - pos))
         return ''.join(r)
 
     def write(self, pos, s):
         # might raise an IOError
+        if self.positional:
+            self._pwrite(pos, s)
+            return
+        self.pool.lock.acquire()
+        try:
+            self._write(pos, s)
+        finally:
+            self.pool.lock.release()
+
+    def _write(self, pos, s):
         total = 0
         for file, begin, end in self._intervals(pos, len(s)):
-            if not self.whandles.has_key(file):
-                # This file was only open for reading; open in append and binary mode.
-                self.handles[file].close()
-                self.handles[file] = open(file, 'rb+')
-                self.whandles[file] = 1
-            h = self.handles[file]
+            h = self._get_handle(file, True)
             # May skip some bytes on the first file. For subsequent files begin = 0.
             h.seek(begin)
             h.write(s[total: total + end - begin])
             total += end - begin
 
+    def _pwrite(self, pos, s):
+        intervals = self._intervals(pos, len(s))
+        hs = self._pin(intervals, True)
+        try:
+            total = 0
+            for i in xrange(len(intervals)):
+                file, begin, end = intervals[i]
+                fd = hs[i].fileno()
+                while begin < end:
+                    # May write fewer bytes than given, so write the rest after them.
+                    n = pwrite(fd, s[total: total + end - begin], begin)
+                    begin += n
+                    total += n
+        finally:
+            self._unpin(hs)
+
     def close(self):
-        for h in self.handles.values():
+        self.pool.lock.acquire()
+        try:
+            for file in self.handles.keys():
+                self._close_handle(file)
+                self.pool.closed(self, file)
+        finally:
+            self.pool.lock.release()
+
+    def flush(self):
+        # might raise an IOError
+        self.pool.lock.acquire()
+        try:
+            for file in self.whandles.keys():
+                if self.handles.has_key(file):
+                    self.handles[file].flush()
+        finally:
+            self.pool.lock.release()
+
+    def get_fingerprints(self):
+        # Returns a [size, mtime] list for each file, or an empty list if it does not exist.
+        # Compared with get_changed_ranges to tell which files changed since the data was saved.
+        r = []
+        for file, length in self.files:
+            if not self.exists(file):
+                r.append([])
+            elif self.getmtime is None:
+                r.append([self.getsize(file)])
+            else:
+                r.append([self.getsize(file), int(self.getmtime(file))])
+        return r
+
+    def get_changed_ranges(self, fingerprints):
+        # Returns the (first byte offset, end byte offset) of each file whose fingerprint
+        # differs from the given one returned earlier by get_fingerprints.
+        if len(fingerprints) != len(self.files):
+            return [(0, self.total_length)]
+        r = []
+        total = 0
+        now = self.get_fingerprints()
+        for i in xrange(len(self.files)):
+            length = self.files[i][1]
+            if length != 0 and now[i] != fingerprints[i]:
+                r.append((total, total + length))
+            total += length
+        return r
+
+
+class MmapStorage(Storage):
+    """Storage that maps each file into memory, so reads and writes are copies to and from the mapping
+    instead of a seek and a system call on a file handle."""
+
+    # Mappings are read and written with the lock held.
+    positional = False
+
+    def __init__(self, files, open, exists, getsize, skip = {}, getmtime = None, pool = None,
+            fadvise = True):
+        Storage.__init__(self, files, open, exists, getsize, skip, getmtime, pool, fadvise)
+        # Maps each filename to its memory map, created on first use.
+        self.maps = {}
+        # Maps a filename to 1 if its memory map is writable.
+        self.wmaps = {}
+
+    def _get_map(self, file, write):
+        # Returns the memory map of the given file, remapping it if it must become writable.
+        if self.maps.has_key(file) and (self.wmaps.has_key(file) or not write):
+            return self.maps[file]
+        try:
+            return self._map(file, write)
+        except mmap_error, e:
+            # Callers only expect an IOError.
+            raise IOError(str(e))
+
+    def _map(self, file, write):
+        length = self.lengths[file]
+        if write or not self.exists(file) or self.getsize(file) < length:
+            h = self._get_handle(file, True)
+            # A file must be at least as long as its mapping. Extending it leaves a sparse hole.
+            if self.getsize(file) < length:
+                h.truncate(length)
+            m = mmap(h.fileno(), length, access = ACCESS_WRITE)
+            self.wmaps[file] = 1
+        else:
+            h = self._get_handle(file, False)
+            m = mmap(h.fileno(), length, access = ACCESS_READ)
+        if self.maps.has_key(file):
+            self.maps[file].close()
+        self.maps[file] = m
+        return m
+
+    def _read(self, pos, amount):
+        r = []
+        for file, begin, end in self._intervals(pos, amount):
+            r.append(self._get_map(file, False)[begin:end])
+        if len(r) == 1:
+            # The block is within one file, so don't copy it again.
+            return r[0]
+        return ''.join(r)
+
+    def _write(self, pos, s):
+        total = 0
+        for file, begin, end in self._intervals(pos, len(s)):
+            self._get_map(file, True)[begin:end] = s[total: total + end - begin]
+            total += end - begin
+
+    def _close_maps(self):
+        self.pool.lock.acquire()
+        try:
+            for m in self.maps.values():
+                m.flush()
+                m.close()
+            self.maps = {}
+            self.wmaps = {}
+        finally:
+            self.pool.lock.release()
+
+    def set_readonly(self):
+        # may raise IOError or OSError
+        self._close_maps()
+        Storage.set_readonly(self)
+
+    def close(self):
+        self._close_maps()
+        Storage.close(self)
+
+    def flush(self):
+        # might raise an IOError
+        self.pool.lock.acquire()
+        try:
+            for file in self.wmaps.keys():
+                self.maps[file].flush()
+        finally:
+            self.pool.lock.release()
+
+
+class MemoryStorage(StorageBackend):
+    """Keeps the torrent in memory only, such as for relaying data without saving it,
+    or running the rest of the client without a disk."""
+
+    def __init__(self, files):
+        for file, length in files:
+            self.total_length += length
+        # The bytes of the torrent, zero where nothing was written.
+        self.data = bytearray(self.total_length)
+
+    def read(self, pos, amount):
+        return str(self.data[pos:pos + amount])
+
+    def write(self, pos, s):
+        self.data[pos:pos + len(s)] = s
+
+
+class BlobStorage(Storage):
+    """Keeps the whole torrent in one file, sized to the total length when it is created,
+    instead of in each of the torrent's files."""
+
+    def __init__(self, blob, files, open, exists, getsize, getmtime = None, pool = None,
+            fadvise = True):
+        total = 0l
+        for file, length in files:
+            total += length
+        new = not exists(blob)
+        Storage.__init__(self, [(blob, total)], open, exists, getsize, {}, getmtime, pool, fadvise)
+        if new and total:
+            # Extend the new blob to its full size, leaving a sparse hole. It was still empty at startup,
+            # so its pieces aren't hashed to tell what they hold.
+            h = open(blob, 'rb+')
+            h.truncate(total)
             h.close()
 
 
@@ -190,3 +733,247 @@ def test_Storage_mixed_resume():
     x.sort()
     assert x == ['a', 'b']
     assert m.read(3, 3) == 'abc'
+
+def test_fingerprints():
+    f = FakeOpen({'a': 'abc'})
+    m = Storage([('a', 3), ('b', 0), ('c', 2), ('d', 3)], f.open, f.exists, f.getsize,
+        {'d': 1}, f.getmtime)
+    x = m.get_fingerprints()
+    assert x == [[3, 0], [0, 0], [0, 0], []]
+    assert m.get_changed_ranges(x) == []
+    m.write(3, 'de')
+    assert m.get_changed_ranges(x) == [(3, 5)]
+    assert m.get_changed_ranges(x[:2]) == [(0, 8)]
+
+def test_Storage_skip():
+    f = FakeOpen({'c': 'xyz'})
+    m = Storage([('a', 3), ('b', 3), ('c', 3), ('d', 0)], 
+        f.open, f.exists, f.getsize, {'b': 1, 'c': 1, 'd': 1})
+    x = f.files.keys()
+    x.sort()
+    assert x == ['a', 'c']
+    assert m.was_preallocated(6, 3)
+    assert not m.was_preallocated(3, 3)
+    assert m.read(6, 3) == 'xyz'
+    # Writing a piece that crosses into a skipped file creates it.
+    m.write(2, 'pq')
+    assert f.files['b'] == ['q']
+    assert m.read(2, 2) == 'pq'
+
+def test_piece_index():
+    f = FakeOpen({'a': 'abc', 'b': 'de', 'c': 'fghi', 'e': 'jk'})
+    files = [('a', 3), ('b', 4), ('c', 4), ('d', 0), ('e', 2), ('f', 1)]
+    m = Storage(files, f.open, f.exists, f.getsize, {'b': 1, 'f': 1})
+    m.set_piece_size(4)
+    assert m.piece_ranges.tolist() == [0, 1, 2, 3, 4]
+    for i in xrange(4):
+        assert m.was_piece_preallocated(i) == m.was_preallocated(i * 4, min(4, 14 - i * 4))
+    assert m.preallocated.tolist() == [1, 0, 1, 0]
+    # Searching only the files of a piece finds the same ranges.
+    m.write(0, 'ABCDEFGHIJKLMN')
+    assert m.read(0, 14) == 'ABCDEFGHIJKLMN'
+    assert m._intervals(5, 9) == [('b', 2, 4), ('c', 0, 4), ('e', 0, 2), ('f', 0, 1)]
+    assert m._intervals(13, 1) == [('f', 0, 1)]
+
+def test_MmapStorage():
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from os import path
+    d = mkdtemp()
+    try:
+        a, b, c = [path.join(d, x) for x in 'abc']
+        f = open(c, 'wb')
+        f.write('xyz')
+        f.close()
+        m = MmapStorage([(a, 3), (b, 2), (c, 3)], open, path.exists, path.getsize)
+        # Writes go into the mappings, and the files are extended to their full length.
+        m.write(2, 'pqr')
+        assert m.read(1, 4) == chr(0) + 'pqr'
+        assert m.read(5, 3) == 'xyz'
+        m.write(6, 'Y')
+        m.flush()
+        assert path.getsize(a) == 3
+        assert open(c, 'rb').read() == 'xYz'
+        m.set_readonly()
+        assert m.read(0, 8) == chr(0) * 2 + 'pqrxYz'
+        m.close()
+    finally:
+        rmtree(d)
+
+def test_positional():
+    # Python 2 has no os.pread or os.pwrite, so stand in for them with seeks on the descriptor.
+    global pread, pwrite
+    from os import lseek, read, write
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from os import path
+    def fake_pread(fd, n, pos, lseek = lseek, read = read):
+        lseek(fd, pos, 0)
+        return read(fd, n)
+    def fake_pwrite(fd, s, pos, lseek = lseek, write = write):
+        lseek(fd, pos, 0)
+        # Write at most two bytes at a time, to check short writes are finished.
+        return write(fd, s[:2])
+    old = pread, pwrite
+    pread, pwrite = fake_pread, fake_pwrite
+    d = mkdtemp()
+    try:
+        a, b = path.join(d, 'a'), path.join(d, 'b')
+        m = Storage([(a, 3), (b, 4)], open, path.exists, path.getsize, pool = HandlePool(1))
+        m.positional = True
+        m.write(1, 'pqrst')
+        assert m.read(0, 6) == chr(0) + 'pqrst'
+        assert open(b, 'rb').read() == 'rst'
+        # A handle another thread is using is only closed once it's done.
+        hs = m._pin(m._intervals(0, 1), False)
+        assert m.read(3, 2) == 'rs'
+        assert m.handles.keys() == [b]
+        assert not hs[0].closed
+        m._unpin(hs)
+        assert hs[0].closed
+        assert m.busy == {} and m.closing == {}
+        m.close()
+    finally:
+        pread, pwrite = old
+        rmtree(d)
+
+def test_pread_fallback():
+    # Python 2 has no os.pread, so it comes from the C library on systems that have it.
+    import sys
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from os import path
+    from fakeopen import FakeOpen
+    if not sys.platform.startswith('linux'):
+        return
+    assert pread is not None and pwrite is not None
+    d = mkdtemp()
+    try:
+        a, b = path.join(d, 'a'), path.join(d, 'b')
+        m = Storage([(a, 3), (b, 4)], open, path.exists, path.getsize)
+        assert m.positional
+        m.write(1, 'pqrst')
+        assert m.read(0, 6) == chr(0) + 'pqrst'
+        assert open(a, 'rb').read() == chr(0) + 'pq'
+        m.close()
+    finally:
+        rmtree(d)
+    # Fake files have no descriptors to read at an offset.
+    f = FakeOpen()
+    m = Storage([('a', 3)], f.open, f.exists, f.getsize)
+    assert not m.positional
+    m.write(0, 'abc')
+    assert m.read(1, 2) == 'bc'
+
+def test_advise():
+    # Record the hints instead of giving them.
+    global posix_fadvise, advice
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from os import path
+    hints = []
+    def fake_fadvise(fd, begin, length, hint, hints = hints):
+        hints.append((begin, length, hint))
+    old = posix_fadvise, advice
+    posix_fadvise, advice = fake_fadvise, {'willneed': 3, 'dontneed': 4}
+    d = mkdtemp()
+    try:
+        a, b = path.join(d, 'a'), path.join(d, 'b')
+        m = Storage([(a, 3), (b, 4)], open, path.exists, path.getsize)
+        m.advise(2, 3, 'willneed')
+        assert hints == [(2, 1, 3), (0, 2, 3)]
+        m.close()
+        del hints[:]
+        m = Storage([(a, 3), (b, 4)], open, path.exists, path.getsize, fadvise = False)
+        m.advise(0, 7, 'dontneed')
+        assert hints == []
+    finally:
+        posix_fadvise, advice = old
+        rmtree(d)
+
+def test_fadvise_fallback():
+    # Python 2 has no os.posix_fadvise, so it comes from the C library on Linux.
+    global posix_fadvise
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from os import path
+    from fakeopen import FakeOpen
+    if not platform.startswith('linux'):
+        return
+    assert posix_fadvise is not None
+    hints = []
+    def recording_fadvise(fd, begin, length, hint, hints = hints, real = posix_fadvise):
+        # Give the hint, noting any error that advise would ignore.
+        try:
+            real(fd, begin, length, hint)
+            hints.append((begin, length, hint))
+        except OSError, e:
+            hints.append(e)
+    old = posix_fadvise
+    posix_fadvise = recording_fadvise
+    d = mkdtemp()
+    try:
+        a, b = path.join(d, 'a'), path.join(d, 'b')
+        m = Storage([(a, 3), (b, 4)], open, path.exists, path.getsize)
+        assert m.fadvise
+        m.write(0, 'abcdefg')
+        m.advise(1, 5, 'dontneed')
+        assert hints == [(1, 2, advice['dontneed']), (0, 3, advice['dontneed'])]
+        m.close()
+        # Fake files have no descriptors to give hints for.
+        f = FakeOpen()
+        m = Storage([('a', 3)], f.open, f.exists, f.getsize)
+        assert not m.fadvise
+    finally:
+        posix_fadvise = old
+        rmtree(d)
+
+def test_MemoryStorage():
+    m = MemoryStorage([('a', 3), ('b', 0), ('c', 4)])
+    assert m.get_total_length() == 7
+    m.write(2, 'pqr')
+    assert m.read(1, 5) == chr(0) + 'pqr' + chr(0)
+    m.set_piece_size(4)
+    assert not m.was_piece_preallocated(1)
+    assert m.get_changed_ranges(m.get_fingerprints()) == [(0, 7)]
+
+def test_BlobStorage():
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from os import path
+    d = mkdtemp()
+    try:
+        blob = path.join(d, 'blob')
+        m = BlobStorage(blob, [('a', 3), ('b', 0), ('c', 4)], open, path.exists, path.getsize)
+        # The blob is created at its full size, but was empty at startup.
+        assert path.getsize(blob) == 7
+        assert not m.was_preallocated(0, 7)
+        m.write(2, 'pqr')
+        m.close()
+        m = BlobStorage(blob, [('a', 3), ('b', 0), ('c', 4)], open, path.exists, path.getsize)
+        assert m.was_preallocated(0, 7)
+        assert m.read(0, 7) == chr(0) * 2 + 'pqr' + chr(0) * 2
+        m.close()
+    finally:
+        rmtree(d)
+
+def test_handle_pool():
+    f = FakeOpen({'a': 'abc', 'b': 'def', 'c': 'ghi'})
+    pool = HandlePool(2)
+    m = Storage([('a', 3), ('b', 3), ('c', 3)], f.open, f.exists, f.getsize, pool = pool)
+    # No files are open until they are used.
+    assert m.handles == {}
+    assert m.read(0, 6) == 'abcdef'
+    assert m.read(0, 1) == 'a'
+    # Opening a third file closes the least recently used one.
+    assert m.read(6, 3) == 'ghi'
+    x = m.handles.keys()
+    x.sort()
+    assert x == ['a', 'c']
+    assert pool.get_stats() == {'hits': 1, 'misses': 3, 'open': 2}
+    m.write(3, 'DE')
+    assert f.files['b'] == list('DEf')
+    assert m.whandles == {'b': 1}
+    m.close()
+    assert m.handles == {}
+    assert pool.used == {}
@@ -2,8 +2,12 @@
 # see LICENSE.txt for license information
 
 from sha import sha
-from threading import Event
+from threading import Event, Thread, Condition
+from Queue import Queue
+from bisect import insort
+from array import array
 from bitfield import Bitfield
+from DiskIO import DiskIO
 
 def dummy_status(fractionDone = None, activity = None):
     pass
@@ -11,13 +15,22 @@ def dummy_status(fractionDone = None, activity = None):
 def dummy_data_flunked(size):
     pass
 
+def dummy_piece_finished(index):
+    pass
+
+def dummy_piece_lost(index):
+    pass
+
 class StorageWrapper:
     def __init__(self, storage, request_size, hashes, 
             piece_size, finished, failed, 
             statusfunc = dummy_status, flag = Event(), check_hashes = True,
-            data_flunked = dummy_data_flunked):
-        # The Storage instance.
+            data_flunked = dummy_data_flunked, piece_finished = dummy_piece_finished,
+            hash_threads = 1, resume = None, allocation = 'compact', cache_size = 0,
+            read_cache_size = 0, diskio = None, piece_lost = dummy_piece_lost):
+        # The Storage instance, which indexes the files each piece overlaps.
         self.storage = storage
+        storage.set_piece_size(piece_size)
         # The size of blocks to request.
         self.request_size = request_size
         # An array of SHA-1 hashes for all pieces.
@@ -26,6 +39,12 @@ class StorageWrapper:
         self.piece_size = piece_size
         # Method to call if a piece fails SHA-1 validation.
         self.data_flunked = data_flunked
+        # Method to call with the index of each piece downloaded and validated.
+        self.piece_finished = piece_finished
+        # Method to call with the index of each piece assumed complete at startup that failed validation.
+        self.piece_lost = piece_lost
+        # Pieces we told peers we have that failed validation, as dictionary keys.
+        self.lost = {}
         # The total bytes to download and save.
         self.total_length = storage.get_total_length()
         # The number of bytes left to download and validate.
@@ -36,14 +55,20 @@ class StorageWrapper:
             raise ValueError, 'bad data from tracker - total too big'
         # Callback invoked once all pieces have been downloaded and validated.
         self.finished = finished
+        # Whether finished was called. Pieces lost afterwards are downloaded again without calling it twice.
+        self.was_finished = False
         # Callback invoked with a string describing any error.
         self.failed = failed
 
         # The number of outstanding requests for blocks belonging to a piece.
-        self.numactive = [0] * len(hashes)
-        # If an element is 1, then the piece has not been requested from peers.
-        # If an elemtent is an array, it contains blocks that have not been requested from peers.
-        self.inactive_requests = [1] * len(hashes)
+        self.numactive = array('i', [0]) * len(hashes)
+        # For each piece, a bitmap of its blocks that have not been requested from peers,
+        # where bit k is set if the block starting at byte k * request_size has not been requested.
+        # All bits are set if the piece has not been requested, and none if we have it.
+        self.inactive_requests = [self._all_blocks(0)] * len(hashes)
+        if hashes:
+            # The last piece may be shorter.
+            self.inactive_requests[-1] = self._all_blocks(len(hashes) - 1)
         # The number of bytes that have not been downloaded or requested.
         # When this reaches 0, then we enter endgame mode.
         self.amount_inactive = self.total_length
@@ -54,16 +79,64 @@ class StorageWrapper:
         self.have = Bitfield(len(hashes))
         # Whether each piece has been validated by computing its SHA-1 hash.
         # If check_hashes is False, then validating preallocated segments is deferred.
-        self.waschecked = [check_hashes] * len(hashes)
+        self.waschecked = array('b', [check_hashes]) * len(hashes)
+
+        # Whether each piece belongs only to files the user chose to skip.
+        self.skipped = [False] * len(hashes)
 
+        # Either 'compact' to write pieces into the first free segment and move them into place later,
+        # or 'direct' to write pieces at their own segment.
+        self.allocation = allocation
         # Maps each piece to what piece, or segment, it occupies on disk.
         # It may not be the right segment for the piece, and the piece may be incomplete.
         self.places = {}
         # Missing segments on disk.
         self.holes = []
+        # Missing segments on disk belonging to skipped pieces.
+        # These are never allocated to other pieces, so skipped files are not written to.
+        self.skipped_holes = []
+        # Maps each piece that is downloading to the (begin, length) blocks written to disk,
+        # so the blocks need not be downloaded again after a restart.
+        self.written = {}
+        # Maps each downloading piece to the (begin, data) blocks received but not yet written to disk.
+        self.dirty = {}
+        # The total bytes of blocks in dirty.
+        self.dirty_bytes = 0
+        # Once dirty_bytes and held_bytes exceed this, the pieces with the most blocks in memory are
+        # written to disk.
+        self.cache_size = cache_size
+        # Maps each downloading piece to a [sha, length hashed, pending, held] list, where pending maps
+        # the first byte of each block received after a missing block to the block, and held has the
+        # first byte of each block in pending already written to disk as keys.
+        # Blocks are hashed as they arrive, so a completed piece need not be read back from disk.
+        self.hashers = {}
+        # The total bytes of blocks in hashers that are no longer in dirty.
+        self.held_bytes = 0
+        # Maps validated pieces read for uploading to their data, so peers requesting
+        # other blocks of them are served from memory.
+        self.read_cache = {}
+        # The pieces in read_cache, from least to most recently read.
+        self.read_order = []
+        # The total bytes of pieces in read_cache, which is kept at most read_cache_size.
+        self.read_cache_bytes = 0
+        self.read_cache_size = read_cache_size
+        # The number of blocks read from read_cache, and from disk.
+        self.read_hits = 0
+        self.read_misses = 0
+        # The first piece that verify_unchecked has not looked at yet.
+        self.next_unchecked = 0
+        # The DiskIO instance that writes and reads for uploading run on.
+        # By default these run immediately, in the reactor loop.
+        if diskio is None:
+            diskio = DiskIO(0, None)
+        self.diskio = diskio
+        # Maps each piece to the number of its writes that have not completed.
+        self.pending_writes = {}
+        # Maps each piece in pending_writes to functions to call once its writes complete.
+        self.after_writes = {}
         if len(hashes) == 0:
             # If no hashes, then no data to download, so trivially finished.
-            finished()
+            self._finish()
             return
 
         # Maps each SHA-1 hash to all pieces that have that hash.
@@ -89,56 +162,231 @@ class StorageWrapper:
             self.amount_left -= self._piecelen(piece)
             self.amount_inactive -= self._piecelen(piece)
             # We won't be requesting this piece from peers.
-            self.inactive_requests[piece] = None
+            self.inactive_requests[piece] = 0
             self.waschecked[piece] = check_hashes
 
+        # Maps each segment whose contents are known from the fast-resume data to
+        # the piece in it, or to None if it holds no piece.
+        resumed = {}
+        if resume is not None:
+            resumed = self._get_resumed(resume)
+            for piece, state in resumed.values():
+                if piece in targets.get(hashes[piece], []):
+                    # Already know where this piece is, so don't look for it.
+                    targets[hashes[piece]].remove(piece)
         # Get the length of the last piece.
         lastlen = self._piecelen(len(hashes) - 1)
+        # The preallocated segments whose pieces must be identified by their hashes.
+        tocheck = []
         for i in xrange(len(hashes)):
             if not self._waspre(i):
                 # This piece is not preallocated, i.e. it has no segment of bytes on disk.
                 self.holes.append(i)
+            elif resumed.has_key(i):
+                # The fast-resume data says what this segment holds, so don't hash it.
+                piece, state = resumed[i]
+                self._resume_segment(i, piece, state, resume['clean'], markgot)
             elif not check_hashes:
                 # The corresponding segment on disk is full of bytes.
                 # Assume that it belongs to this piece, meaning places[i] = i.
                 markgot(i, i)
             else:
-                # Only get here if check_hashes = True, so we called statusfunc earlier.
-                # We're trying to figure out what piece is at segment i on disk.
+                tocheck.append(i)
 
-                # The bytes in this segment on disk could belong to any piece.
-                # Compute a hash of its first lastlen bytes in case it has the last piece.
-                sh = sha(self.storage.read(piece_size * i, lastlen))
-                sp = sh.digest()
-                # Compute a hash of all its bytes in the case that it has any other piece.
-                sh.update(self.storage.read(piece_size * i + lastlen, self._piecelen(i) - lastlen))
-                s = sh.digest()
-
-                if s == hashes[i]:
-                    # This is piece i, occupying its correct segment on disk.
-                    markgot(i, i)
-                elif targets.get(s) and self._piecelen(i) == self._piecelen(targets[s][-1]):
-                    # This is not the last piece, temporarily occupying the wrong segment.
-                    markgot(targets[s].pop(), i)
-                elif not self.have[len(hashes) - 1] and sp == hashes[-1] and (i == len(hashes) - 1 or not self._waspre(len(hashes) - 1)):
-                    # This is the last piece, temporarily occupying the wrong segment.
-                    markgot(len(hashes) - 1, i)
-                else:
-                    # This segment has been allocated but it doesn't belong to any piece.
-                    # When this piece comes in, we can write to this segment directly.
-                    self.places[i] = i
-                if flag.isSet():
-                    return
-                numchecked += 1
-                statusfunc({'fractionDone': 1 - float(self.amount_left) / self.total_length})
+        def check(i, sp, s, self = self, hashes = hashes, targets = targets, 
+                markgot = markgot, statusfunc = statusfunc):
+            # Only get here if check_hashes = True, so we called statusfunc earlier.
+            # We're trying to figure out what piece is at segment i on disk.
+            # The bytes in this segment on disk could belong to any piece.
+            # sp is the hash of its first lastlen bytes, in case it has the last piece.
+            # s is the hash of all its bytes, in the case that it has any other piece.
+            if s == hashes[i]:
+                # This is piece i, occupying its correct segment on disk.
+                markgot(i, i)
+            elif self.allocation == 'direct':
+                # Pieces are never moved in direct allocation, so any other data is overwritten.
+                self.places[i] = i
+            elif targets.get(s) and self._piecelen(i) == self._piecelen(targets[s][-1]):
+                # This is not the last piece, temporarily occupying the wrong segment.
+                markgot(targets[s].pop(), i)
+            elif not self.have[len(hashes) - 1] and sp == hashes[-1] and (i == len(hashes) - 1 or not self._waspre(len(hashes) - 1)):
+                # This is the last piece, temporarily occupying the wrong segment.
+                markgot(len(hashes) - 1, i)
+            else:
+                # This segment has been allocated but it doesn't belong to any piece.
+                # When this piece comes in, we can write to this segment directly.
+                self.places[i] = i
+            statusfunc({'fractionDone': 1 - float(self.amount_left) / self.total_length})
+
+        if tocheck and not self._hash_segments(tocheck, lastlen, max(hash_threads, 1), flag, check):
+            return
 
         if self.amount_left == 0:
             # All data has been downloaded and validated.
-            finished()
+            self._finish()
+
+    def get_resume_data(self, clean = False):
+        # Returns the state needed to restart without hashing all data, for passing as resume later.
+        # clean is True if no more data will be written before the download restarts.
+        # might raise an IOError
+        self.flush()
+        self.storage.flush()
+        unchecked = []
+        for i in xrange(len(self.hashes)):
+            if self.have[i] and not self.waschecked[i]:
+                unchecked.append(i)
+        return {'pieces': len(self.hashes), 'piece length': self.piece_size,
+            'have': self.have.tostring(), 
+            'places': [[p, s] for p, s in self.places.items()],
+            'partial': [[p, [b for b, l in bl]] for p, bl in self.written.items()],
+            'unchecked': unchecked, 'clean': int(clean),
+            'files': self.storage.get_fingerprints()}
+
+    def _get_resumed(self, resume):
+        # Returns a dictionary from each segment whose contents are known from the resume data
+        # to a (piece, state) pair. The state is 1 if the piece was validated, 0 if it was not,
+        # a list of the first bytes of the blocks written if it was downloading, or None if nothing was written.
+        # Segments in files that changed since the resume data was saved are left out, so they're hashed again.
+        n = len(self.hashes)
+        try:
+            if resume['pieces'] != n or resume['piece length'] != self.piece_size:
+                return {}
+            have = Bitfield(n, resume['have'])
+            unchecked = {}
+            for p in resume['unchecked']:
+                unchecked[p] = 1
+            partial = {}
+            for p, begins in resume['partial']:
+                partial[p] = begins
+            r = {}
+            for p, s in resume['places']:
+                if not (0 <= p < n and 0 <= s < n) or r.has_key(s):
+                    return {}
+                if p != s and self.allocation == 'direct':
+                    # Pieces must be at their own segment, so hash this segment again.
+                    continue
+                if have[p]:
+                    r[s] = (p, int(not unchecked.has_key(p)))
+                else:
+                    r[s] = (p, partial.get(p))
+            if self.allocation == 'direct':
+                # Each piece is only written at its own segment, so a segment the resume data doesn't
+                # list was never written to, even if writing a later segment extended the file past it.
+                for s in xrange(n):
+                    if not r.has_key(s):
+                        r[s] = (s, None)
+            changed = self.storage.get_changed_ranges(resume['files'])
+        except (KeyError, TypeError, ValueError, IndexError):
+            return {}
+        for begin, end in changed:
+            for s in xrange(begin // self.piece_size, (end - 1) // self.piece_size + 1):
+                if r.has_key(s):
+                    del r[s]
+        return r
+
+    def _resume_segment(self, i, piece, state, clean, markgot):
+        # Restore what segment i holds from the resume data.
+        if type(state) is int:
+            markgot(piece, i)
+            # Pieces written after the last save may have moved, unless the download stopped cleanly.
+            # Validate such pieces once they are first read instead.
+            self.waschecked[piece] = clean and state == 1
+            return
+        self.places[piece] = i
+        if state:
+            # Don't request the blocks already written again.
+            written = []
+            for begin in state:
+                bit = 1L << (begin // self.request_size)
+                if begin % self.request_size == 0 and self.inactive_requests[piece] & bit:
+                    self.inactive_requests[piece] &= ~bit
+                    length = self._block_length(piece, begin)
+                    self.amount_inactive -= length
+                    written.append((begin, length))
+            self.written[piece] = written
+
+    def _hash_segments(self, segments, lastlen, numthreads, flag, func):
+        # Reads the given segments in order on one thread, and hashes them on numthreads others.
+        # Calls func with each segment, the hash of its first lastlen bytes, and the hash of all its bytes,
+        # in the order of segments. Returns False if flag was set before all segments were checked.
+        # Segments read ahead of hashing, waiting to be hashed.
+        work = Queue(numthreads * 2)
+        # Maps each hashed segment to its two hashes, or to the exception raised reading it.
+        done = {}
+        cond = Condition()
+        # Not empty once the reading thread should stop.
+        stop = []
+        def put(i, result, done = done, cond = cond):
+            cond.acquire()
+            done[i] = result
+            cond.notify()
+            cond.release()
+        def read(self = self, segments = segments, lastlen = lastlen, work = work,
+                numthreads = numthreads, stop = stop, put = put):
+            # Reading ahead more and not keeping what was read leaves the page cache to data being seeded.
+            self.storage.advise(0, self.total_length, 'sequential')
+            try:
+                for i in segments:
+                    if stop:
+                        break
+                    try:
+                        a = self.storage.read(self.piece_size * i, lastlen)
+                        b = self.storage.read(self.piece_size * i + lastlen, self._piecelen(i) - lastlen)
+                    except Exception, e:
+                        put(i, e)
+                        break
+                    # The kernel only drops cached folios wholly inside the range, and they can be
+                    # up to 2 MiB, so start that far back to catch any straddling the last piece.
+                    begin = max(self.piece_size * i - 2 ** 21, 0)
+                    self.storage.advise(begin, self.piece_size * i + self._piecelen(i) - begin, 'dontneed')
+                    work.put((i, a, b))
+            finally:
+                self.storage.advise(0, self.total_length, 'normal')
+                # Tell each hashing thread to exit.
+                for k in xrange(numthreads):
+                    work.put(None)
+        def hash(work = work, put = put):
+            # The hash functions release the interpreter lock, so these threads hash in parallel.
+            while True:
+                x = work.get()
+                if x is None:
+                    return
+                i, a, b = x
+                sh = sha(a)
+                sp = sh.digest()
+                sh.update(b)
+                put(i, (sp, sh.digest()))
+        threads = [Thread(target = read)] + [Thread(target = hash) for k in xrange(numthreads)]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        try:
+            for i in segments:
+                cond.acquire()
+                try:
+                    while not done.has_key(i):
+                        cond.wait()
+                    r = done[i]
+                    del done[i]
+                finally:
+                    cond.release()
+                if type(r) is not tuple:
+                    raise r
+                func(i, r[0], r[1])
+                if flag.isSet():
+                    return False
+            return True
+        finally:
+            stop.append(1)
+            for t in threads:
+                t.join()
 
     def _waspre(self, piece):
         # Returns whether all files containing this piece were preallocated.
-        return self.storage.was_preallocated(piece * self.piece_size, self._piecelen(piece))
+        return self.storage.was_piece_preallocated(piece)
+
+    def get_piece_length(self, index):
+        return self._piecelen(index)
 
     def _piecelen(self, piece):
         # Return the length of the given piece.
@@ -154,18 +402,15 @@ class StorageWrapper:
         # Returns whether we've downloaded at least one piece.
         return self.amount_left < self.total_length
 
-    def _make_inactive(self, index):
+    def _all_blocks(self, index):
+        # Returns the bitmap with a bit set for each block of this piece.
         # This assigns to length what _piecelen would return.
         length = min(self.piece_size, self.total_length - self.piece_size * index)
-        # Will contain all blocks for this piece as (start byte, end byte) pairs.
-        l = []
-        x = 0
-        while x + self.request_size < length:
-            l.append((x, self.request_size))
-            x += self.request_size
-        l.append((x, length - x))
-        # Replace the value of 1 with the array of blocks.
-        self.inactive_requests[index] = l
+        return (1L << ((length + self.request_size - 1) // self.request_size)) - 1
+
+    def _block_length(self, index, begin):
+        # Returns the length of the block of this piece starting at byte begin.
+        return min(self.request_size, self._piecelen(index) - begin)
 
     def is_endgame(self):
         return self.endgame
@@ -178,22 +423,49 @@ class StorageWrapper:
         return self.have[index]
 
     def do_I_have_requests(self, index):
-        # Similar to how you would convert to boolean in JavaScript,
-        # this returns True if the element is 1 or a non-empty array, and
-        # this returns False if the element is None or an empty array.
-        return not not self.inactive_requests[index]
+        # Returns True if any block of this piece has not been requested.
+        return not self.skipped[index] and self.inactive_requests[index] != 0
+
+    def _inactive_length(self, index):
+        # The number of bytes of this piece neither downloaded nor requested.
+        rs = self.inactive_requests[index]
+        total = bin(rs).count('1') * self.request_size
+        last = (self._piecelen(index) - 1) // self.request_size
+        if rs >> last:
+            # The last block may be shorter.
+            total -= self.request_size - self._block_length(index, last * self.request_size)
+        return total
+
+    def set_skipped(self, index, skipped):
+        # Stop or resume requesting this piece, such as when the files it belongs to are skipped.
+        if self.skipped[index] == skipped:
+            return
+        self.skipped[index] = skipped
+        if skipped:
+            # Bytes of skipped pieces are never requested, so don't wait on them to enter endgame.
+            self.amount_inactive -= self._inactive_length(index)
+            if index in self.holes:
+                self.holes.remove(index)
+                insort(self.skipped_holes, index)
+        else:
+            self.amount_inactive += self._inactive_length(index)
+            if self.amount_inactive > 0:
+                # There are blocks to request again.
+                self.endgame = False
+            if index in self.skipped_holes:
+                self.skipped_holes.remove(index)
+                insort(self.holes, index)
 
     def new_request(self, index):
         # returns (begin, length)
-        if self.inactive_requests[index] == 1:
-            # Create the blocks to request for this piece.
-            self._make_inactive(index)
         # Increment count of blocks requested for this piece.
         self.numactive[index] += 1
-        # Get the block with the earliest start byte.
+        # Get the block with the earliest start byte, which is the lowest bit set.
         rs = self.inactive_requests[index]
-        r = min(rs)
-        rs.remove(r)
+        bit = rs & -rs
+        self.inactive_requests[index] = rs ^ bit
+        begin = (bit.bit_length() - 1) * self.request_size
+        r = (begin, self._block_length(index, begin))
         # Deduct block length from total bytes neither downloaded nor requested.
         self.amount_inactive -= r[1]
         if self.amount_inactive == 0:
@@ -208,91 +480,219 @@ class StorageWrapper:
             self.failed('IO Error ' + str(e))
             return True
 
-    def _piece_came_in(self, index, begin, piece):
-        if not self.places.has_key(index):
-            # There is no segment allocated for this piece,
-            # either because it wasn't preallocated, or because this is its first block.
-            # Allocate one as early as possible, hopefully extending another segment.
-            n = self.holes.pop(0)
-
-            if self.places.has_key(n):
-                # The piece that belongs at this new segment is in another segment.
-                oldpos = self.places[n]
-                # Read that piece from its temporary segment.
-                old = self.storage.read(self.piece_size * oldpos, self._piecelen(n))
-                if self.have[n] and sha(old).digest() != self.hashes[n]:
-                    # Not that the piece may be incomplete. But if it is complete, validate it.
-                    self.failed('data corrupted on disk - maybe you have two copies running?')
-                    return True
-                # Write it to its correct segment.
-                self.storage.write(self.piece_size * n, old)
-                self.places[n] = n
-
-                if index == oldpos or index in self.holes:
-                    # The new piece belongs at the segment that was just vacated,
-                    # or belongs to a segment that has not been allocated yet.
-                    # So write the piece to the segment that was vacated.
-                    self.places[index] = oldpos
-                else:
-                    # The correct segment for the new piece is occupied by another piece. Find it.
-                    for p, v in self.places.items():
-                        if v == index:
-                            break
-                    # The new piece will be written to its correct segment.
-                    self.places[index] = index
-                    # Move the piece that is in the new piece's correct segment to the vacated one.
-                    self.places[p] = oldpos
-                    old = self.storage.read(self.piece_size * index, self.piece_size)
-                    self.storage.write(self.piece_size * oldpos, old)
-
-            elif index in self.holes or index == n:
-                # This new segment is where this piece belongs,
-                # or the segment for this piece has not been allocated so put it here anyway.
-                if not self._waspre(n):
-                    # Fill the new segment with all 0xFF bytes.
-                    self.storage.write(self.piece_size * n, self._piecelen(n) * chr(0xFF))
-                self.places[index] = n
+    def _allocate(self, index):
+        # Allocate a segment on disk for this piece, moving other pieces if needed.
+        # Returns False if the data on disk is corrupted.
+        # There is no segment allocated for this piece,
+        # either because it wasn't preallocated, or because this is its first block.
+        # Allocate one as early as possible, hopefully extending another segment.
+        n = self.holes.pop(0)
+
+        if self.places.has_key(n):
+            # The piece that belongs at this new segment is in another segment.
+            oldpos = self.places[n]
+            self._flush_piece(n)
+            # Moving pieces reads them directly, so wait for their writes.
+            self.diskio.drain()
+            # Read that piece from its temporary segment.
+            old = self.storage.read(self.piece_size * oldpos, self._piecelen(n))
+            if self.have[n] and sha(old).digest() != self.hashes[n]:
+                # Not that the piece may be incomplete. But if it is complete, validate it.
+                self.failed('data corrupted on disk - maybe you have two copies running?')
+                return False
+            # Write it to its correct segment.
+            self.storage.write(self.piece_size * n, old)
+            self.places[n] = n
+
+            if index == oldpos or index in self.holes:
+                # The new piece belongs at the segment that was just vacated,
+                # or belongs to a segment that has not been allocated yet.
+                # So write the piece to the segment that was vacated.
+                self.places[index] = oldpos
             else:
                 # The correct segment for the new piece is occupied by another piece. Find it.
                 for p, v in self.places.items():
                     if v == index:
                         break
+                self._flush_piece(p)
+                self.diskio.drain()
                 # The new piece will be written to its correct segment.
                 self.places[index] = index
-                # Move the piece that is in the new piece's correct segment to a new segment.
-                self.places[p] = n
-                old = self.storage.read(self.piece_size * index, self._piecelen(n))
-                self.storage.write(self.piece_size * n, old)
+                # Move the piece that is in the new piece's correct segment to the vacated one.
+                self.places[p] = oldpos
+                old = self.storage.read(self.piece_size * index, self.piece_size)
+                self.storage.write(self.piece_size * oldpos, old)
+
+        elif index in self.holes or index == n:
+            # This new segment is where this piece belongs,
+            # or the segment for this piece has not been allocated so put it here anyway.
+            if not self._waspre(n):
+                # Fill the new segment with all 0xFF bytes.
+                self.storage.write(self.piece_size * n, self._piecelen(n) * chr(0xFF))
+            self.places[index] = n
+        else:
+            # The correct segment for the new piece is occupied by another piece. Find it.
+            for p, v in self.places.items():
+                if v == index:
+                    break
+            self._flush_piece(p)
+            self.diskio.drain()
+            # The new piece will be written to its correct segment.
+            self.places[index] = index
+            # Move the piece that is in the new piece's correct segment to a new segment.
+            self.places[p] = n
+            old = self.storage.read(self.piece_size * index, self._piecelen(n))
+            self.storage.write(self.piece_size * n, old)
+        return True
+
+    def _piece_came_in(self, index, begin, piece):
+        if not self.places.has_key(index):
+            if self.allocation == 'direct':
+                # Write every piece at its own segment, so no piece ever moves.
+                # Parts of files not yet written are left sparse.
+                self.places[index] = index
+            elif not self._allocate(index):
+                return True
 
-        # Write this block to its corresponding segment on disk.
-        self.storage.write(self.places[index] * self.piece_size + begin, piece)
+        if not self.hashers.has_key(index) and not self.written.has_key(index) and not self.dirty.has_key(index):
+            # This is the first block of the piece, so all of its blocks will be hashed in memory.
+            # Pieces with blocks written before a restart are read back from disk instead.
+            self.hashers[index] = [sha(), 0, {}, {}]
+        if self.hashers.has_key(index):
+            h = self.hashers[index]
+            h[2][begin] = piece
+            # Hash the blocks following those already hashed, keeping the others until the gap fills.
+            while h[2].has_key(h[1]):
+                data = h[2][h[1]]
+                del h[2][h[1]]
+                if h[3].has_key(h[1]):
+                    del h[3][h[1]]
+                    self.held_bytes -= len(data)
+                h[0].update(data)
+                h[1] += len(data)
+        # Hold this block in memory until the piece completes or the cache is full.
+        self.dirty.setdefault(index, []).append((begin, piece))
+        self.dirty_bytes += len(piece)
         self.numactive[index] -= 1
         if not self.inactive_requests[index] and not self.numactive[index]:
             # If inactive_requests is empty and numactive is 0, then the piece is fully downloaded.
-            if sha(self.storage.read(self.piece_size * self.places[index], self._piecelen(index))).digest() == self.hashes[index]:
+            self._flush_piece(index)
+            del self.written[index]
+            if self.hashers.has_key(index) and self.hashers[index][1] == self._piecelen(index):
+                digest = self.hashers[index][0].digest()
+            else:
+                # Some blocks were written before a restart, so read the piece back once it is written.
+                self.diskio.drain()
+                digest = sha(self.storage.read(self.piece_size * self.places[index], self._piecelen(index))).digest()
+            self._drop_hasher(index)
+            if digest == self.hashes[index]:
                 # We have downloaded and validated this piece.
                 self.have[index] = True
-                self.inactive_requests[index] = None
+                self.inactive_requests[index] = 0
                 self.waschecked[index] = True
                 # This piece has been downloaded and validated.
                 self.amount_left -= self._piecelen(index)
+                self.piece_finished(index)
                 if self.amount_left == 0:
-                    # All data has been downloaded and validated.
-                    self.finished()
+                    # All data has been downloaded and validated. Finish writing it before reopening files.
+                    self.diskio.drain()
+                    self._finish()
             else:
                 # Notify via the callback that the piece failed validation.
                 self.data_flunked(self._piecelen(index))
                 # All blocks for the piece must be downloaded again.
-                self.inactive_requests[index] = 1
-                self.amount_inactive += self._piecelen(index)
+                self.inactive_requests[index] = self._all_blocks(index)
+                if not self.skipped[index]:
+                    self.amount_inactive += self._piecelen(index)
                 return False
+        self._trim_cache()
         return True
 
+    def _trim_cache(self):
+        while self.dirty_bytes + self.held_bytes > self.cache_size:
+            # Write the piece with the most bytes cached, so each write to disk is as long as possible.
+            amounts = {}
+            for i, blocks in self.dirty.items():
+                for begin, data in blocks:
+                    amounts[i] = amounts.get(i, 0) + len(data)
+            for i, h in self.hashers.items():
+                for begin in h[3].keys():
+                    amounts[i] = amounts.get(i, 0) + len(h[2][begin])
+            most = None
+            for i, amount in amounts.items():
+                if most is None or amount > most[0]:
+                    most = (amount, i)
+            self._flush_piece(most[1])
+            if self.hashers.has_key(most[1]) and self.hashers[most[1]][3]:
+                # Stop keeping its blocks after a missing block. The piece is read back from disk
+                # to validate it once it completes.
+                self._drop_hasher(most[1])
+
+    def _drop_hasher(self, index):
+        if self.hashers.has_key(index):
+            h = self.hashers[index]
+            for begin in h[3].keys():
+                self.held_bytes -= len(h[2][begin])
+            del self.hashers[index]
+
+    def _flush_piece(self, index):
+        # Write the cached blocks of this piece to its segment on disk, joining adjacent blocks into one write.
+        if not self.dirty.has_key(index):
+            return
+        blocks = self.dirty[index]
+        del self.dirty[index]
+        blocks.sort()
+        pos = self.piece_size * self.places[index]
+        start, run, end = blocks[0][0], [], blocks[0][0]
+        for begin, data in blocks:
+            if begin != end:
+                # A block is missing between this run of blocks and the next.
+                self._write(index, pos + start, ''.join(run))
+                start, run = begin, []
+            run.append(data)
+            end = begin + len(data)
+        self._write(index, pos + start, ''.join(run))
+        written = self.written.setdefault(index, [])
+        h = self.hashers.get(index)
+        for begin, data in blocks:
+            self.dirty_bytes -= len(data)
+            written.append((begin, len(data)))
+            if h is not None and h[2].has_key(begin):
+                # This block is waiting to be hashed, so it is still held in memory.
+                h[3][begin] = 1
+                self.held_bytes += len(data)
+
+    def _write(self, index, pos, data):
+        # Write data of the given piece to disk on a worker thread.
+        self.pending_writes[index] = self.pending_writes.get(index, 0) + 1
+        def wrote(result, error, self = self, index = index):
+            self.pending_writes[index] -= 1
+            if not self.pending_writes[index]:
+                del self.pending_writes[index]
+                if self.after_writes.has_key(index):
+                    funcs = self.after_writes[index]
+                    del self.after_writes[index]
+                    for func in funcs:
+                        func()
+            if error is not None:
+                self.failed('IO Error ' + str(error))
+        self.diskio.submit(self.storage.write, (pos, data), wrote)
+
+    def flush(self):
+        # Write all cached blocks to disk, such as before shutting down.
+        # might raise an IOError
+        for index in self.dirty.keys():
+            self._flush_piece(index)
+        # Blocks waiting to be hashed are still held in memory.
+        self._trim_cache()
+        self.diskio.drain()
+
     def request_lost(self, index, begin, length):
         # Add the block back to the blocks not yet requested for this piece.
-        self.inactive_requests[index].append((begin, length))
-        # Neither downloaded nor requested this block now.
-        self.amount_inactive += length
+        self.inactive_requests[index] |= 1L << (begin // self.request_size)
+        if not self.skipped[index]:
+            # Neither downloaded nor requested this block now.
+            self.amount_inactive += length
         # Decrement count of blocks requested for this piece.
         self.numactive[index] -= 1
 
@@ -307,18 +707,186 @@ class StorageWrapper:
         if not self.have[index]:
             # We have not downloaded and validated this piece yet.
             return None
+        if self.pending_writes.has_key(index):
+            # The piece was just downloaded, so wait for it to be written.
+            self.diskio.drain()
+        if self.read_cache.has_key(index):
+            self.read_hits += 1
+            # Move this piece to the most recently read end.
+            self.read_order.remove(index)
+            self.read_order.append(index)
+            data = self.read_cache[index]
+            if begin + length > len(data):
+                return None
+            return data[begin:begin + length]
+        self.read_misses += 1
+        data = None
         if not self.waschecked[index]:
             # We have downloaded this piece, but not yet validated it.
-            if sha(self.storage.read(self.piece_size * self.places[index], self._piecelen(index))).digest() != self.hashes[index]:
+            data = self.storage.read(self.piece_size * self.places[index], self._piecelen(index))
+            if sha(data).digest() != self.hashes[index]:
                 # The piece failed validation.
-                self.failed('told file complete on start-up, but piece failed hash check')
+                self._lose_piece(index)
                 return None
             # The piece validated correctly; remember this so we don't validate it agian.
             self.waschecked[index] = True
         if begin + length > self._piecelen(index):
             # The caller is requesting more data than this piece actually has.
             return None
-        return self.storage.read(self.piece_size * self.places[index] + begin, length)
+        if self._piecelen(index) > self.read_cache_size:
+            # The piece doesn't fit in the cache, so only read the block.
+            return self.storage.read(self.piece_size * self.places[index] + begin, length)
+        if data is None:
+            # Read the whole piece at once, expecting peers to request its other blocks next.
+            data = self.storage.read(self.piece_size * self.places[index], self._piecelen(index))
+        self._cache_piece(index, data)
+        return data[begin:begin + length]
+
+    def _cache_piece(self, index, data):
+        # Add a validated piece to the read cache, forgetting the least recently read pieces if it is full.
+        self.read_cache[index] = data
+        self.read_order.append(index)
+        self.read_cache_bytes += len(data)
+        while self.read_cache_bytes > self.read_cache_size:
+            old = self.read_order.pop(0)
+            self.read_cache_bytes -= len(self.read_cache[old])
+            del self.read_cache[old]
+
+    def get_piece_async(self, index, begin, length, callback):
+        # Like get_piece, but reads and validates the piece on a worker thread.
+        # Calls callback in the reactor loop with the block, or None if it could not be read.
+        if not self.have[index] or begin + length > self._piecelen(index):
+            callback(None)
+            return
+        if self.read_cache.has_key(index):
+            callback(self._get_piece(index, begin, length))
+            return
+        if self.pending_writes.has_key(index):
+            # The piece was just downloaded, so read it once it is written.
+            def retry(self = self, index = index, begin = begin, length = length, callback = callback):
+                self.get_piece_async(index, begin, length, callback)
+            self.after_writes.setdefault(index, []).append(retry)
+            return
+        self.read_misses += 1
+        check = not self.waschecked[index]
+        # Read the whole piece if it must be validated or will be cached.
+        whole = check or self._piecelen(index) <= self.read_cache_size
+        if whole:
+            pos, amount = self.piece_size * self.places[index], self._piecelen(index)
+        else:
+            pos, amount = self.piece_size * self.places[index] + begin, length
+        def done(result, error, self = self, index = index, begin = begin, length = length,
+                callback = callback, check = check, whole = whole):
+            if error is not None:
+                self.failed('IO Error ' + str(error))
+                callback(None)
+                return
+            data, digest = result
+            if check and not self.waschecked[index]:
+                if digest != self.hashes[index]:
+                    # The piece failed validation.
+                    self._lose_piece(index)
+                    callback(None)
+                    return
+                self.waschecked[index] = True
+            if not whole:
+                callback(data)
+                return
+            if self._piecelen(index) <= self.read_cache_size and not self.read_cache.has_key(index):
+                self._cache_piece(index, data)
+            callback(data[begin:begin + length])
+        self.diskio.submit(self._read_and_hash, (pos, amount, check), done)
+
+    def will_read(self, index, begin, length):
+        # Called with a block a peer requested that will be read later, so the disk can start reading it.
+        if not self.have[index] or self.read_cache.has_key(index) or self.pending_writes.has_key(index):
+            return
+        if not self.waschecked[index] or self._piecelen(index) <= self.read_cache_size:
+            # The whole piece will be read.
+            begin, length = 0, self._piecelen(index)
+        self.storage.advise(self.piece_size * self.places[index] + begin, length, 'willneed')
+
+    def _read_and_hash(self, pos, amount, check):
+        # Runs on a worker thread. Returns the data read and, if check is True, its hash.
+        data = self.storage.read(pos, amount)
+        if check:
+            return data, sha(data).digest()
+        return data, None
+
+    def is_disk_busy(self):
+        # Returns whether enough disk jobs are queued that peers should wait before adding more.
+        return self.diskio.is_full()
+
+    def when_disk_free(self, func):
+        # Call func once is_disk_busy is no longer true.
+        self.diskio.when_free(func)
+
+    def _finish(self):
+        # Call finished the first time all pieces are downloaded and validated.
+        if not self.was_finished:
+            self.was_finished = True
+            self.finished()
+
+    def _lose_piece(self, index):
+        # A piece assumed complete at startup failed validation, so download it again.
+        self.data_flunked(self._piecelen(index))
+        self.have[index] = False
+        self.lost[index] = 1
+        self.inactive_requests[index] = self._all_blocks(index)
+        self.amount_left += self._piecelen(index)
+        if not self.skipped[index]:
+            self.amount_inactive += self._piecelen(index)
+            # There are blocks to request again.
+            self.endgame = False
+        self.piece_lost(index)
+
+    def was_lost(self, index):
+        # Whether we told peers we have this piece before it failed validation.
+        return self.lost.has_key(index)
+
+    def verify_unchecked(self, amount):
+        # Validate pieces we have but have not validated, hashing up to about amount bytes on worker threads.
+        # Called in the background, so peers requesting these pieces later are not kept waiting.
+        # Returns whether any pieces are left to validate.
+        while self.next_unchecked < len(self.hashes):
+            i = self.next_unchecked
+            if self.have[i] and not self.waschecked[i]:
+                if amount <= 0 or self.diskio.is_full():
+                    return True
+                pos, length = self.piece_size * self.places[i], self._piecelen(i)
+                # Unless a peer requests it, this piece is only read this once.
+                self.storage.advise(pos, length, 'noreuse')
+                def done(result, error, self = self, i = i):
+                    if error is not None:
+                        self.failed('IO Error ' + str(error))
+                    elif not self.have[i] or self.waschecked[i]:
+                        # A peer requested the piece, which validated it meanwhile.
+                        pass
+                    elif result[1] == self.hashes[i]:
+                        self.waschecked[i] = True
+                    else:
+                        self._lose_piece(i)
+                self.diskio.submit(self._read_and_hash, (pos, length, True), done)
+                amount -= length
+            self.next_unchecked += 1
+        return False
+
+    def get_cache_stats(self):
+        # Returns how well the read and write caches are working.
+        return {'read hits': self.read_hits, 'read misses': self.read_misses,
+            'read cached': self.read_cache_bytes, 'write cached': self.dirty_bytes + self.held_bytes}
+
+    def get_failed_piece(self, index, begin, length):
+        # Read a block of a piece that failed validation, before its blocks are downloaded again.
+        try:
+            if self.have[index] or not self.places.has_key(index):
+                return None
+            if self.pending_writes.has_key(index):
+                self.diskio.drain()
+            return self.storage.read(self.piece_size * self.places[index] + begin, length)
+        except IOError, e:
+            self.failed('IO Error ' + str(e))
+            return None
 
 
 class DummyStorage:
@@ -327,6 +895,8 @@ class DummyStorage:
         self.ranges = ranges
         self.s = chr(0xFF) * total
         self.done = False
+        # The (pos, amount, hint) calls to advise.
+        self.hints = []
 
     def was_preexisting(self):
         return self.pre
@@ -337,6 +907,16 @@ class DummyStorage:
                 return True
         return False
 
+    def set_piece_size(self, piece_size):
+        self.piece_size = piece_size
+
+    def advise(self, pos, amount, hint):
+        self.hints.append((pos, amount, hint))
+
+    def was_piece_preallocated(self, index):
+        begin = index * self.piece_size
+        return self.was_preallocated(begin, min(self.piece_size, len(self.s) - begin))
+
     def get_total_length(self):
         return len(self.s)
 
@@ -455,9 +1035,27 @@ def test_hash_fail():
 def test_lazy_hashing():
     ds = DummyStorage(4, ranges = [(0, 4)])
     flag = Event()
-    sw = StorageWrapper(ds, 4, [sha('abcd').digest()], 4, ds.finished, lambda x, flag = flag: flag.set(), check_hashes = False)
+    lost = []
+    sw = StorageWrapper(ds, 4, [sha('abcd').digest()], 4, ds.finished, lambda x, flag = flag: flag.set(), check_hashes = False,
+        piece_lost = lost.append)
+    assert sw.get_piece(0, 0, 2) is None
+    # The piece is downloaded again instead of stopping the download.
+    assert not flag.isSet()
+    assert lost == [0]
+    assert sw.do_I_have_requests(0)
+
+def test_finished_once():
+    ds = DummyStorage(4, ranges = [(0, 4)])
+    done = []
+    sw = StorageWrapper(ds, 4, [sha('abcd').digest()], 4, lambda done = done: done.append(1), None,
+        check_hashes = False)
+    assert done == [1]
     assert sw.get_piece(0, 0, 2) is None
-    assert flag.isSet()
+    assert sw.new_request(0) == (0, 4)
+    assert sw.piece_came_in(0, 0, 'abcd')
+    assert sw.do_I_have(0)
+    # The download already finished before the piece was lost.
+    assert done == [1]
 
 def test_lazy_hashing_pass():
     ds = DummyStorage(4)
@@ -485,6 +1083,357 @@ def test_preexisting():
     assert not sw.do_I_have_requests(0)
     assert not sw.do_I_have_requests(1)
 
+def test_hash_threads():
+    # The preallocated segments hold pieces 3 and 1, and the last piece 4.
+    data = ['aa', 'bb', 'cc', 'dd', 'e']
+    ds = DummyStorage(9, True, [(0, 6)])
+    ds.s = 'ddbbex' + chr(0xFF) * 3
+    sw = StorageWrapper(ds, 2, [sha(x).digest() for x in data], 2, ds.finished, None,
+        hash_threads = 3)
+    assert sw.places == {3: 0, 1: 1, 4: 2}
+    assert sw.get_have_list() == chr(0x58)
+    assert sw.holes == [3, 4]
+    assert sw.get_amount_left() == 4
+
+def test_hash_threads_read_error():
+    ds = DummyStorage(4, True, [(0, 4)])
+    def read(begin, length):
+        raise IOError('bad sector')
+    ds.read = read
+    try:
+        StorageWrapper(ds, 2, [sha('ab').digest(), sha('cd').digest()], 2, ds.finished, None)
+        assert False
+    except IOError:
+        pass
+
+def test_resume():
+    from fakeopen import FakeOpen
+    from Storage import Storage
+    f = FakeOpen()
+    hashes = [sha('abcd').digest(), sha('efgh').digest(), sha('ijkl').digest()]
+    def make(resume = None, f = f, hashes = hashes):
+        storage = Storage([('a', 12)], f.open, f.exists, f.getsize, getmtime = f.getmtime)
+        return StorageWrapper(storage, 2, hashes, 4, lambda: None, None, resume = resume)
+    sw = make()
+    for i in xrange(2):
+        sw.new_request(2)
+    sw.piece_came_in(2, 0, 'ij')
+    sw.piece_came_in(2, 2, 'kl')
+    sw.new_request(0)
+    sw.piece_came_in(0, 0, 'ab')
+    assert sw.places == {0: 0, 2: 1}
+    resume = sw.get_resume_data(True)
+    # Nothing changed, so the pieces and written blocks are restored.
+    sw = make(resume)
+    assert sw.places == {0: 0, 2: 1}
+    assert sw.get_have_list() == chr(0x20)
+    assert sw.waschecked[2]
+    assert sw.new_request(0) == (2, 2)
+    assert not sw.do_I_have_requests(0)
+    assert sw.get_amount_left() == 8
+    # The file changed, so its segments are hashed again and the written block is forgotten.
+    f.mtimes['a'] += 1
+    sw = make(resume)
+    assert sw.places == {0: 0, 2: 1}
+    assert sw.get_have_list() == chr(0x20)
+    assert sw.new_request(0) == (0, 2)
+    # Resume data for another torrent is ignored.
+    resume['pieces'] = 4
+    assert make(resume).new_request(0) == (0, 2)
+
+def test_direct_allocation():
+    from fakeopen import FakeOpen
+    from Storage import Storage
+    f = FakeOpen()
+    hashes = [sha('abcd').digest(), sha('efgh').digest(), sha('ijkl').digest()]
+    storage = Storage([('a', 12)], f.open, f.exists, f.getsize)
+    sw = StorageWrapper(storage, 2, hashes, 4, lambda: None, None, allocation = 'direct')
+    for i in xrange(2):
+        sw.new_request(2)
+    sw.piece_came_in(2, 0, 'ij')
+    sw.piece_came_in(2, 2, 'kl')
+    # The piece is written at its own segment, leaving the segments before it unwritten.
+    assert sw.places == {2: 2}
+    assert f.files['a'][8:] == list('ijkl')
+    sw.new_request(0)
+    sw.piece_came_in(0, 0, 'ab')
+    assert sw.places == {0: 0, 2: 2}
+    # A piece at the wrong segment is not moved, only rehashed at its own.
+    f = FakeOpen({'a': list('ijklabcd\x00\x00\x00\x00')})
+    storage = Storage([('a', 12)], f.open, f.exists, f.getsize)
+    sw = StorageWrapper(storage, 2, hashes, 4, lambda: None, None, allocation = 'direct')
+    assert sw.places == {0: 0, 1: 1, 2: 2}
+    assert sw.get_have_list() == chr(0)
+
+def test_direct_resume():
+    from fakeopen import FakeOpen
+    from Storage import Storage
+    f = FakeOpen()
+    hashes = [sha(c * 2).digest() for c in 'abcd']
+    reads = []
+    def make(resume = None, f = f, hashes = hashes, reads = reads):
+        storage = Storage([('a', 8)], f.open, f.exists, f.getsize, getmtime = f.getmtime)
+        def read(pos, amount, reads = reads, old = storage.read):
+            reads.append((pos, amount))
+            return old(pos, amount)
+        storage.read = read
+        return StorageWrapper(storage, 2, hashes, 2, lambda: None, None, resume = resume,
+            allocation = 'direct')
+    sw = make()
+    sw.new_request(3)
+    sw.piece_came_in(3, 0, 'dd')
+    resume = sw.get_resume_data(True)
+    # Writing the last piece extended the file past the segments before it,
+    # but the resume data says they are empty, so none are read.
+    sw = make(resume)
+    assert reads == []
+    assert sw.get_have_list() == chr(0x10)
+    assert sw.places == {0: 0, 1: 1, 2: 2, 3: 3}
+    assert sw.get_amount_left() == 6
+    # The file changed, so its segments are hashed again.
+    f.mtimes['a'] += 1
+    sw = make(resume)
+    assert len(reads) == 8
+    assert sw.get_have_list() == chr(0x10)
+
+def test_write_cache():
+    from fakeopen import FakeOpen
+    from Storage import Storage
+    f = FakeOpen()
+    hashes = [sha('abcdef').digest(), sha('ghijkl').digest()]
+    storage = Storage([('a', 12)], f.open, f.exists, f.getsize)
+    writes = []
+    def write(pos, s, writes = writes, old = storage.write):
+        writes.append((pos, s))
+        old(pos, s)
+    storage.write = write
+    sw = StorageWrapper(storage, 2, hashes, 6, lambda: None, None,
+        allocation = 'direct', cache_size = 4)
+    for i in xrange(3):
+        sw.new_request(0)
+        sw.new_request(1)
+    sw.piece_came_in(0, 4, 'ef')
+    sw.piece_came_in(1, 2, 'ij')
+    # Blocks are held in memory until the cache is full.
+    assert writes == []
+    assert sw.dirty_bytes == 4
+    sw.piece_came_in(1, 0, 'gh')
+    # Then the piece with the most blocks is written, one write for each run of adjacent blocks.
+    assert writes == [(6, 'ghij')]
+    assert sw.dirty_bytes == 2
+    assert sw.written == {1: [(0, 2), (2, 2)]}
+    del writes[:]
+    sw.piece_came_in(0, 0, 'ab')
+    assert writes == []
+    sw.piece_came_in(0, 2, 'cd')
+    # A completed piece is written with one write before it is validated.
+    assert writes == [(0, 'abcdef')]
+    assert sw.do_I_have(0)
+    assert sw.dirty_bytes == 0
+    assert sw.get_piece(0, 0, 6) == 'abcdef'
+    sw.piece_came_in(1, 4, 'kl')
+    assert sw.do_I_have(1)
+
+def test_incremental_hash():
+    from fakeopen import FakeOpen
+    from Storage import Storage
+    f = FakeOpen()
+    hashes = [sha('abcdef').digest(), sha('ghijkl').digest()]
+    storage = Storage([('a', 12)], f.open, f.exists, f.getsize)
+    reads = []
+    def read(pos, amount, reads = reads, old = storage.read):
+        reads.append((pos, amount))
+        return old(pos, amount)
+    storage.read = read
+    sw = StorageWrapper(storage, 2, hashes, 6, lambda: None, None, allocation = 'direct',
+        cache_size = 6)
+    for i in xrange(3):
+        sw.new_request(0)
+        sw.new_request(1)
+    sw.piece_came_in(0, 4, 'ef')
+    sw.piece_came_in(0, 2, 'cd')
+    # Blocks after a missing block are kept until it arrives.
+    assert sw.hashers[0][1] == 0
+    sw.piece_came_in(0, 0, 'ab')
+    # The piece was validated without reading it back from disk.
+    assert sw.do_I_have(0)
+    assert reads == []
+    assert sw.hashers == {}
+    # A piece that fails validation is downloaded and hashed again.
+    sw.piece_came_in(1, 0, 'gh')
+    sw.piece_came_in(1, 2, 'xx')
+    sw.piece_came_in(1, 4, 'kl')
+    assert not sw.do_I_have(1)
+    for i in xrange(3):
+        sw.new_request(1)
+    sw.piece_came_in(1, 0, 'gh')
+    sw.piece_came_in(1, 2, 'ij')
+    sw.piece_came_in(1, 4, 'kl')
+    assert sw.do_I_have(1)
+    assert reads == []
+
+def test_held_blocks_count_toward_cache():
+    from fakeopen import FakeOpen
+    from Storage import Storage
+    f = FakeOpen()
+    hashes = [sha('abcdef').digest(), sha('ghijkl').digest()]
+    storage = Storage([('a', 12)], f.open, f.exists, f.getsize)
+    reads = []
+    def read(pos, amount, reads = reads, old = storage.read):
+        reads.append((pos, amount))
+        return old(pos, amount)
+    storage.read = read
+    sw = StorageWrapper(storage, 2, hashes, 6, lambda: None, None, allocation = 'direct',
+        cache_size = 4)
+    for i in xrange(3):
+        sw.new_request(0)
+        sw.new_request(1)
+    sw.piece_came_in(0, 4, 'ef')
+    sw.piece_came_in(0, 2, 'cd')
+    sw.flush()
+    # The written blocks are still held in memory until the missing block arrives.
+    assert sw.dirty_bytes == 0
+    assert sw.held_bytes == 4
+    sw.piece_came_in(1, 2, 'ij')
+    # Together they exceed the cache, so the blocks held longest are let go.
+    assert sw.dirty_bytes + sw.held_bytes <= 4
+    assert not sw.hashers.has_key(0)
+    sw.piece_came_in(0, 0, 'ab')
+    # The piece is read back from disk to validate it.
+    assert reads == [(0, 6)]
+    assert sw.do_I_have(0)
+    assert sw.held_bytes == 0
+
+def test_read_cache():
+    from fakeopen import FakeOpen
+    from Storage import Storage
+    f = FakeOpen({'a': list('abcdefghijkl')})
+    hashes = [sha('abcd').digest(), sha('efgh').digest(), sha('ijkl').digest()]
+    storage = Storage([('a', 12)], f.open, f.exists, f.getsize)
+    reads = []
+    def read(pos, amount, reads = reads, old = storage.read):
+        reads.append((pos, amount))
+        return old(pos, amount)
+    storage.read = read
+    sw = StorageWrapper(storage, 2, hashes, 4, lambda: None, None, read_cache_size = 8)
+    del reads[:]
+    # The whole piece is read once for its first block.
+    assert sw.get_piece(0, 0, 2) == 'ab'
+    assert sw.get_piece(0, 2, 2) == 'cd'
+    assert reads == [(0, 4)]
+    assert sw.get_piece(1, 0, 2) == 'ef'
+    assert sw.get_piece(0, 0, 2) == 'ab'
+    # Piece 1 was read least recently, so it's forgotten.
+    assert sw.get_piece(2, 2, 2) == 'kl'
+    assert sw.read_order == [0, 2]
+    assert sw.get_piece(0, 2, 4) == None
+    stats = sw.get_cache_stats()
+    assert stats['read hits'] == 3
+    assert stats['read misses'] == 3
+    assert stats['read cached'] == 8
+
+def test_block_bitmap():
+    ds = DummyStorage(5)
+    sw = StorageWrapper(ds, 2, [sha('abcde').digest()], 5, ds.finished, None)
+    assert sw.inactive_requests == [7]
+    assert sw.new_request(0) == (0, 2)
+    assert sw.new_request(0) == (2, 2)
+    assert sw.new_request(0) == (4, 1)
+    assert not sw.do_I_have_requests(0)
+    # A lost block is requested again before the blocks after it.
+    sw.request_lost(0, 4, 1)
+    sw.request_lost(0, 2, 2)
+    assert sw._inactive_length(0) == 3
+    assert sw.new_request(0) == (2, 2)
+    assert sw.numactive[0] == 2
+    assert sw._inactive_length(0) == 1
+
+def test_diskio():
+    from fakeopen import FakeOpen
+    from Storage import Storage
+    f = FakeOpen({'a': list('abcd\x00\x00\x00\x00')})
+    hashes = [sha('abcd').digest(), sha('efgh').digest()]
+    storage = Storage([('a', 8)], f.open, f.exists, f.getsize)
+    tasks = []
+    diskio = DiskIO(1, lambda func, delay, tasks = tasks: tasks.append(func))
+    sw = StorageWrapper(storage, 2, hashes, 4, lambda: None, None,
+        check_hashes = False, allocation = 'direct', diskio = diskio)
+    sw.new_request(1)
+    sw.new_request(1)
+    sw.piece_came_in(1, 0, 'ef')
+    sw.piece_came_in(1, 2, 'gh')
+    assert sw.do_I_have(1)
+    # Reading the piece just downloaded waits for it to be written.
+    result = []
+    sw.get_piece_async(1, 2, 2, result.append)
+    diskio.drain()
+    assert result == []
+    while tasks:
+        tasks.pop(0)()
+        diskio.drain()
+    assert result == ['gh']
+    assert f.files['a'] == list('abcdefgh')
+    # A piece not validated at startup is validated on the worker thread.
+    assert not sw.waschecked[0]
+    sw.get_piece_async(0, 0, 2, result.append)
+    diskio.drain()
+    tasks.pop(0)()
+    assert result == ['gh', 'ab']
+    assert sw.waschecked[0]
+    diskio.stop()
+
+def test_verify_unchecked():
+    from fakeopen import FakeOpen
+    from Storage import Storage
+    f = FakeOpen({'a': list('abcdefghijxx')})
+    hashes = [sha('abcd').digest(), sha('efgh').digest(), sha('ijkl').digest()]
+    storage = Storage([('a', 12)], f.open, f.exists, f.getsize)
+    failed = []
+    lost = []
+    flunked = []
+    tasks = []
+    diskio = DiskIO(1, lambda func, delay, tasks = tasks: tasks.append(func))
+    sw = StorageWrapper(storage, 2, hashes, 4, lambda: None, failed.append, check_hashes = False,
+        data_flunked = flunked.append, diskio = diskio, piece_lost = lost.append)
+    assert sw.waschecked.tolist() == [False, False, False]
+    # Each call validates pieces until about the given number of bytes are hashed, on a worker thread.
+    assert sw.verify_unchecked(3)
+    diskio.drain()
+    assert sw.waschecked.tolist() == [False, False, False]
+    tasks.pop()()
+    assert sw.waschecked.tolist() == [True, False, False]
+    assert sw.verify_unchecked(4)
+    # The last piece is corrupted, so it is downloaded again instead of stopping the download.
+    assert not sw.verify_unchecked(4)
+    diskio.drain()
+    for func in tasks:
+        func()
+    diskio.stop()
+    assert sw.waschecked.tolist() == [True, True, False]
+    assert failed == []
+    assert lost == [2]
+    assert flunked == [4]
+    assert sw.get_have_list() == chr(0xC0)
+    assert sw.get_amount_left() == 4
+    assert sw.was_lost(2) and not sw.was_lost(1)
+    assert sw.get_piece(2, 0, 2) is None
+    assert sw.new_request(2) == (0, 2)
+    assert sw.new_request(2) == (2, 2)
+    sw.piece_came_in(2, 0, 'ij')
+    sw.piece_came_in(2, 2, 'kl')
+    assert sw.get_amount_left() == 0
+    assert sw.get_piece(2, 0, 4) == 'ijkl'
+
+def test_advise():
+    ds = DummyStorage(4, True, [(0, 4)])
+    sw = StorageWrapper(ds, 2, [sha(chr(0xFF) * 2).digest(), sha('ab').digest()], 2, ds.finished, None)
+    # Existing data is read sequentially and then dropped from the page cache.
+    assert ds.hints == [(0, 4, 'sequential'), (0, 2, 'dontneed'), (0, 4, 'dontneed'), (0, 4, 'normal')]
+    del ds.hints[:]
+    sw.will_read(0, 1, 1)
+    sw.will_read(1, 0, 2)
+    assert ds.hints == [(1, 1, 'willneed')]
+
 def test_total_too_short():
     ds = DummyStorage(4)
     try:
@@ -561,6 +1510,29 @@ def test_not_last_pre():
     assert sw.do_I_have_requests(0)
     assert sw.do_I_have_requests(2)
 
+def test_skipped():
+    ds = DummyStorage(4)
+    sw = StorageWrapper(ds, 1, [sha('a').digest(), sha('b').digest(), 
+        sha('c').digest(), sha('d').digest()], 1, ds.finished, None)
+    sw.set_skipped(0, True)
+    sw.set_skipped(1, True)
+    assert not sw.do_I_have_requests(0)
+    assert sw.do_I_have_requests(2)
+    assert sw.new_request(3) == (0, 1)
+    # Pieces are not written into the segments of skipped pieces.
+    sw.piece_came_in(3, 0, 'd')
+    assert ds.s == chr(0xFF) * 2 + 'd' + chr(0xFF)
+    assert not sw.is_endgame()
+    assert sw.new_request(2) == (0, 1)
+    assert sw.is_endgame()
+    sw.set_skipped(1, False)
+    assert not sw.is_endgame()
+    assert sw.do_I_have_requests(1)
+    assert sw.new_request(1) == (0, 1)
+    sw.piece_came_in(2, 0, 'c')
+    sw.piece_came_in(1, 0, 'b')
+    assert ds.s[1:] == 'bcd'
+
 def test_last_piece_not_pre():
     ds = DummyStorage(51, ranges = [(50, 1)])
     sw = StorageWrapper(ds, 2, [sha('aa').digest()] * 25 + [sha('b').digest()], 2, ds.finished, None)
@@ -0,0 +1,277 @@
+# see LICENSE.txt for license information
+
+from threading import Event
+from time import time
+
+class StreamReader:
+    """A file-like object that reads a byte range of the torrent while it downloads.
+
+    Reads block until the pieces they cover have been downloaded and validated.
+    May be used from any thread; all storage access happens in the reactor loop, so the
+    Streamer must be given a scheduling function that wakes it, RawServer.external_add_task."""
+
+    def __init__(self, streamer, begin, length):
+        # The Streamer instance.
+        self.streamer = streamer
+        # The offset of the first byte of the stream in the torrent.
+        self.begin = begin
+        # The number of bytes in the stream.
+        self.length = length
+        # The position of the next byte to read, relative to begin.
+        self.pos = 0
+        self.closed = False
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence = 0):
+        if self.closed:
+            raise ValueError('I/O operation on closed stream')
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.length
+        if offset < 0:
+            raise IOError('negative seek')
+        self.pos = offset
+        # Download the pieces after the new position first.
+        self.streamer.moved(self, offset)
+
+    def read(self, amount = -1):
+        if self.closed:
+            raise ValueError('I/O operation on closed stream')
+        if amount < 0 or self.pos + amount > self.length:
+            # Read until the end of the stream.
+            amount = max(0, self.length - self.pos)
+        if amount == 0:
+            return ''
+        result = []
+        done = Event()
+        self.streamer.request_read(self, self.pos, amount, result, done)
+        while not done.isSet():
+            done.wait(1)
+            if not done.isSet() and self.streamer.doneflag.isSet():
+                raise IOError('download stopped')
+        if result[0] is None:
+            raise IOError('could not read downloaded data')
+        self.pos += amount
+        self.streamer.moved(self, self.pos)
+        return result[0]
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.streamer.close(self)
+
+
+class Streamer:
+    def __init__(self, storagewrapper, picker, downloader, sched, doneflag,
+            piece_size, total_length, window, piece_time, duplicate_time):
+        # The StorageWrapper instance.
+        self.storagewrapper = storagewrapper
+        # The PiecePicker instance.
+        self.picker = picker
+        # The Downloader instance.
+        self.downloader = downloader
+        # Function to schedule events in the reactor loop of RawServer from other threads,
+        # which must wake the loop so reads don't wait for polling to time out.
+        self.sched = sched
+        # Threading Event object set once the download stops.
+        self.doneflag = doneflag
+        self.piece_size = piece_size
+        # The total bytes in the torrent.
+        self.total_length = total_length
+        # The number of pieces after each reader's position to download first.
+        self.window = window
+        # The number of seconds apart the deadlines of consecutive pieces in a window are.
+        self.piece_time = piece_time
+        # Pieces due within this many seconds are requested from several peers at once.
+        self.duplicate_time = duplicate_time
+        # Maps each open StreamReader to its position, relative to its first byte.
+        self.positions = {}
+        # (reader, pos, amount, result, done) tuples for reads waiting on pieces.
+        self.waiting = []
+        # Maps each piece we gave a deadline to in the PiecePicker to that deadline.
+        self.deadlines = {}
+        # Whether _update is already scheduled to run in the reactor loop.
+        self.update_scheduled = False
+
+    def open(self, begin = 0, length = None):
+        # Returns a StreamReader over length bytes of the torrent starting at begin.
+        if length is None:
+            length = self.total_length - begin
+        if begin < 0 or length < 0 or begin + length > self.total_length:
+            raise ValueError('stream extends outside of torrent')
+        r = StreamReader(self, begin, length)
+        self.moved(r, 0)
+        return r
+
+    def moved(self, reader, pos):
+        def foo(self = self, reader = reader, pos = pos):
+            if not reader.closed:
+                self.positions[reader] = pos
+                self._schedule_update()
+        self.sched(foo, 0)
+
+    def close(self, reader):
+        def foo(self = self, reader = reader):
+            try:
+                del self.positions[reader]
+            except KeyError:
+                pass
+            self._try_reads()
+            self._schedule_update()
+        self.sched(foo, 0)
+
+    def request_read(self, reader, pos, amount, result, done):
+        def foo(self = self, w = (reader, pos, amount, result, done)):
+            self.waiting.append(w)
+            self._try_reads()
+            if self.waiting:
+                # Pieces a reader is blocked on are due immediately.
+                self._update()
+        self.sched(foo, 0)
+
+    def piece_finished(self, index):
+        # Called by StorageWrapper once a piece has been downloaded and validated.
+        if self.waiting:
+            self._try_reads()
+        if self.deadlines.has_key(index):
+            self._schedule_update()
+
+    def _pieces(self, begin, amount):
+        # Returns the indexes of the first and last piece covering the given byte range.
+        return begin // self.piece_size, (begin + amount - 1) // self.piece_size
+
+    def _try_reads(self):
+        # Complete each waiting read whose pieces have all been validated.
+        still_waiting = []
+        for w in self.waiting:
+            reader, pos, amount, result, done = w
+            if reader.closed:
+                result.append(None)
+                done.set()
+                continue
+            begin = reader.begin + pos
+            first, last = self._pieces(begin, amount)
+            for i in xrange(first, last + 1):
+                if not self.storagewrapper.do_I_have(i):
+                    break
+            else:
+                result.append(self._read(begin, amount))
+                done.set()
+                continue
+            still_waiting.append(w)
+        self.waiting = still_waiting
+
+    def _read(self, begin, amount):
+        # Read the given byte range, one piece at a time.
+        r = []
+        first, last = self._pieces(begin, amount)
+        for i in xrange(first, last + 1):
+            start = i * self.piece_size
+            b = max(begin, start)
+            e = min(begin + amount, start + self.piece_size)
+            data = self.storagewrapper.get_piece(i, b - start, e - b)
+            if data is None:
+                return None
+            r.append(data)
+        return ''.join(r)
+
+    def _schedule_update(self):
+        if not self.update_scheduled:
+            self.update_scheduled = True
+            self.sched(self._update, 0)
+
+    def _update(self):
+        # Give the pieces after each reader's position deadlines, spaced piece_time apart.
+        self.update_scheduled = False
+        now = time()
+        deadlines = {}
+        def need(i, d, deadlines = deadlines, self = self):
+            if self.storagewrapper.do_I_have(i):
+                return
+            if not deadlines.has_key(i) or d < deadlines[i]:
+                deadlines[i] = d
+        for reader, pos in self.positions.items():
+            if pos >= reader.length:
+                continue
+            first, last = self._pieces(reader.begin + pos, reader.length - pos)
+            for i in xrange(first, min(last, first + self.window - 1) + 1):
+                need(i, now + (i - first) * self.piece_time)
+        for reader, pos, amount, result, done in self.waiting:
+            # A reader is blocked on these pieces, so they're due now.
+            first, last = self._pieces(reader.begin + pos, amount)
+            for i in xrange(first, last + 1):
+                need(i, now)
+        for i in self.deadlines.keys():
+            if not deadlines.has_key(i):
+                self.picker.clear_deadline(i)
+        for i, d in deadlines.items():
+            self.picker.set_deadline(i, d)
+        self.deadlines = deadlines
+        # Request the pieces due soonest from several peers, whichever sends them first.
+        self.downloader.set_urgent(self.picker.get_urgent(now + self.duplicate_time))
+
+
+# everything below is for testing
+
+from sha import sha
+from threading import Thread
+from fakeopen import FakeOpen
+from Storage import Storage
+from StorageWrapper import StorageWrapper
+from PiecePicker import PiecePicker
+
+class DummyDownloader:
+    def __init__(self, urgent):
+        self.urgent = urgent
+
+    def set_urgent(self, pieces):
+        self.urgent.append(pieces)
+
+def test_stream():
+    f = FakeOpen()
+    storage = Storage([('a', 6)], f.open, f.exists, f.getsize)
+    finished = []
+    sw = StorageWrapper(storage, 2, [sha('ab').digest(), sha('cd').digest(),
+        sha('ef').digest()], 2, lambda: None, None,
+        piece_finished = lambda i, finished = finished: finished[0](i))
+    picker = PiecePicker(3)
+    urgent = []
+    s = Streamer(sw, picker, DummyDownloader(urgent), lambda f, delay: f(), Event(),
+        2, 6, 2, 1.0, 0.5)
+    finished.append(s.piece_finished)
+    r = s.open(1, 4)
+    # The first two pieces of the stream are due, and the first is urgent.
+    x = picker.deadlines.keys()
+    x.sort()
+    assert x == [0, 1]
+    assert urgent[-1] == [0]
+
+    result = []
+    t = Thread(target = lambda r = r, result = result: result.append(r.read(3)))
+    t.start()
+    t.join(.5)
+    # The read blocks until pieces 0 and 1 are validated.
+    assert result == []
+    assert t.isAlive()
+    for i, data in [(1, 'cd'), (0, 'ab')]:
+        sw.new_request(i)
+        sw.piece_came_in(i, 0, data)
+    t.join(5)
+    assert result == ['bcd']
+    assert r.tell() == 3
+    assert picker.deadlines.keys() == [2]
+    r.seek(0)
+    assert r.read(2) == 'bc'
+    r.close()
+    assert picker.deadlines == {}
+
+def test_open_outside():
+    s = Streamer(None, None, None, lambda f, delay: None, Event(), 2, 6, 2, 1.0, 0.5)
+    try:
+        s.open(4, 3)
+        assert False
+    except ValueError:
+        pass
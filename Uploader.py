@@ -17,6 +17,10 @@ class Upload:
         self.interested = False
         # (index, begin, length) tuples the peer has requested from this client.
         self.buffer = []
+        # Whether a requested block is being read from disk, so is not in buffer.
+        self.reading = False
+        # Whether flushed is running, so a block read in the meantime need not call it again.
+        self.flushing = False
         self.measure = Measure(max_rate_period, fudge)
         # Send our bitfield to the peer if we have any pieces.
         if storage.do_I_have_anything():
@@ -37,16 +41,44 @@ class Upload:
 
     def flushed(self):
         # Send each requested (index, begin, length) part until there is backpressure.
-        while len(self.buffer) > 0 and self.connection.is_flushed():
+        # Blocks are read from disk one at a time, and sent once each read completes.
+        if self.connection.closed:
+            return
+        self.flushing = True
+        while len(self.buffer) > 0 and self.connection.is_flushed() and not self.reading:
+            if self.storage.is_disk_busy():
+                # The disk has fallen behind, so send more once it catches up.
+                self.storage.when_disk_free(self.flushed)
+                break
             index, begin, length = self.buffer[0]
             del self.buffer[0]
-            piece = self.storage.get_piece(index, begin, length)
-            if piece is None:
-                # The peer requested a bad piece, so we're done.
-                self.connection.close()
+            self.reading = True
+            def read(piece, self = self, index = index, begin = begin):
+                self._piece_read(index, begin, piece)
+            self.storage.get_piece_async(index, begin, length, read)
+        self.flushing = False
+
+    def _piece_read(self, index, begin, piece):
+        self.reading = False
+        if self.connection.closed:
+            return
+        if piece is None:
+            if self.storage.was_lost(index):
+                # We told the peer we have this piece before it failed validation, so skip the request.
+                if not self.flushing:
+                    self.flushed()
                 return
-            self.measure.update_rate(len(piece))
-            self.connection.send_piece(index, begin, piece)
+            # The peer requested a bad piece, so we're done.
+            self.connection.close()
+            return
+        if self.choked:
+            # The peer was choked while the block was read, which cancels its requests.
+            return
+        self.measure.update_rate(len(piece))
+        self.connection.send_piece(index, begin, piece)
+        if not self.flushing:
+            # The block was read on another thread, so continue sending.
+            self.flushed()
 
     def got_request(self, index, begin, length):
         if not self.interested or length > self.max_slice_length:
@@ -58,6 +90,9 @@ class Upload:
             # We're not choking this peer, so enqueue and then try to fulfill the request.
             self.buffer.append((index, begin, length))
             self.flushed()
+            if self.buffer:
+                # The block waits behind others, so have the disk start reading it now.
+                self.storage.will_read(index, begin, length)
 
     def got_cancel(self, index, begin, length):
         try:
@@ -98,6 +133,7 @@ class DummyConnection:
     def __init__(self, events):
         self.events = events
         self.flushed = False
+        self.closed = False
 
     def send_bitfield(self, bitfield):
         self.events.append(('bitfield', bitfield))
@@ -130,6 +166,11 @@ class DummyChoker:
 class DummyStorage:
     def __init__(self, events):
         self.events = events
+        # If a list, reads complete only once their callbacks are popped from it.
+        self.pending = None
+        self.busy = False
+        # The blocks will_read was called with.
+        self.hinted = []
 
     def do_I_have_anything(self):
         self.events.append('do I have')
@@ -145,6 +186,24 @@ class DummyStorage:
             return None
         return 'a' * length
 
+    def get_piece_async(self, index, begin, length, callback):
+        if self.pending is not None:
+            self.pending.append((callback, self.get_piece(index, begin, length)))
+        else:
+            callback(self.get_piece(index, begin, length))
+
+    def is_disk_busy(self):
+        return self.busy
+
+    def when_disk_free(self, func):
+        self.events.append('wait for disk')
+
+    def will_read(self, index, begin, length):
+        self.hinted.append((index, begin, length))
+
+    def was_lost(self, index):
+        return index == 5
+
 def test_skip_over_choke():
     events = []
     dco = DummyConnection(events)
@@ -292,3 +351,66 @@ def test_no_bitfield_on_start_empty():
     ds.do_I_have_anything = lambda: False
     u = Upload(dco, dch, ds, 100, 20, 5)
     assert events == []
+
+def test_reads_one_block_at_a_time():
+    events = []
+    dco = DummyConnection(events)
+    dch = DummyChoker(events)
+    ds = DummyStorage(events)
+    ds.pending = []
+    u = Upload(dco, dch, ds, 100, 20, 5)
+    u.unchoke()
+    u.got_interested()
+    dco.flushed = True
+    u.got_request(0, 1, 3)
+    u.got_request(0, 4, 2)
+    del events[:]
+    # The second block is only read once the first is sent.
+    assert events == []
+    callback, piece = ds.pending.pop(0)
+    assert ds.pending == []
+    callback(piece)
+    assert events == [('piece', 0, 1, 'aaa'), ('get piece', 0, 4, 2)]
+    # A block read after the peer was choked is not sent.
+    u.choke()
+    callback, piece = ds.pending.pop(0)
+    callback(piece)
+    assert events[-1] == 'choke'
+
+def test_skips_lost_piece():
+    events = []
+    dco = DummyConnection(events)
+    dch = DummyChoker(events)
+    ds = DummyStorage(events)
+    ds.pending = []
+    u = Upload(dco, dch, ds, 100, 20, 5)
+    u.unchoke()
+    u.got_interested()
+    dco.flushed = True
+    u.got_request(5, 0, 4)
+    u.got_request(0, 0, 2)
+    callback, piece = ds.pending.pop(0)
+    # We had piece 5 before it failed validation, so the request is skipped without closing.
+    callback(piece)
+    callback, piece = ds.pending.pop(0)
+    callback(piece)
+    assert 'closed' not in events
+    assert events[-1] == ('piece', 0, 0, 'aa')
+
+def test_waits_for_disk():
+    events = []
+    dco = DummyConnection(events)
+    dch = DummyChoker(events)
+    ds = DummyStorage(events)
+    ds.busy = True
+    u = Upload(dco, dch, ds, 100, 20, 5)
+    u.unchoke()
+    u.got_interested()
+    dco.flushed = True
+    u.got_request(0, 1, 3)
+    assert events[-1] == 'wait for disk'
+    # The disk is told to start reading the waiting block.
+    assert ds.hinted == [(0, 1, 3)]
+    ds.busy = False
+    u.flushed()
+    assert events[-1] == ('piece', 0, 1, 'aaa')
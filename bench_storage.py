@@ -0,0 +1,319 @@
+# see LICENSE.txt for license information
+
+# Times Storage reads with and without pread, measures how much of the page cache checking
+# existing data leaves behind with and without posix_fadvise hints, and how often each piece picker
+# picks pieces next to cached data. Also reports the memory StorageWrapper uses per piece to track
+# requested blocks, and times starting a download of 100,000 files with and without Storage's index of
+# the files each piece overlaps. Linux only, since it calls the C library directly to read which pages
+# are cached.
+#
+# python bench_storage.py [directory]
+#
+# The directory should be on a disk-backed filesystem; tmpfs ignores the hints. Without memory
+# pressure data being seeded stays cached either way, so to see checking evict it run this in a
+# memory cgroup limited to less than the 160 MiB of files it checks and seeds.
+
+from ctypes import CDLL, c_int, c_longlong, c_size_t, c_void_p, c_ubyte
+from ctypes.util import find_library
+from threading import Thread, Event
+from random import Random
+from time import time
+from sha import sha
+from os import open as os_open, close, fstat, remove, rmdir, fsync, O_RDONLY
+from os.path import join, exists, getsize
+from sys import getsizeof
+from tempfile import mkdtemp
+import sys
+from Storage import Storage, HandlePool, pread, posix_fadvise, advice
+from StorageWrapper import StorageWrapper
+from PiecePicker import PiecePicker, strategies
+from fakeopen import FakeOpen
+
+libc = CDLL(find_library('c'))
+libc.mmap.argtypes = [c_void_p, c_size_t, c_int, c_int, c_int, c_longlong]
+libc.mmap.restype = c_void_p
+libc.munmap.argtypes = [c_void_p, c_size_t]
+libc.mincore.argtypes = [c_void_p, c_size_t, c_void_p]
+
+PAGE = 4096
+PROT_READ = 1
+MAP_SHARED = 1
+
+def map_file(filename):
+    # Maps the file into memory, to ask which of its pages are cached. Returns (address, size).
+    fd = os_open(filename, O_RDONLY)
+    try:
+        size = fstat(fd).st_size
+        return libc.mmap(None, size, PROT_READ, MAP_SHARED, fd, 0), size
+    finally:
+        close(fd)
+
+def cached(addr, pos, amount):
+    # The fraction of amount bytes at page-aligned pos in a mapped file that are in the page cache.
+    vec = (c_ubyte * ((amount + PAGE - 1) / PAGE))()
+    libc.mincore(addr + pos, amount, vec)
+    return sum([v & 1 for v in vec]) / float(len(vec))
+
+def resident(filename):
+    # The fraction of the file's pages in the page cache.
+    addr, size = map_file(filename)
+    try:
+        return cached(addr, 0, size)
+    finally:
+        libc.munmap(addr, size)
+
+def drop(filename):
+    # Write the file out and evict it from the page cache.
+    fd = os_open(filename, O_RDONLY)
+    try:
+        fsync(fd)
+        posix_fadvise(fd, 0, 0, advice['dontneed'])
+    finally:
+        close(fd)
+
+def make_file(filename, length, seed):
+    # Random data, so the pieces hash differently.
+    r = Random(seed)
+    f = open(filename, 'wb')
+    for i in xrange(0, length, 1 << 20):
+        f.write(''.join([chr(r.randrange(256)) for k in xrange(256)]) * 4096)
+    f.close()
+
+def read_all(filename):
+    f = open(filename, 'rb')
+    while f.read(1 << 20):
+        pass
+    f.close()
+
+def time_reads(files, positional, numthreads, reads, cold, block = 2 ** 14):
+    # Seconds for numthreads threads to each read reads random blocks, from disk if cold.
+    if cold:
+        for file, length in files:
+            drop(file)
+    s = Storage(files, open, exists, getsize, pool = HandlePool())
+    s.positional = positional
+    total = s.total_length
+    def run(seed, s = s, total = total, reads = reads, block = block):
+        r = Random(seed)
+        for i in xrange(reads):
+            s.read(r.randrange(total / block) * block, block)
+    threads = [Thread(target = run, args = [k]) for k in xrange(numthreads)]
+    t = time()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    t = time() - t
+    s.close()
+    return t
+
+def check(files, hashes, piece_size, fadvise):
+    # Seconds for StorageWrapper to check the files against hashes on two threads.
+    s = Storage(files, open, exists, getsize, pool = HandlePool(), fadvise = fadvise)
+    def finished():
+        pass
+    def failed(reason):
+        raise ValueError(reason)
+    t = time()
+    sw = StorageWrapper(s, 2 ** 14, hashes, piece_size, finished, failed, flag = Event(),
+        hash_threads = 2)
+    t = time() - t
+    assert sw.get_amount_left() == 0
+    s.close()
+    return t
+
+def bench_reads(dir):
+    # Two files, so some blocks span both.
+    files = [(join(dir, 'a'), 24 << 20), (join(dir, 'b'), 40 << 20)]
+    for i in xrange(len(files)):
+        make_file(files[i][0], files[i][1], i)
+        read_all(files[i][0])
+    print 'random 16 KiB reads of 64 MiB, 2000 per thread cached and 200 per thread from disk'
+    print 'threads  cached seek  cached pread  disk seek  disk pread'
+    for numthreads in (1, 2, 4, 8):
+        r = [numthreads]
+        for cold, reads in ((False, 2000), (True, 200)):
+            for positional in (False, True):
+                r.append(min([time_reads(files, positional, numthreads, reads, cold)
+                    for k in xrange(3)]))
+        print '%7d  %10.3fs  %11.3fs  %8.3fs  %9.3fs' % tuple(r)
+    for file, length in files:
+        remove(file)
+
+def bench_check(dir):
+    piece_size = 2 ** 18
+    torrent = join(dir, 'torrent')
+    seeding = join(dir, 'seeding')
+    make_file(torrent, 128 << 20, 2)
+    make_file(seeding, 32 << 20, 3)
+    f = open(torrent, 'rb')
+    hashes = []
+    while 1:
+        s = f.read(piece_size)
+        if not s:
+            break
+        hashes.append(sha(s).digest())
+    f.close()
+    print 'checking 128 MiB with 32 MiB being seeded in the page cache'
+    print 'hints  check time  checked data cached  seeded data cached  reread seeded'
+    for fadvise in (False, True):
+        drop(torrent)
+        read_all(seeding)
+        t = check([(torrent, 128 << 20)], hashes, piece_size, fadvise)
+        a = resident(torrent)
+        b = resident(seeding)
+        r = time()
+        read_all(seeding)
+        r = time() - r
+        print '%5s  %9.3fs  %18.1f%%  %17.1f%%  %12.3fs' % (fadvise and 'on' or 'off', t,
+            a * 100, b * 100, r)
+    remove(torrent)
+    remove(seeding)
+
+def pick_download(filename, name, peers, data, numpieces):
+    # Downloads a piece of data at a time from each peer in turn, picking pieces with the named
+    # strategy. Returns the seconds spent writing and the pieces picked next to a cached piece.
+    piece_size = len(data)
+    f = open(filename, 'wb')
+    f.truncate(numpieces * piece_size)
+    f.close()
+    s = Storage([(filename, numpieces * piece_size)], open, exists, getsize, pool = HandlePool())
+    picker = PiecePicker(numpieces, 1, strategies[name]())
+    for have in peers:
+        for i in xrange(numpieces):
+            if have[i]:
+                picker.got_have(i)
+    addr, size = map_file(filename)
+    near = 0
+    t = 0
+    k = 0
+    while not picker.am_I_complete():
+        have = peers[k % len(peers)]
+        k += 1
+        i = picker.next(lambda i, have = have: have[i])
+        if i is None:
+            continue
+        for j in (i - 1, i + 1):
+            if 0 <= j < numpieces and cached(addr, j * piece_size, piece_size) == 1:
+                near += 1
+                break
+        picker.requested(i)
+        w = time()
+        s.write(i * piece_size, data)
+        t += time() - w
+        picker.complete(i)
+    w = time()
+    s.flush()
+    s.close()
+    # Include writing the data out, which is where the order of writes matters.
+    drop(filename)
+    t += time() - w
+    libc.munmap(addr, size)
+    remove(filename)
+    return t, near
+
+def bench_pickers(dir):
+    numpieces = 1024
+    r = Random(4)
+    data = ''.join([chr(r.randrange(256)) for k in xrange(256)]) * 1024
+    # Eight peers each have a random half of the pieces, and every piece is on at least one.
+    peers = [[r.randrange(2) for i in xrange(numpieces)] for k in xrange(8)]
+    for i in xrange(numpieces):
+        peers[r.randrange(8)][i] = 1
+    print 'downloading 256 MiB in 256 KiB pieces from 8 peers with each piece picker, best time of 3 runs'
+    print 'picker      write time  picked next to a cached piece'
+    for name in ('rarest', 'sequential', 'cached'):
+        results = [pick_download(join(dir, 'picked'), name, peers, data, numpieces)
+            for k in xrange(3)]
+        t = min([x[0] for x in results])
+        near = sum([x[1] for x in results]) / 3.0
+        print '%-10s  %9.3fs  %28.1f%%' % (name, t, near * 100.0 / numpieces)
+
+def size(obj, seen):
+    # Bytes of obj and the lists and tuples in it as sys.getsizeof reports them, counting each once.
+    if seen.has_key(id(obj)):
+        return 0
+    seen[id(obj)] = 1
+    n = getsizeof(obj)
+    if type(obj) in (list, tuple):
+        for x in obj:
+            n += size(x, seen)
+    return n
+
+def bench_piece_state():
+    numpieces = 2 ** 20
+    piece_size = 2 ** 18
+    request_size = 2 ** 14
+    # A download of 256 GiB that hasn't started, with nothing on disk.
+    f = FakeOpen()
+    s = Storage([('a', numpieces * piece_size)], f.open, f.exists, f.getsize)
+    sw = StorageWrapper(s, request_size, [chr(0) * 20] * numpieces, piece_size, None, None)
+    new = size([sw.inactive_requests, sw.numactive, sw.waschecked], {})
+    # What the same state took before: a list of the sentinel 1 for each piece, a list of how many
+    # blocks are requested, and a list of whether each piece was checked.
+    old = size([[1] * numpieces, [0] * numpieces, [True] * numpieces], {})
+    # A piece with one of its 16 blocks requested.
+    sw.new_request(0)
+    newpiece = size(sw.inactive_requests[0], {})
+    rs = [(begin, request_size) for begin in xrange(0, piece_size, request_size)]
+    rs.remove(min(rs))
+    oldpiece = size(rs, {})
+    print 'block request state of 2 ** 20 pieces of 16 blocks'
+    print '                             before      after'
+    print 'bytes per piece          %9.1f  %9.1f' % (old / float(numpieces), new / float(numpieces))
+    print 'bytes per started piece  %9d  %9d' % (oldpiece, newpiece)
+
+def time_startup(files, exists, getsize, piece_size, indexed):
+    # Seconds to open Storage and tell which pieces were preallocated twice over, as StorageWrapper
+    # does at startup, and seconds to find the files of each block. Without the index, the checks
+    # go through was_preallocated and each lookup searches all files.
+    t = time()
+    s = Storage(files, open, exists, getsize)
+    total = s.get_total_length()
+    numpieces = (total + piece_size - 1) / piece_size
+    if indexed:
+        s.set_piece_size(piece_size)
+        for k in xrange(2):
+            for i in xrange(numpieces):
+                s.was_piece_preallocated(i)
+    else:
+        for k in xrange(2):
+            for i in xrange(numpieces):
+                s.was_preallocated(i * piece_size, min(piece_size, total - i * piece_size))
+    t = time() - t
+    b = time()
+    for pos in xrange(0, total, 2 ** 14):
+        s._intervals(pos, min(2 ** 14, total - pos))
+    return t, time() - b
+
+def bench_startup():
+    r = Random(5)
+    # 100,000 files of up to 100 KB, all fully on disk, so every piece was preallocated.
+    files = [('f%d' % i, r.randrange(1, 100000)) for i in xrange(100000)]
+    lengths = dict(files)
+    print 'starting a download of 100,000 files, best of 3'
+    print 'piece size  startup before  startup after  block lookups before  block lookups after'
+    for piece_size in (2 ** 18, 2 ** 20, 2 ** 22):
+        a = [time_startup(files, lengths.has_key, lengths.get, piece_size, False) for k in xrange(3)]
+        b = [time_startup(files, lengths.has_key, lengths.get, piece_size, True) for k in xrange(3)]
+        print '%6d KiB  %13.3fs  %12.3fs  %19.3fs  %18.3fs' % (piece_size / 1024,
+            min([x[0] for x in a]), min([x[0] for x in b]), min([x[1] for x in a]), min([x[1] for x in b]))
+
+if __name__ == '__main__':
+    assert pread is not None and posix_fadvise is not None, 'no pread or posix_fadvise on this system'
+    if len(sys.argv) > 1:
+        dir = mkdtemp(dir = sys.argv[1])
+    else:
+        dir = mkdtemp()
+    try:
+        bench_reads(dir)
+        print
+        bench_check(dir)
+        print
+        bench_pickers(dir)
+        print
+        bench_piece_state()
+        print
+        bench_startup()
+    finally:
+        rmdir(dir)
@@ -8,26 +8,30 @@ except:
     False = 0
     bool = lambda x: not not x
 
-try:
-    sum([1])
-    negsum = lambda a: len(a)-sum(a)
-except:
-    negsum = lambda a: reduce(lambda x,y: x+(not y), a, 0)
-    
-def _int_to_booleans(x):
-    r = []
-    for i in range(8):
-        r.append(bool(x & 0x80))
-        x <<= 1
-    return tuple(r)
+from binascii import b2a_hex, a2b_hex
+
+# The number of values packed into each word of a bitfield.
+WORD_BITS = 1024
+
+def numwords(length):
+    # Returns the number of words needed to hold the given number of values.
+    return (length + WORD_BITS - 1) // WORD_BITS
+
+# Maps each position in a word to its bit, with the first position in the highest bit.
+# This matches the order of bits sent over the wire.
+word_bits = [1L << (WORD_BITS - 1 - i) for i in xrange(WORD_BITS)]
+
+def word_bit(index):
+    # Returns the bit for the given index in its word.
+    return word_bits[index % WORD_BITS]
 
-# Maps each possible byte value to an array of 8 booleans.
-lookup_table = [_int_to_booleans(i) for i in range(256)]
+def bit_index(word, bit):
+    # Returns the index of the given single bit in the given word number.
+    return word * WORD_BITS + WORD_BITS - bit.bit_length()
 
-# Maps each array of 8 booleans to its corresponding byte value.
-reverse_lookup_table = {}
-for i in xrange(256):
-    reverse_lookup_table[lookup_table[i]] = chr(i)
+def popcount(word):
+    # Returns the number of bits set in the given word.
+    return bin(word).count('1')
 
 
 class Bitfield:
@@ -38,46 +42,108 @@ class Bitfield:
             extra = len(bitstring) * 8 - length
             if extra < 0 or extra >= 8:
                 raise ValueError
-            t = lookup_table
-            r = []
-            # Convert each character in the bitstring to its boolean array.
-            for c in bitstring:
-                r.extend(t[ord(c)])
-            if extra > 0:
-                if r[-extra:] != [0] * extra:
-                    raise ValueError
-                del r[-extra:]
-            self.array = r
-            # The number of false values in the array.
-            self.numfalse = negsum(r)
+            if extra > 0 and ord(bitstring[-1]) & ((1 << extra) - 1):
+                # The spare bits at the end must be zero.
+                raise ValueError
+            # The values packed into long integers of WORD_BITS bits.
+            self.words = []
+            n = WORD_BITS // 8
+            for x in xrange(0, len(bitstring), n):
+                chunk = bitstring[x:x+n]
+                self.words.append(long(b2a_hex(chunk), 16) << ((n - len(chunk)) * 8))
+            # The number of false values.
+            self.numfalse = length - self.count_words()
         else:
-            self.array = [False] * length
+            self.words = [0L] * numwords(length)
             self.numfalse = length
 
+    def _check(self, index):
+        # Returns the index, counting from the end if negative, like a list would.
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError, 'bitfield index out of range'
+        return index
+
     def __setitem__(self, index, val):
-        val = bool(val)
-        self.numfalse += self.array[index]-val
-        self.array[index] = val
+        index = self._check(index)
+        w = index // WORD_BITS
+        bit = word_bits[index % WORD_BITS]
+        if val:
+            if not self.words[w] & bit:
+                self.words[w] |= bit
+                self.numfalse -= 1
+        elif self.words[w] & bit:
+            self.words[w] &= ~bit
+            self.numfalse += 1
 
     def __getitem__(self, index):
-        return self.array[index]
+        index = self._check(index)
+        return (self.words[index // WORD_BITS] & word_bits[index % WORD_BITS]) != 0
 
     def __len__(self):
         return self.length
 
     def tostring(self):
-        booleans = self.array
-        t = reverse_lookup_table
-        s = len(booleans) % 8
-        r = [ t[tuple(booleans[x:x+8])] for x in xrange(0, len(booleans)-s, 8) ]
-        if s:
-            r += t[tuple(booleans[-s:] + ([0] * (8-s)))]
-        return ''.join(r)
+        # Each word becomes WORD_BITS / 8 bytes, then the bytes past the last value are dropped.
+        f = '%0' + str(WORD_BITS // 4) + 'x'
+        r = [a2b_hex(f % w) for w in self.words]
+        return ''.join(r)[:(self.length + 7) // 8]
+
+    def count_words(self):
+        # Returns the number of true values, counting the bits in each word.
+        total = 0
+        for w in self.words:
+            if w:
+                total += popcount(w)
+        return total
+
+    def count(self):
+        # Returns the number of true values.
+        return self.length - self.numfalse
+
+    def any(self):
+        # Returns whether any value is true.
+        return self.numfalse < self.length
 
     def complete(self):
         # Complete if no values are false, i.e. all are true.
         return not self.numfalse
 
+    def _combine(self, words):
+        # Returns a new Bitfield of the same length with the given words.
+        b = Bitfield(self.length)
+        b.words = words
+        b.numfalse = self.length - b.count_words()
+        return b
+
+    def __and__(self, other):
+        # Returns the values true in both this and the other Bitfield.
+        return self._combine([a & b for a, b in zip(self.words, other.words)])
+
+    def andnot(self, other):
+        # Returns the values true in this Bitfield but not the other.
+        return self._combine([a & ~b for a, b in zip(self.words, other.words)])
+
+    def intersects(self, other):
+        # Returns whether any value is true in both this and the other Bitfield.
+        for a, b in zip(self.words, other.words):
+            if a & b:
+                return True
+        return False
+
+    def indexes(self):
+        # Returns the indexes of the true values in order, skipping the words with none.
+        r = []
+        for w in xrange(len(self.words)):
+            x = self.words[w]
+            while x:
+                # Take the highest bit, which has the lowest index.
+                bit = 1L << (x.bit_length() - 1)
+                r.append(bit_index(w, bit))
+                x ^= bit
+        return r
+
 
 def test_bitfield():
     try:
@@ -158,3 +224,40 @@ def test_bitfield():
     assert len(x) == 8
     assert x.numfalse == 5
     assert x.tostring() == chr(0xC4)
+
+def test_words():
+    x = Bitfield(1030, chr(0x80) + chr(0) * 126 + chr(1) + chr(0x40))
+    assert x.words == [(1L << 1023) | 1, 1L << 1022]
+    assert bit_index(0, 1L << 1023) == 0
+    assert bit_index(0, 1L) == 1023
+    assert bit_index(1, 1L << 1022) == 1025
+    x[0] = 0
+    x[1029] = 1
+    assert x.words == [1L, (1L << 1022) | (1L << 1018)]
+    y = Bitfield(1030, x.tostring())
+    assert y.words == x.words
+    assert len(Bitfield(0, '').words) == 0
+
+def test_set_operations():
+    x = Bitfield(1030)
+    y = Bitfield(1030)
+    assert not x.any()
+    for i in (0, 5, 1029):
+        x[i] = 1
+    y[5] = 1
+    y[-1] = 1
+    assert y[1029]
+    assert x.count() == 3
+    assert x.indexes() == [0, 5, 1029]
+    assert x.intersects(y)
+    assert (x & y).indexes() == [5, 1029]
+    z = x.andnot(y)
+    assert z.indexes() == [0]
+    assert z.numfalse == 1029
+    assert not z.intersects(y)
+    assert z.any()
+    try:
+        x[1030]
+        assert False
+    except IndexError:
+        pass
@@ -5,8 +5,9 @@ from zurllib import urlopen
 from urlparse import urljoin
 from btformats import check_message
 from Choker import Choker
-from Storage import Storage
+from Storage import Storage, MmapStorage, MemoryStorage, BlobStorage, handle_pool
 from StorageWrapper import StorageWrapper
+from DiskIO import DiskIO
 from Uploader import Upload
 from Downloader import Downloader
 from Connecter import Connecter
@@ -16,12 +17,14 @@ from Rerequester import Rerequester
 from DownloaderFeedback import DownloaderFeedback
 from RateMeasure import RateMeasure
 from CurrentRateMeasure import Measure
-from PiecePicker import PiecePicker
+from PiecePicker import PiecePicker, strategies
+from StreamReader import Streamer
+from FilePriority import FilePriority
 from bencode import bencode, bdecode
 from __init__ import version
 from binascii import b2a_hex
 from sha import sha
-from os import path, makedirs
+from os import path, makedirs, remove, rename
 from parseargs import parseargs, formatDefinitions
 from socket import error as socketerror
 from random import seed
@@ -82,6 +85,8 @@ defaults = [
         'whether to check hashes on disk'),
     ('max_upload_rate', 0,
         'maximum kB/s to upload at, 0 means no limit'),
+    ('max_download_rate', 0,
+        'maximum kB/s to download at, 0 means no limit'),
     ('snub_time', 30.0,
         "seconds to wait for data to come in over a connection before assuming it's semi-permanently choked"),
     ('spew', 0,
@@ -92,6 +97,42 @@ defaults = [
         "the number of uploads to fill out to with extra optimistic unchokes"),
     ('report_hash_failures', 0,
         "whether to inform the user that hash failures occur. They're non-fatal."),
+    ('stream_window', 8,
+        "number of pieces after a stream reader's position to download before all others"),
+    ('stream_piece_time', 2.0,
+        "seconds between the deadlines of consecutive pieces after a stream reader's position"),
+    ('stream_duplicate_time', 5.0,
+        "pieces a stream reader needs within this many seconds are requested from several peers at once"),
+    ('resume_interval', 300,
+        "seconds between saving fast-resume state next to the download, so restarting skips checking it (0 to disable)"),
+    ('verify_rate', 8388608,
+        "bytes per second of existing data to check in the background when check_hashes is off or resuming after a crash (0 to disable)"),
+    ('read_cache_size', 8388608,
+        "bytes of recently uploaded pieces to hold in memory, so each piece is read from disk once for all blocks and peers requesting it"),
+    ('write_cache_size', 4194304,
+        "bytes of downloaded blocks to hold in memory, so each piece is written to disk in as few writes as possible"),
+    ('disk_threads', 2,
+        "number of threads reading and writing the downloaded files, so a slow disk doesn't stall the network (0 to access the disk directly)"),
+    ('max_disk_queue', 64,
+        "the most disk reads and writes to queue before pausing uploads and requests until the disk catches up"),
+    ('max_files_open', 50,
+        "the most files to keep open at once across all downloads in this process, closing the least recently used"),
+    ('fadvise', 1,
+        "whether to tell the operating system how files will be read, so checking existing data doesn't push data being uploaded out of its cache"),
+    ('storage', 'files',
+        "how to access the downloaded files: 'files' reads and writes them through file handles, 'mmap' maps them into memory, which is faster for seeding large files on 64-bit systems, 'blob' keeps them all in one file named after the download with '.blob' appended, and 'memory' keeps them in memory without saving them"),
+    ('allocation', 'compact',
+        "how to allocate disk space: 'compact' writes pieces into the first free space and moves them into place later, while 'direct' writes each piece at its final position without moving it, leaving the parts not downloaded yet sparse"),
+    ('hash_threads', 2,
+        "number of threads hashing existing data at startup while another thread reads ahead"),
+    ('ban_file', '',
+        "file listing the IP addresses of peers banned for sending data that failed hash checks, one per line"),
+    ('piece_affinity_time', 15.0,
+        "peers fast enough to download a whole piece within this many seconds download pieces by themselves (0 to disable)"),
+    ('piece_picker', 'rarest',
+        "how to pick pieces to download: 'rarest' first for public swarms, 'sequential' for mirrors, or 'cached' to pick pieces next to those just written"),
+    ('priority', '',
+        "comma-separated per-file priorities, -1 to skip, 0 normal, 1 or higher to download first (multi-file torrents only)"),
     ]
 
 def download(params, filefunc, statusfunc, finfunc, errorfunc, doneflag, cols, pathFunc = None, paramfunc = None, spewflag = Event()):
@@ -110,6 +151,12 @@ def download(params, filefunc, statusfunc, finfunc, errorfunc, doneflag, cols, p
                 config['url'] = args[0]
         if (config['responsefile'] == '') == (config['url'] == ''):
             raise ValueError, 'need responsefile or url'
+        if not strategies.has_key(config['piece_picker']):
+            raise ValueError, 'piece_picker must be one of ' + ', '.join(strategies.keys())
+        if config['storage'] not in ('files', 'mmap', 'blob', 'memory'):
+            raise ValueError, "storage must be 'files', 'mmap', 'blob', or 'memory'"
+        if config['allocation'] not in ('direct', 'compact'):
+            raise ValueError, "allocation must be 'direct' or 'compact'"
     except ValueError, e:
         errorfunc('error: ' + str(e) + '\nrun with no args for parameter explanations')
         return
@@ -140,6 +187,8 @@ def download(params, filefunc, statusfunc, finfunc, errorfunc, doneflag, cols, p
         return
     
     # Make the directory structure for the files to download.
+    # A blob or memory download makes no files, except for saving state next to where they would be.
+    nofiles = config['storage'] in ('blob', 'memory')
     try:
         def make(f, forcedir = False):
             if not forcedir:
@@ -173,7 +222,7 @@ def download(params, filefunc, statusfunc, finfunc, errorfunc, doneflag, cols, p
                 if not existing:
                     file = path.join(file, info['name'])
                     
-            make(file, True)
+            make(file, not nofiles)
             
             # alert the UI to any possible change in path
             if pathFunc != None:
@@ -185,10 +234,30 @@ def download(params, filefunc, statusfunc, finfunc, errorfunc, doneflag, cols, p
                 for i in x['path']:
                     n = path.join(n, i)
                 files.append((n, x['length']))
-                make(n)
+                if not nofiles:
+                    make(n)
     except OSError, e:
         errorfunc("Couldn't allocate dir - " + str(e))
         return
+
+    # Parse the priority of each file.
+    priorities = [0] * len(files)
+    if config['priority'] != '':
+        try:
+            priorities = [int(x) for x in config['priority'].split(',')]
+            if len(priorities) != len(files):
+                raise ValueError, 'need one priority for each of the ' + str(len(files)) + ' files'
+            for p in priorities:
+                if p < -1:
+                    raise ValueError, 'priorities must be -1 or higher'
+        except ValueError, e:
+            errorfunc('bad priority - ' + str(e))
+            return
+    # Skipped files are not created.
+    skip = {}
+    for i in xrange(len(files)):
+        if priorities[i] == -1:
+            skip[files[i][0]] = 1
     
     # Flag set if we have all pieces and are seeding. Is not doneflag, which exits.
     finflag = Event()
@@ -202,6 +271,19 @@ def download(params, filefunc, statusfunc, finfunc, errorfunc, doneflag, cols, p
     # Create the array of SHA-1 piece hashes.
     pieces = [info['pieces'][x:x+20] for x in xrange(0, 
         len(info['pieces']), 20)]
+    infohash = sha(bencode(info)).digest()
+    # Load the fast-resume state saved by an earlier run.
+    resume_file = file + '.resume'
+    resume = None
+    if config['resume_interval'] > 0 and path.exists(resume_file):
+        try:
+            f = open(resume_file, 'rb')
+            resume = bdecode(f.read())
+            f.close()
+            if type(resume) is not dict or resume.get('infohash') != infohash:
+                resume = None
+        except (IOError, ValueError):
+            resume = None
     def failed(reason, errorfunc = errorfunc, doneflag = doneflag):
         # Exit.
         doneflag.set()
@@ -212,7 +294,18 @@ def download(params, filefunc, statusfunc, finfunc, errorfunc, doneflag, cols, p
     try:
         try:
             # Create the low-level storage.
-            storage = Storage(files, open, path.exists, path.getsize)
+            handle_pool.max_open = config['max_files_open']
+            if config['storage'] == 'mmap':
+                storage = MmapStorage(files, open, path.exists, path.getsize, skip, path.getmtime,
+                    fadvise = config['fadvise'])
+            elif config['storage'] == 'blob':
+                storage = BlobStorage(file + '.blob', files, open, path.exists, path.getsize,
+                    path.getmtime, fadvise = config['fadvise'])
+            elif config['storage'] == 'memory':
+                storage = MemoryStorage(files)
+            else:
+                storage = Storage(files, open, path.exists, path.getsize, skip, path.getmtime,
+                    fadvise = config['fadvise'])
         except IOError, e:
             errorfunc('trouble accessing files - ' + str(e))
             return
@@ -235,16 +328,30 @@ def download(params, filefunc, statusfunc, finfunc, errorfunc, doneflag, cols, p
                 rm[0](amount)
             if report_hash_failures:
                 errorfunc('a piece failed hash check, re-downloading it')
+        sf = [None]
+        def piece_finished(index, sf = sf):
+            if sf[0] is not None:
+                sf[0](index)
+        pl = [None]
+        def piece_lost(index, pl = pl):
+            if pl[0] is not None:
+                pl[0](index)
+        # Read and write the files on worker threads, completing in the reactor loop.
+        diskio = DiskIO(config['disk_threads'], rawserver.external_add_task,
+            config['max_disk_queue'])
         # Wrap the low-level storage with high-level storage.
         storagewrapper = StorageWrapper(storage, 
             config['download_slice_size'], pieces, 
             info['piece length'], finished, failed, 
-            statusfunc, doneflag, config['check_hashes'], data_flunked)
+            statusfunc, doneflag, config['check_hashes'], data_flunked,
+            piece_finished, config['hash_threads'], resume, config['allocation'],
+            config['write_cache_size'], config['read_cache_size'], diskio, piece_lost)
     except ValueError, e:
         failed('bad data - ' + str(e))
     except IOError, e:
         failed('IOError - ' + str(e))
     if doneflag.isSet():
+        diskio.stop()
         return
 
     # Bind to the first port available in range [minport, maxport].
@@ -257,6 +364,7 @@ def download(params, filefunc, statusfunc, finfunc, errorfunc, doneflag, cols, p
             pass
     else:
         errorfunc("Couldn't listen - " + str(e))
+        diskio.stop()
         return
 
     # Create the choker.
@@ -278,29 +386,77 @@ def download(params, filefunc, statusfunc, finfunc, errorfunc, doneflag, cols, p
     ratemeasure = RateMeasure(storagewrapper.get_amount_left())
     rm[0] = ratemeasure.data_rejected
     # Create piece picker, initialize with completed pieces.
-    picker = PiecePicker(len(pieces), config['rarest_first_cutoff'])
+    picker = PiecePicker(len(pieces), config['rarest_first_cutoff'],
+        strategies[config['piece_picker']]())
     for i in xrange(len(pieces)):
         if storagewrapper.do_I_have(i):
             picker.complete(i)
 
+    # Will later refer to a method to ban a peer that sent bad data.
+    bn = [None]
+    def ban(ip, bn = bn):
+        if bn[0] is not None:
+            bn[0](ip)
+
     # Create the downloader.
     # This takes ownership of storage, the piece picker, and download rate measurement.
     downloader = Downloader(storagewrapper, picker,
         config['request_backlog'], config['max_rate_period'],
         len(pieces), downmeasure, config['snub_time'], 
-        ratemeasure.data_came_in)
+        ratemeasure.data_came_in, config['max_download_rate'] * 1024,
+        rawserver.add_task, rawserver.pause_reading, rawserver.resume_reading,
+        config['download_slice_size'], info['piece length'], config['piece_affinity_time'],
+        ban)
+
+    # Skip files and download the pieces of high priority files first.
+    filepriority = FilePriority(files, info['piece length'], storagewrapper, picker,
+        downloader, rawserver.external_add_task)
+    filepriority.set_priorities(priorities)
+    pl[0] = filepriority.piece_lost
+
+    # Serve stream readers out of the download, downloading the pieces they need first.
+    streamer = Streamer(storagewrapper, picker, downloader, rawserver.external_add_task,
+        doneflag, info['piece length'], file_length, config['stream_window'],
+        config['stream_piece_time'], config['stream_duplicate_time'])
+    sf[0] = streamer.piece_finished
 
     # Create the Connecter.
     # This takes ownership of the upload factory, downloader, choker, and upload rate measurement.
     connecter = Connecter(make_upload, downloader, choker,
         len(pieces), upmeasure, config['max_upload_rate'] * 1024, rawserver.add_task)
-    infohash = sha(bencode(info)).digest()
 
     # Create the Encoder.
     # This takes ownership of the Connecter and server.
     encoder = Encoder(connecter, rawserver, 
         myid, config['max_message_length'], rawserver.add_task, 
         config['keepalive_interval'], infohash, config['max_initiate'])
+    # Load the peers banned in earlier sessions.
+    ban_file = config['ban_file']
+    if ban_file != '' and path.exists(ban_file):
+        try:
+            f = open(ban_file, 'r')
+            for line in f.readlines():
+                if line.strip() != '':
+                    encoder.ban(line.strip())
+            f.close()
+        except IOError, e:
+            errorfunc('trouble reading ban file - ' + str(e))
+    def ban_peer(ip, encoder = encoder, ban_file = ban_file, errorfunc = errorfunc,
+            report_hash_failures = config['report_hash_failures']):
+        if encoder.banned.has_key(ip):
+            return
+        encoder.ban(ip)
+        if report_hash_failures:
+            errorfunc('banned ' + ip + ' for sending data that failed hash check')
+        if ban_file != '':
+            # Remember the ban for later sessions.
+            try:
+                f = open(ban_file, 'a')
+                f.write(ip + '\n')
+                f.close()
+            except IOError, e:
+                errorfunc('trouble writing ban file - ' + str(e))
+    bn[0] = ban_peer
     # Create the Rerequester to make requests to the tracker and find new peers.
     rerequest = Rerequester(response['announce'], config['rerequest_interval'], 
         rawserver.add_task, connecter.how_many_connections, 
@@ -322,17 +478,63 @@ def download(params, filefunc, statusfunc, finfunc, errorfunc, doneflag, cols, p
     # useful info and functions for the UI
     if paramfunc:
         paramfunc({ 'max_upload_rate' : connecter.change_max_upload_rate,  # change_max_upload_rate(<int bytes/sec>)
+                    'max_download_rate' : downloader.change_max_download_rate,  # change_max_download_rate(<int bytes/sec>)
                     'max_uploads': choker.change_max_uploads, # change_max_uploads(<int max uploads>)
                     'listen_port' : listen_port, # int
                     'peer_id' : myid, # string
                     'info_hash' : infohash, # string
-                    'start_connection' : encoder._start_connection # start_connection((<string ip>, <int port>), <peer id>)
+                    'start_connection' : encoder._start_connection, # start_connection((<string ip>, <int port>), <peer id>)
+                    'open_stream' : streamer.open, # open_stream(<int begin>, <int length>) returns a file-like object
+                    'set_file_priority' : filepriority.set_priority, # set_file_priority(<int file index>, <int priority>)
+                    'get_cache_stats' : storagewrapper.get_cache_stats, # get_cache_stats() returns a dict of read hits and misses and bytes cached
+                    'get_handle_stats' : handle_pool.get_stats # get_handle_stats() returns a dict of file handle hits, misses, and files open
                     })
     
     statusfunc({"activity" : 'connecting to peers'})
     # Method to make a request to the tracker when the download has completed.
     ann[0] = rerequest.announce
     rerequest.begin()
+    def save_resume(clean = False, storagewrapper = storagewrapper, 
+            resume_file = resume_file, infohash = infohash, errorfunc = errorfunc):
+        # Write to a temporary file first, so a crash never leaves a truncated state file.
+        try:
+            r = storagewrapper.get_resume_data(clean)
+            r['infohash'] = infohash
+            f = open(resume_file + '.tmp', 'wb')
+            f.write(bencode(r))
+            f.close()
+            try:
+                rename(resume_file + '.tmp', resume_file)
+            except OSError:
+                # Windows does not rename over an existing file.
+                remove(resume_file)
+                rename(resume_file + '.tmp', resume_file)
+        except (IOError, OSError), e:
+            errorfunc('trouble saving fast-resume state - ' + str(e))
+    if config['resume_interval'] > 0:
+        def save_periodically(save_resume = save_resume, add_task = rawserver.add_task,
+                interval = config['resume_interval']):
+            add_task(save_periodically, interval)
+            save_resume()
+        # Save right away, so a crash never leaves the state of a clean shutdown behind.
+        rawserver.add_task(save_periodically, 0)
+    if config['verify_rate'] > 0:
+        def verify_periodically(verify_unchecked = storagewrapper.verify_unchecked,
+                add_task = rawserver.add_task, rate = config['verify_rate']):
+            # Check a second's worth of data, and keep going while unchecked pieces remain.
+            if verify_unchecked(rate):
+                add_task(verify_periodically, 1)
+        rawserver.add_task(verify_periodically, 0)
     rawserver.listen_forever(encoder)
+    if config['resume_interval'] > 0:
+        save_resume(True)
+    else:
+        # Write the blocks still held in memory.
+        try:
+            storagewrapper.flush()
+        except IOError, e:
+            errorfunc('trouble writing downloaded data - ' + str(e))
+    # Every write has finished once the worker threads stop.
+    diskio.stop()
     storage.close()
     rerequest.announce(2)
@@ -38,12 +38,19 @@ class FakeHandle:
             f.append(chr(0))
         self.fakeopen.files[self.name][self.pos : self.pos + len(s)] = list(s)
         self.pos += len(s)
+        self.fakeopen.mtimes[self.name] = self.fakeopen.mtimes.get(self.name, 0) + 1
+
+    def truncate(self, size):
+        del self.fakeopen.files[self.name][size:]
+        self.fakeopen.mtimes[self.name] = self.fakeopen.mtimes.get(self.name, 0) + 1
 
 class FakeOpen:
     """A fake file system. Used for testing."""
 
     def __init__(self, initial = {}):
         self.files = {}
+        # Maps each file to the number of times it was written, standing in for its modification time.
+        self.mtimes = {}
         for key, value in initial.items():
             self.files[key] = list(value)
     
@@ -58,6 +65,9 @@ class FakeOpen:
     def getsize(self, file):
         return len(self.files[file])
 
+    def getmtime(self, file):
+        return self.mtimes.get(file, 0)
+
 def test_normal():
     f = FakeOpen({'f1': 'abcde'})
     assert f.exists('f1')